@@ -11,6 +11,8 @@ from ksshow import Show
 from kssettings import Settings, About
 from ksviewer import ImgView
 from ksdialogs import MessageDialog
+from ksthumbnail import CacheMigration
+from ksbackend import BackendCalibration
 
 
 class ViewerMode(QWidget):
@@ -108,7 +110,7 @@ class ViewerMode(QWidget):
 
     def show_picture_result(self, img_temp_path, need_temp):
         self.rolling_progressbar.hide()
-        self.image_viewer = ImgView(img_temp_path, self.current_img_path, self.current_show_size, need_temp)
+        self.image_viewer = ImgView(img_temp_path, self.current_img_path, self.current_show_size, need_temp, '')
         self.image_viewer.show()
 
     def closeEvent(self, event):
@@ -183,6 +185,8 @@ class AlbumMode(QWidget):
         self.album_layout = QVBoxLayout()
         self.album_layout.setContentsMargins(0, 0, 0, 0)
         self.main_layout.addLayout(self.album_layout)
+        CacheMigration().start_migrate()
+        BackendCalibration().start_calibrate()
         self.album = Show(window_width)
         self.album_layout.addWidget(self.album)
 
@@ -0,0 +1,528 @@
+import os
+import time
+import random
+import struct
+import shutil
+import threading
+import subprocess
+from threading import Thread, Lock
+from PySide6.QtCore import Qt, QSize, QRect, qVersion
+from PySide6.QtGui import QImage, QImageReader, QImageWriter, QImageIOHandler, QPainter, QColor, QLinearGradient
+
+from kshandler import Commands, ImageMagickHandler
+from ksprobe import PictureHeader
+from ksexif import ExifHeader
+
+
+class QtBackend:
+    # Qt's image plugins decode inside this process, so no program is started for each picture
+    name = 'qt'
+    probe_formats = ['.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp', '.heic', '.heif']
+
+    def __init__(self):
+        super(QtBackend, self).__init__()
+
+    @staticmethod
+    def read_formats(supported_formats):
+        return set(f'.{bytes(img_format).decode().lower()}' for img_format in supported_formats)
+
+    def check_operation(self, filetype, operation):
+        filetype = filetype.lower()
+        if operation == 'probe' and filetype in self.probe_formats:
+            return True
+        return filetype in self.read_formats(QImageReader.supportedImageFormats())
+
+    @staticmethod
+    def check_target(target_path):
+        target_filetype = Commands.get_filetype(target_path).lower()
+        return target_filetype in QtBackend.read_formats(QImageWriter.supportedImageFormats())
+
+    @staticmethod
+    def decode(img_path, width=0, height=0):
+        # The picture is turned upright, and JPEG is scaled by 1/2, 1/4 or 1/8 while decoding when it is
+        # wanted smaller; the scaled size is given before the EXIF rotation
+        img_reader = QImageReader(img_path)
+        img_reader.setAutoTransform(True)
+
+        img_size = img_reader.size()
+        if img_size.isValid() and (width or height):
+            img_width = img_size.width()
+            img_height = img_size.height()
+            rotated = bool(img_reader.transformation() & QImageIOHandler.TransformationRotate90)
+            if rotated:
+                img_width, img_height = img_height, img_width
+
+            scaled_width, scaled_height = QtBackend.read_scaled_size(img_width, img_height, width, height)
+            if scaled_width < img_width:
+                if rotated:
+                    scaled_width, scaled_height = scaled_height, scaled_width
+                img_reader.setScaledSize(QSize(scaled_width, scaled_height))
+
+        img = img_reader.read()
+        if img.isNull():
+            return None
+        return img
+
+    @staticmethod
+    def thumbnail(img_path, tiers_list):
+        # tiers_list holds (target_path, resize_option) pairs, largest first; the picture is decoded once
+        # for the largest and every smaller tier is scaled from the one before it
+        width, height = QtBackend.read_resize_option(tiers_list[0][1])
+        img = QtBackend.decode(img_path, width, height)
+        if img is None:
+            return False
+        img = QtBackend.flatten_image(img)
+
+        for target_path, resize_option in tiers_list:
+            img = QtBackend.resize_image(img, resize_option)
+            if not QtBackend.save_thumbnail(img, target_path):
+                return False
+
+        return True
+
+    @staticmethod
+    def crop(img_path, target_path, resize_option, width, height, begin_x, begin_y):
+        # The picture is resized first, so the area is given in the size it was shown at
+        if not QtBackend.check_target(target_path):
+            return False
+
+        img = QtBackend.decode(img_path, *QtBackend.read_resize_option(resize_option))
+        if img is None:
+            return False
+        img = QtBackend.resize_image(img, resize_option)
+
+        # As with ImageMagick, an area reaching past the picture is cut at its edges
+        crop_rect = QRect(int(begin_x), int(begin_y), int(width), int(height)).intersected(img.rect())
+        if crop_rect.isEmpty():
+            return False
+        if not QtBackend.save_image(img.copy(crop_rect), target_path, ''):
+            return False
+        return QtBackend.copy_exif(img_path, target_path)
+
+    @staticmethod
+    def convert(img_path, target_path, resize_option, img_quality):
+        if not QtBackend.check_target(target_path):
+            return False
+
+        img = QtBackend.decode(img_path, *QtBackend.read_resize_option(resize_option))
+        if img is None:
+            return False
+        img = QtBackend.resize_image(img, resize_option)
+        if not QtBackend.save_image(img, target_path, img_quality):
+            return False
+        return QtBackend.copy_exif(img_path, target_path)
+
+    @staticmethod
+    def probe(img_path):
+        # The header parser answers without loading a plugin; Qt's reader covers the formats it does not know
+        img_width, img_height = PictureHeader.read_display_size(img_path)
+        if not img_width or not img_height:
+            img_reader = QImageReader(img_path)
+            img_reader.setAutoTransform(True)
+            img_size = img_reader.size()
+            img_width = max(img_size.width(), 0)
+            img_height = max(img_size.height(), 0)
+            if img_reader.transformation() & QImageIOHandler.TransformationRotate90:
+                img_width, img_height = img_height, img_width
+
+        if not img_width or not img_height:
+            return None
+        return img_width, img_height
+
+    @staticmethod
+    def flatten_image(img):
+        if img.hasAlphaChannel():
+            # JPEG has no transparency, so transparent areas are laid on white
+            flattened_img = QImage(img.size(), QImage.Format_RGB32)
+            flattened_img.fill(Qt.white)
+            painter = QPainter(flattened_img)
+            painter.drawImage(0, 0, img)
+            painter.end()
+            img = flattened_img
+        return img
+
+    @staticmethod
+    def resize_image(img, resize_option):
+        width, height = QtBackend.read_resize_option(resize_option)
+        scaled_width, scaled_height = QtBackend.read_scaled_size(img.width(), img.height(), width, height)
+        if resize_option.endswith('>') and scaled_width >= img.width():
+            # As in ImageMagick geometry, ">" only ever shrinks a picture
+            return img
+        if (scaled_width, scaled_height) != (img.width(), img.height()):
+            img = img.scaled(scaled_width, scaled_height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        return img
+
+    @staticmethod
+    def save_image(img, target_path, img_quality):
+        target_filetype = Commands.get_filetype(target_path).lower()
+        if target_filetype in ['.jpg', '.jpeg']:
+            img = QtBackend.flatten_image(img)
+
+        if img_quality:
+            return img.save(target_path, target_filetype[1:].upper(), int(img_quality))
+        return img.save(target_path, target_filetype[1:].upper())
+
+    @staticmethod
+    def copy_exif(img_path, target_path):
+        # Qt writes no EXIF, so a JPEG's EXIF segment is copied into the JPEG made from it, as ImageMagick does;
+        # the pixels were turned upright while decoding, so the copy's orientation is reset
+        if Commands.get_filetype(target_path).lower() not in ['.jpg', '.jpeg']:
+            return True
+        try:
+            with open(img_path, 'rb') as img_file:
+                tiff_data, _ = ExifHeader.read_jpeg_exif_segment(img_file.read(131072))
+            if not tiff_data:
+                return True
+            tiff_data = ExifHeader.reset_orientation(tiff_data)
+
+            with open(target_path, 'rb') as target_file:
+                target_data = target_file.read()
+            if target_data[:2] != b'\xff\xd8':
+                return False
+
+            # The EXIF segment goes after a JFIF segment, where readers look for it
+            insert_offset = 2
+            if target_data[2:4] == b'\xff\xe0':
+                insert_offset = 4 + struct.unpack('>H', target_data[4:6])[0]
+            exif_segment = b'Exif\x00\x00' + tiff_data
+            exif_segment = b'\xff\xe1' + struct.pack('>H', len(exif_segment) + 2) + exif_segment
+
+            temp_target_path = f'{target_path}.{os.getpid()}.{threading.get_ident()}.part'
+            with open(temp_target_path, 'wb') as temp_target_file:
+                temp_target_file.write(target_data[:insert_offset] + exif_segment + target_data[insert_offset:])
+            os.replace(temp_target_path, target_path)
+        except (OSError, struct.error):
+            return False
+        return True
+
+    @staticmethod
+    def save_thumbnail(img, target_path):
+        # The cache file only appears once it is complete, so an interrupted write is never taken as cached;
+        # the album may ask for a picture a cache thread is also writing, so each writer has its own temp file
+        temp_target_path = f'{target_path}.{os.getpid()}.{threading.get_ident()}.part'
+        target_format = Commands.get_filetype(target_path)[1:].upper()
+        if not img.save(temp_target_path, target_format, 90):
+            if os.path.exists(temp_target_path):
+                os.remove(temp_target_path)
+            return False
+
+        os.replace(temp_target_path, target_path)
+        return True
+
+    @staticmethod
+    def read_scaled_size(img_width, img_height, width, height):
+        if width and height:
+            scale = min(width / img_width, height / img_height)
+        elif height:
+            scale = height / img_height
+        elif width:
+            scale = width / img_width
+        else:
+            scale = 1
+        scaled_width = max(round(img_width * scale), 1)
+        scaled_height = max(round(img_height * scale), 1)
+        return scaled_width, scaled_height
+
+    @staticmethod
+    def read_resize_option(resize_option):
+        # ImageMagick geometry such as "x250", "250" or "250x250"
+        width = int()
+        height = int()
+        if resize_option:
+            size = resize_option.rstrip('>').split('x')
+            if size[0].isdigit():
+                width = int(size[0])
+            if len(size) > 1 and size[1].isdigit():
+                height = int(size[1])
+        return width, height
+
+
+class ImageMagickBackend:
+    # ImageMagick reads the formats Qt has no plugin for, at the cost of one process for each call
+    name = 'imagemagick'
+
+    def __init__(self):
+        super(ImageMagickBackend, self).__init__()
+        self.imagemagick_handler = ImageMagickHandler()
+        self.imagemagick_program_status, self.imagemagick_program_path = \
+            self.imagemagick_handler.check_imagemagick_available()
+        self.formats_set = set(img_format.lower() for img_format in Commands.read_supported_formats())
+        self.formats_set.add('unknown')
+
+    def check_operation(self, filetype, operation):
+        if not self.imagemagick_program_status:
+            return False
+        return filetype.lower() in self.formats_set
+
+    def decode(self, img_path, width=0, height=0):
+        commands = [self.imagemagick_program_path, img_path, '-auto-orient']
+        if width or height:
+            commands.extend(['-resize', f'{width or ""}x{height or ""}>'])
+        commands.extend(['-define', 'png:compression-level=1', 'png:-'])
+
+        hide_console = self.imagemagick_handler.hide_console_status()
+        decode_process = subprocess.Popen(
+            commands, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, startupinfo=hide_console
+        )
+        img_data, _ = decode_process.communicate()
+        if decode_process.returncode != 0 or not img_data:
+            return None
+
+        img = QImage.fromData(img_data)
+        if img.isNull():
+            return None
+        return img
+
+    def thumbnail(self, img_path, tiers_list):
+        return self.imagemagick_handler.convert_picture_tiers(img_path, tiers_list)
+
+    def crop(self, img_path, target_path, resize_option, width, height, begin_x, begin_y):
+        if not self.imagemagick_handler.convert_picture(img_path, target_path, resize_option, ''):
+            return False
+        return self.imagemagick_handler.clip_picture(target_path, target_path, width, height, begin_x, begin_y)
+
+    def convert(self, img_path, target_path, resize_option, img_quality):
+        return self.imagemagick_handler.convert_picture(img_path, target_path, resize_option, img_quality)
+
+    def probe(self, img_path):
+        picture_metadata = self.imagemagick_handler.identify_pictures([img_path]).get(img_path)
+        if picture_metadata is None or not picture_metadata['width'] or not picture_metadata['height']:
+            return None
+
+        img_width = picture_metadata['width']
+        img_height = picture_metadata['height']
+        if picture_metadata['orientation'] in (5, 6, 7, 8):
+            img_width, img_height = img_height, img_width
+        return img_width, img_height
+
+
+class ImageBackends:
+    # Each operation on each format goes to the backend the calibration measured fastest on this machine;
+    # a backend that cannot handle it, or fails, hands it on to the next one. Probing is not calibrated:
+    # the header parser answers in this process, and ImageMagick is only asked when nothing else can.
+    # Neither are the files the user saves: ImageMagick keeps their EXIF and colour profile, so it makes them
+    # whenever it can, whatever the timings say
+    operations_list = ['decode', 'thumbnail', 'crop', 'convert', 'probe']
+    calibrated_operations_list = ['decode', 'thumbnail']
+    export_operations_list = ['crop', 'convert']
+    backends_dict = None
+    routing_dict = None
+    backends_lock = Lock()
+
+    def __init__(self):
+        super(ImageBackends, self).__init__()
+
+    @classmethod
+    def get_backends(cls):
+        with cls.backends_lock:
+            if cls.backends_dict is None:
+                cls.backends_dict = {'qt': QtBackend(), 'imagemagick': ImageMagickBackend()}
+        return cls.backends_dict
+
+    @classmethod
+    def read_routing(cls):
+        with cls.backends_lock:
+            if cls.routing_dict is None:
+                # A routing measured with another Qt or ImageMagick is not used until it is measured again
+                image_backends = Commands().read_image_backends()
+                if image_backends.get('signature') == BackendCalibration.read_signature() \
+                        and isinstance(image_backends.get('routing'), dict):
+                    cls.routing_dict = image_backends['routing']
+                else:
+                    cls.routing_dict = dict()
+        return cls.routing_dict
+
+    @classmethod
+    def reset_routing(cls):
+        with cls.backends_lock:
+            cls.routing_dict = None
+
+    @staticmethod
+    def read_default_order(filetype, operation):
+        # Until the calibration has run, the formats ImageMagick has always handled stay with it
+        imagemagick_formats = [img_format.lower() for img_format in Commands.imagemagick_supported_formats()]
+        if operation in ImageBackends.export_operations_list:
+            return ['imagemagick', 'qt']
+        if operation != 'probe' and filetype in imagemagick_formats:
+            return ['imagemagick', 'qt']
+        return ['qt', 'imagemagick']
+
+    @classmethod
+    def read_backend_names(cls, filetype, operation):
+        backends_dict = cls.get_backends()
+        filetype = filetype.lower()
+
+        backend_names_list = list()
+        if operation in cls.calibrated_operations_list:
+            routed_name = cls.read_routing().get(filetype, dict()).get(operation)
+            if routed_name in backends_dict:
+                backend_names_list.append(routed_name)
+        for backend_name in cls.read_default_order(filetype, operation):
+            if backend_name not in backend_names_list:
+                backend_names_list.append(backend_name)
+
+        return [
+            backend_name for backend_name in backend_names_list
+            if backends_dict[backend_name].check_operation(filetype, operation)
+        ]
+
+    @classmethod
+    def read_backend_name(cls, filetype, operation):
+        backend_names_list = cls.read_backend_names(filetype, operation)
+        if not backend_names_list:
+            return str()
+        return backend_names_list[0]
+
+    @classmethod
+    def run(cls, operation, img_path, *args):
+        backend_names_list = cls.read_backend_names(Commands.get_filetype(img_path), operation)
+        return cls.run_backends(backend_names_list, operation, img_path, *args)
+
+    @classmethod
+    def run_backends(cls, backend_names_list, operation, img_path, *args):
+        # The thumbnail workers are handed the backend names with each job, so a routing measured after
+        # they were started still reaches them
+        backends_dict = cls.get_backends()
+        for backend_name in backend_names_list:
+            result = getattr(backends_dict[backend_name], operation)(img_path, *args)
+            if result is not None and result is not False:
+                return result
+        return None
+
+    @classmethod
+    def probe(cls, img_path):
+        img_size = cls.run('probe', img_path)
+        if img_size is None:
+            return 0, 0
+        return img_size
+
+
+class BackendCalibration:
+    # Every capable backend runs every operation on a generated sample of each format and the fastest
+    # is kept; the routing is measured again once Qt or ImageMagick has changed
+    sample_width = 2400
+    sample_height = 1600
+    calibration_runs = 2
+    sample_aliases_dict = {'.jpeg': '.jpg', '.tif': '.tiff'}
+    calibration_lock = Lock()
+
+    def __init__(self):
+        super(BackendCalibration, self).__init__()
+        self.commands = Commands()
+        self.calibration_folder_path = os.path.join(self.commands.read_temp_folder_path(), 'calibration')
+
+    @staticmethod
+    def read_signature():
+        imagemagick_program_status, imagemagick_program_path = \
+            ImageMagickHandler().check_imagemagick_available()
+        imagemagick_signature = str()
+        if imagemagick_program_status:
+            imagemagick_signature = f'{imagemagick_program_path}:{int(os.path.getmtime(imagemagick_program_path))}'
+
+        qt_formats_list = sorted(QtBackend.read_formats(QImageReader.supportedImageFormats()))
+        return f'{qVersion()}|{",".join(qt_formats_list)}|{imagemagick_signature}'
+
+    def start_calibrate(self):
+        if self.commands.read_image_backends().get('signature') == self.read_signature():
+            return
+
+        thread = Thread(target=self.calibrate)
+        thread.daemon = True
+        thread.start()
+
+    def calibrate(self):
+        with self.calibration_lock:
+            signature = self.read_signature()
+            sample_img = self.create_sample_image()
+
+            routing_dict = dict()
+            try:
+                os.makedirs(self.calibration_folder_path, exist_ok=True)
+                sample_filetypes_list = sorted(set(
+                    img_format.lower() for img_format in Commands.read_supported_formats()
+                    if img_format.lower() not in self.sample_aliases_dict
+                ))
+                for filetype in sample_filetypes_list:
+                    sample_path = self.create_sample(sample_img, filetype)
+                    if sample_path:
+                        routing_dict[filetype] = self.measure_format(sample_path, filetype)
+            except OSError:
+                return
+            finally:
+                shutil.rmtree(self.calibration_folder_path, ignore_errors=True)
+
+            for alias_filetype, filetype in self.sample_aliases_dict.items():
+                if filetype in routing_dict:
+                    routing_dict[alias_filetype] = routing_dict[filetype]
+
+            self.commands.save_image_backends({'signature': signature, 'routing': routing_dict})
+            ImageBackends.reset_routing()
+
+    def create_sample_image(self):
+        # Blocks of colour over a gradient give the encoders some detail to work on, like a photo would
+        sample_img = QImage(self.sample_width, self.sample_height, QImage.Format_RGB32)
+        painter = QPainter(sample_img)
+        gradient = QLinearGradient(0, 0, self.sample_width, self.sample_height)
+        gradient.setColorAt(0, QColor(40, 90, 160))
+        gradient.setColorAt(1, QColor(230, 180, 60))
+        painter.fillRect(sample_img.rect(), gradient)
+
+        randomizer = random.Random(0)
+        for _ in range(600):
+            painter.fillRect(
+                randomizer.randrange(self.sample_width), randomizer.randrange(self.sample_height),
+                randomizer.randrange(10, 300), randomizer.randrange(10, 300),
+                QColor(randomizer.randrange(256), randomizer.randrange(256), randomizer.randrange(256))
+            )
+        painter.end()
+        return sample_img
+
+    def create_sample(self, sample_img, filetype):
+        # Formats Qt cannot write are converted by ImageMagick; a format neither can write keeps the default routing
+        sample_path = os.path.join(self.calibration_folder_path, f'sample{filetype}')
+        if QtBackend.check_target(sample_path) and QtBackend.save_image(sample_img, sample_path, ''):
+            return sample_path
+
+        imagemagick_backend = ImageBackends.get_backends()['imagemagick']
+        if not imagemagick_backend.imagemagick_program_status:
+            return None
+
+        source_path = os.path.join(self.calibration_folder_path, 'source.png')
+        if not os.path.exists(source_path) and not sample_img.save(source_path, 'PNG'):
+            return None
+        imagemagick_backend.convert(source_path, sample_path, '', '')
+        if not os.path.exists(sample_path) or not os.path.getsize(sample_path):
+            return None
+        return sample_path
+
+    def measure_format(self, sample_path, filetype):
+        format_routing_dict = dict()
+        for operation in ImageBackends.calibrated_operations_list:
+            timings_dict = dict()
+            for backend_name, backend in ImageBackends.get_backends().items():
+                if not backend.check_operation(filetype, operation):
+                    continue
+                timing = self.measure(backend, operation, sample_path)
+                if timing is not None:
+                    timings_dict[backend_name] = timing
+
+            if timings_dict:
+                format_routing_dict[operation] = min(timings_dict, key=timings_dict.get)
+        return format_routing_dict
+
+    def measure(self, backend, operation, sample_path):
+        # The best of a few runs is kept, so a run slowed by other work does not decide the routing
+        target_root = os.path.join(self.calibration_folder_path, f'{backend.name}.{operation}')
+        if operation == 'thumbnail':
+            args = ([(f'{target_root}.500.jpg', 'x500'), (f'{target_root}.jpg', 'x250')],)
+        else:
+            args = ()
+
+        timings_list = list()
+        for _ in range(self.calibration_runs):
+            begin_time = time.perf_counter()
+            result = getattr(backend, operation)(sample_path, *args)
+            if result is None or result is False:
+                return None
+            timings_list.append(time.perf_counter() - begin_time)
+        return min(timings_list)
@@ -1,89 +1,147 @@
 import os
+import time
+import heapq
+import weakref
+import itertools
 from queue import Queue as queue_Queue
-from threading import Thread
-from multiprocessing import Process, Queue
+from threading import Thread, Lock, Condition
 
 from kshandler import Commands, ImageMagickHandler
 from ksscan import MultiprocessingFolderScan
+from ksdiff import PicturesDiff
+from kshash import FileHash
+from ksthumbnail import ThumbnailPool, ThumbnailTiers, DeferredThumbnails, CacheMigration
+from ksbackend import ImageBackends, QtBackend
+from kspack import ThumbnailPack
 
 
 class SiftChanges:
     def __init__(self):
         super(SiftChanges, self).__init__()
 
-    def start_read_database(
-            self, top_folder, pictures_data_dict, pictures_path_data,
-            database_list_signal, cache_folder_path, rebuild_cache_list_signal
-    ):
-        process = Process(
-            target=self.read_database, args=(
-                top_folder, pictures_data_dict, pictures_path_data,
-                database_list_signal, cache_folder_path, rebuild_cache_list_signal
-            )
+    def start_check_cache_folder(self, pictures_data_dict, cache_folder_path, rebuild_cache_list_signal):
+        thread = Thread(
+            target=self.check_cache_folder, args=(pictures_data_dict, cache_folder_path, rebuild_cache_list_signal)
         )
-        process.daemon = True
-        process.start()
+        thread.daemon = True
+        thread.start()
 
-    def start_check_non_existent_list(self, img_list, database_list, non_existent_list_signal):
-        process = Process(
-            target=self.check_non_existent_list, args=(img_list, database_list, non_existent_list_signal)
-        )
-        process.daemon = True
-        process.start()
+    @staticmethod
+    def read_known_folders(folder_path, pictures_signature_dict):
+        commands = Commands()
+        directories_mtime_dict, directories_files_number_dict, subdirectories_dict = \
+            commands.read_folder_directories_data(folder_path)
+
+        folders_signature_dict = dict()
+        for picture_path, picture_signature in pictures_signature_dict.items():
+            folders_signature_dict.setdefault(os.path.dirname(picture_path), dict())[picture_path] = picture_signature
+
+        # A folder is only skipped if the catalog holds a signature for every file seen in it last time
+        known_folders_dict = dict()
+        for directory_path, folder_mtime_ns in directories_mtime_dict.items():
+            folder_signature_dict = folders_signature_dict.get(directory_path, dict())
+            if not folder_mtime_ns or len(folder_signature_dict) != directories_files_number_dict[directory_path]:
+                continue
+            if None in folder_signature_dict.values():
+                continue
+
+            known_folders_dict[directory_path] = (
+                folder_mtime_ns, subdirectories_dict.get(directory_path, []), folder_signature_dict
+            )
 
-    def start_check_existent_list(self, img_list, database_list, existent_list_signal):
-        process = Process(
-            target=self.check_existent_list, args=(img_list, database_list, existent_list_signal)
-        )
-        process.daemon = True
-        process.start()
+        return known_folders_dict
 
-    def read_database(
-            self, top_folder, pictures_data_dict, pictures_path_data,
-            database_list_signal, cache_folder_path, rebuild_cache_list_signal
-    ):
-        database_list = list()
+    @staticmethod
+    def check_changes(scanned_files_stat_dict, pictures_signature_dict):
+        pictures_diff = PicturesDiff(pictures_signature_dict)
+        return pictures_diff.compare(scanned_files_stat_dict)
+
+    @staticmethod
+    def check_cache_folder(pictures_data_dict, cache_folder_path, rebuild_cache_list_signal):
+        # Each cache file is looked up on its own, so the check never lists the cache folder
+        rebuild_cache_list = list()
+        cache_file_exists_dict = dict.fromkeys(ThumbnailPack.get_pack().read_packed_names(), True)
 
-        for picture_path in pictures_path_data:
-            if top_folder in picture_path:
-                database_list.append(picture_path)
+        for picture_path, picture_cached_name in pictures_data_dict.items():
+            if not picture_cached_name:
+                rebuild_cache_list.append(picture_path)
+                continue
 
-        database_list_signal.put(database_list)
+            if picture_cached_name not in cache_file_exists_dict:
+                cache_file_exists_dict[picture_cached_name] = \
+                    os.path.exists(Commands.read_cache_path(cache_folder_path, picture_cached_name)) or \
+                    CacheMigration.migrate_cache_file(cache_folder_path, picture_cached_name)
 
-        self.check_cache_folder(pictures_data_dict, database_list, cache_folder_path, rebuild_cache_list_signal)
+            if not cache_file_exists_dict[picture_cached_name]:
+                rebuild_cache_list.append(picture_path)
 
-    @staticmethod
-    def check_non_existent_list(img_list, database_list, non_existent_list_signal):
-        non_existent_list = list()
-        for item in database_list:
-            if item not in img_list:
-                non_existent_list.append(item)
+        rebuild_cache_list_signal.put(rebuild_cache_list)
 
-        non_existent_list_signal.put(non_existent_list)
 
-    @staticmethod
-    def check_existent_list(img_list, database_list, existent_list_signal):
-        existent_list = list()
-        for item in img_list:
-            if item not in database_list:
-                existent_list.append(item)
+class PendingPictures:
+    # Queues that cache threads are taking pictures from, so the album can move what it shows to the front
+    pending_pictures_queues = weakref.WeakSet()
+    pending_pictures_lock = Lock()
 
-        existent_list_signal.put(existent_list)
+    def __init__(self):
+        super(PendingPictures, self).__init__()
+        self.pictures_heap = list()
+        self.pictures_order = itertools.count()
+        self.waiting_pictures_set = set()
+        self.finished = False
+        self.condition = Condition()
 
-    @staticmethod
-    def check_cache_folder(pictures_data_dict, database_list, cache_folder_path, rebuild_cache_list_signal):
-        rebuild_cache_list = list()
-        cache_file_name_list = list()
-        with os.scandir(cache_folder_path) as temp:
-            for item in temp:
-                cache_file_name = item.name
-                cache_file_name_list.append(cache_file_name)
-
-        for picture_path in database_list:
-            if pictures_data_dict[picture_path] not in cache_file_name_list:
-                rebuild_cache_list.append(picture_path)
+        with self.pending_pictures_lock:
+            self.pending_pictures_queues.add(self)
 
-        rebuild_cache_list_signal.put(rebuild_cache_list)
+    @staticmethod
+    def read_priority(creation_time):
+        # Newest first, as the album lists them; "2021-05-04 10:11:12" becomes -20210504101112
+        creation_digits = ''.join(c for c in str(creation_time) if c.isdigit())[:14]
+        if not creation_digits:
+            return 0
+        return -int(creation_digits.ljust(14, '0'))
+
+    def put(self, img_path, creation_time):
+        with self.condition:
+            self.waiting_pictures_set.add(img_path)
+            heapq.heappush(
+                self.pictures_heap, (1, self.read_priority(creation_time), next(self.pictures_order), img_path)
+            )
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while True:
+                while self.pictures_heap:
+                    _, _, _, img_path = heapq.heappop(self.pictures_heap)
+                    # A boosted picture is queued twice; whichever entry comes first takes it
+                    if img_path in self.waiting_pictures_set:
+                        self.waiting_pictures_set.discard(img_path)
+                        return img_path
+
+                if self.finished:
+                    return None
+
+                self.condition.wait()
+
+    def finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def boost(self, img_list):
+        with self.condition:
+            for img_path in img_list:
+                if img_path in self.waiting_pictures_set:
+                    heapq.heappush(self.pictures_heap, (0, 0, next(self.pictures_order), img_path))
+
+    @classmethod
+    def boost_pictures(cls, img_list):
+        with cls.pending_pictures_lock:
+            pending_pictures_list = list(cls.pending_pictures_queues)
+        for pending_pictures in pending_pictures_list:
+            pending_pictures.boost(img_list)
 
 
 class HandlePicturesChanges:
@@ -98,8 +156,23 @@ class HandlePicturesChanges:
         self.cached_img_list = list()
 
         self.existent_list_number = int()
+        self.moved_list_number = int()
         self.handle_list_number = int()
 
+        self.pending_pictures_signal = PendingPictures()
+        self.pending_pictures_set = set()
+        self.pictures_creation_time_dict = dict()
+        self.scanned_files_stat_dict = dict()
+        self.rebuild_cache_set = set()
+        self.modified_set = set()
+        self.pictures_md5_dict = dict()
+        self.walk_finished = False
+
+        # Folders reported by the watcher are read again even if their mtime has not changed;
+        # a forced rescan reads every folder, so pictures edited in place are found as well
+        self.changed_folders_set = set()
+        self.force_rescan = False
+
         self.threads_number = int(self.commands.read_cache_threads_number())
 
         self.resize_option = str()
@@ -108,10 +181,11 @@ class HandlePicturesChanges:
             self,
             folder_path, scanned_files_number_signal,
             cache_status_signal, pictures_changes_signal,
-            cached_progress_signal, cached_files_number_signal
+            cached_progress_signal, cached_files_number_signal, force_rescan=False
     ):
         resize_option = 'x250'
         self.resize_option = resize_option
+        self.force_rescan = force_rescan
 
         thread = Thread(
             target=self.scan_folder, args=(
@@ -130,109 +204,192 @@ class HandlePicturesChanges:
             cached_progress_signal, cached_files_number_signal
     ):
         filetypes = self.commands.read_supported_formats()
-        scan_result_signal = queue_Queue()
-
         multiprocessing_folder_scan = MultiprocessingFolderScan()
+
+        if cache_status_signal == '' and pictures_changes_signal == '' and cached_progress_signal == '' \
+                and cached_files_number_signal == '':
+            scan_result_signal = queue_Queue()
+            multiprocessing_folder_scan.prepare(
+                folder_path, filetypes, self.threads_number, scan_result_signal, '', ''
+            )
+            scanned_files_number_signal.put(scan_result_signal.get())
+            return
+
+        # The walk hands over batches of files while it is still running,
+        # so hashing and thumbnailing start on the first batch instead of after the whole folder
+        pictures_md5_dict, pictures_signature_dict = self.commands.read_folder_pictures_signature_data(folder_path)
+        self.pictures_md5_dict = pictures_md5_dict
+
+        # Full-quality thumbnails still owed from an earlier session
+        pictures_preview_data = self.commands.read_folder_preview_pictures_data(folder_path)
+        if pictures_preview_data:
+            deferred_thumbnails = DeferredThumbnails.get_deferred()
+            for picture_path, picture_cached_name in pictures_preview_data:
+                deferred_thumbnails.add(picture_path, picture_cached_name, self.resize_option)
+
+        sift_changes = SiftChanges()
+        if not self.force_rescan:
+            known_folders_dict = sift_changes.read_known_folders(folder_path, pictures_signature_dict)
+            for changed_folder in self.changed_folders_set:
+                known_folders_dict.pop(changed_folder, None)
+            multiprocessing_folder_scan.known_folders_dict = known_folders_dict
+
+        scan_batch_signal = queue_Queue()
         multiprocessing_folder_scan.prepare(
-            folder_path, filetypes, self.threads_number, scan_result_signal, ''
+            folder_path, filetypes, self.threads_number, '', '', scan_batch_signal
         )
 
-        database_list_signal = Queue()
-        rebuild_cache_list_signal = Queue()
-        pictures_path_data, _, _, pictures_cached_name_data = self.commands.read_pictures_data()
+        rebuild_cache_list_signal = queue_Queue()
+        pictures_path_data, _, pictures_creation_time_data, pictures_cached_name_data = \
+            self.commands.read_folder_pictures_data(folder_path)
 
         pictures_data_dict = dict(zip(pictures_path_data, pictures_cached_name_data))
+        self.pictures_creation_time_dict = dict(zip(pictures_path_data, pictures_creation_time_data))
 
-        sift_changes = SiftChanges()
-        sift_changes.start_read_database(
-            folder_path, pictures_data_dict, pictures_path_data,
-            database_list_signal, self.cache_folder_path, rebuild_cache_list_signal
-        )
+        # Evicted cache files are made again when their pictures are shown, not by scans
+        for picture_path in self.commands.read_folder_evicted_pictures(folder_path):
+            pictures_data_dict.pop(picture_path, None)
 
-        scan_result = scan_result_signal.get()
+        sift_changes.start_check_cache_folder(pictures_data_dict, self.cache_folder_path, rebuild_cache_list_signal)
 
-        if cache_status_signal == '' and pictures_changes_signal == '' and cached_progress_signal == '' \
-                and cached_files_number_signal == '':
-            scanned_files_number_signal.put(scan_result)
-            return
+        pictures_diff = PicturesDiff(pictures_signature_dict)
+        scanned_files_stat_dict = pictures_diff.scanned_signature_dict
+        self.scanned_files_stat_dict = scanned_files_stat_dict
 
-        scanned_files_list = scan_result[0]
-        scanned_files_number = scan_result[1]
+        while True:
+            scan_batch = scan_batch_signal.get()
+            if scan_batch == 'The folder has been scanned.':
+                break
+
+            pictures_diff.feed(scan_batch)
+            settled_list = pictures_diff.read_settled()
+            if settled_list:
+                if not self.handle_list_number:
+                    cache_status_signal.put('Need')
+                    self.initialize_threads(
+                        scanned_files_stat_dict,
+                        cached_progress_signal, cached_files_number_signal, pictures_changes_signal
+                    )
+                self.add_pending_pictures(settled_list, pictures_diff.modified_list)
 
-        scanned_files_number_signal.put(scanned_files_number)
+        scanned_files_number_signal.put(len(scanned_files_stat_dict))
+        self.commands.save_folder_directories(folder_path, multiprocessing_folder_scan.scanned_folders_dict)
+
+        pictures_diff = pictures_diff.finish()
+
+        non_existent_list = pictures_diff['removed']
+        existent_list = pictures_diff['added']
+        moved_list = pictures_diff['moved']
+
+        for picture_path, img_path in pictures_diff['move_candidates']:
+            # Candidates already share size and mtime; a stored fingerprint that differs rules one out
+            # without reading the whole file, and the full hash decides the rest
+            picture_fingerprint = self.commands.read_picture_fingerprint(picture_path)
+            if picture_fingerprint and self.commands.read_quick_fingerprint(img_path) != picture_fingerprint:
+                same_picture = False
+            else:
+                picture_md5 = pictures_md5_dict[picture_path]
+                img_md5 = self.commands.read_file_hash(img_path, FileHash.read_algorithm(picture_md5))
+                same_picture = img_md5 == picture_md5
+
+            if same_picture:
+                moved_list.append((picture_path, img_path))
+            else:
+                non_existent_list.append(picture_path)
+                existent_list.append(img_path)
 
-        database_list = database_list_signal.get()
-        non_existent_list_signal = Queue()
-        existent_list_signal = Queue()
-        sift_changes.start_check_non_existent_list(scanned_files_list, database_list, non_existent_list_signal)
-        sift_changes.start_check_existent_list(scanned_files_list, database_list, existent_list_signal)
+        # Moved records keep their md5, cached_name and creation_time; only the path and signature change
+        self.commands.move_picture_records(moved_list, scanned_files_stat_dict)
+        self.moved_list_number = len(moved_list)
+        for picture_path, img_path in moved_list:
+            pictures_md5_dict[img_path] = pictures_md5_dict.pop(picture_path)
 
-        non_existent_list = non_existent_list_signal.get()
-        existent_list = existent_list_signal.get()
-        rebuild_cache_list = rebuild_cache_list_signal.get()
+        modified_list = pictures_diff['modified']
+        self.save_signatures(pictures_diff['unsigned'], scanned_files_stat_dict)
 
-        if not non_existent_list and not existent_list and not rebuild_cache_list:
+        moved_paths_dict = dict(moved_list)
+        rebuild_cache_list = list()
+        for picture_path in rebuild_cache_list_signal.get():
+            if picture_path in scanned_files_stat_dict:
+                rebuild_cache_list.append(picture_path)
+            elif picture_path in moved_paths_dict:
+                rebuild_cache_list.append(moved_paths_dict[picture_path])
+
+        self.existent_list_number = len(existent_list)
+        self.non_existent_list = non_existent_list
+
+        if self.handle_list_number:
+            self.rebuild_cache_set.update(rebuild_cache_list)
+            self.add_pending_pictures(existent_list + rebuild_cache_list, modified_list)
+            self.finish_pending_pictures()
+        elif not non_existent_list and not existent_list and not rebuild_cache_list and not modified_list \
+                and not moved_list:
             cache_status_signal.put('None')
             pictures_changes_signal.put('No change')
-        elif non_existent_list and not existent_list and not rebuild_cache_list:
+            CacheEvictor().start_evict()
+        elif not existent_list and not rebuild_cache_list and not modified_list:
             cache_status_signal.put('None')
             self.existent_list_number = 0
-            self.non_existent_list = non_existent_list
             self.clean(pictures_changes_signal)
         else:
             cache_status_signal.put('Need')
-
-            self.existent_list_number = len(existent_list)
-            self.non_existent_list = non_existent_list
-
-            temp_list = existent_list + rebuild_cache_list
-            handle_list = list()
-            for item in temp_list:
-                if item not in handle_list:
-                    handle_list.append(item)
-
             self.initialize_threads(
-                handle_list, rebuild_cache_list,
+                scanned_files_stat_dict,
                 cached_progress_signal, cached_files_number_signal, pictures_changes_signal
             )
+            self.rebuild_cache_set.update(rebuild_cache_list)
+            self.add_pending_pictures(existent_list + rebuild_cache_list, modified_list)
+            self.finish_pending_pictures()
+
+    def save_signatures(self, img_list, scanned_files_stat_dict):
+        if not img_list:
+            return
+
+        self.commands.begin_pictures_batch()
+        for img_path in img_list:
+            self.commands.save_picture_signature(img_path, scanned_files_stat_dict[img_path])
+        self.commands.end_pictures_batch()
 
     def initialize_threads(
             self,
-            handle_list, rebuild_cache_list,
+            scanned_files_stat_dict,
             cached_progress_signal, cached_files_number_signal, pictures_changes_signal
     ):
-        self.handle_list_number = len(handle_list)
-
-        if self.handle_list_number < self.threads_number:
-            self.threads_number = self.handle_list_number
-
-        average_img_number = int(self.handle_list_number / self.threads_number)
-
-        pending_list = dict()
-
-        for n in range(self.threads_number):
-            start = n * average_img_number
-            stop = start + average_img_number
-
-            if n == self.threads_number - 1:
-                pending_list[n] = handle_list[start:]
-            else:
-                pending_list[n] = handle_list[start:stop]
-
+        # All cache threads take pictures from one shared queue, so none of them idles while others have work left
         thread = dict()
         for n in range(self.threads_number):
             thread[n] = Thread(
                 target=self.cache_thread, args=(
-                    pending_list[n], rebuild_cache_list,
+                    scanned_files_stat_dict,
                     cached_progress_signal, cached_files_number_signal, pictures_changes_signal
                 )
             )
             thread[n].daemon = True
             thread[n].start()
 
+    def add_pending_pictures(self, img_list, modified_list):
+        self.modified_set.update(modified_list)
+        for img_path in img_list:
+            if img_path in self.pending_pictures_set:
+                continue
+
+            creation_time = self.pictures_creation_time_dict.get(img_path)
+            if not creation_time and img_path in self.scanned_files_stat_dict:
+                # New pictures have not been identified yet, so their file time stands in for the creation time
+                img_mtime = self.scanned_files_stat_dict[img_path][1] / 1000000000
+                creation_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(img_mtime))
+
+            self.pending_pictures_set.add(img_path)
+            self.handle_list_number = self.handle_list_number + 1
+            self.pending_pictures_signal.put(img_path, creation_time)
+
+    def finish_pending_pictures(self):
+        self.walk_finished = True
+        self.pending_pictures_signal.finish()
+
     def cache_thread(
             self,
-            pending_list, rebuild_cache_list,
+            scanned_files_stat_dict,
             cached_progress_signal, cached_files_number_signal, pictures_changes_signal
     ):
         cachepictures_progress_signal = queue_Queue()
@@ -241,7 +398,8 @@ class HandlePicturesChanges:
         cachepictures_thread = CachePictures()
 
         cachepictures_thread.start_cache(
-            pending_list, self.resize_option, rebuild_cache_list,
+            iter(self.pending_pictures_signal.get, None), self.resize_option,
+            self.pictures_md5_dict, self.rebuild_cache_set, self.modified_set, scanned_files_stat_dict,
             cachepictures_progress_signal, cachepictures_result_signal
         )
 
@@ -259,6 +417,9 @@ class HandlePicturesChanges:
     def cache_progress(self, img_path, cached_progress_signal):
         self.handled_img_list.append(img_path)
         handled_percents = int((len(self.handled_img_list) / self.handle_list_number) * 100)
+        if not self.walk_finished:
+            # More pictures may still be found, so the progress never reaches 100 before the walk ends
+            handled_percents = min(handled_percents, 99)
 
         cached_progress_list = list()
         cached_progress_list.append(img_path)
@@ -283,24 +444,31 @@ class HandlePicturesChanges:
     def clean(self, pictures_changes_signal):
         moved_list = list()
         removed_list = list()
+        removed_cache_names_set = set()
+
+        self.commands.begin_pictures_batch()
         for item in self.non_existent_list:
             picture_cached_path = self.commands.read_picture_cached_path(item)
-            if not picture_cached_path:
+            if picture_cached_path:
+                removed_cache_names_set.add(os.path.basename(picture_cached_path))
+            elif not self.commands.read_picture_record(item):
                 moved_list.append(item)
-            else:
-                reserved_cache_files_list = self.commands.check_reserved_cache_files()
+                continue
+            removed_list.append(item)
 
-                if picture_cached_path not in reserved_cache_files_list:
-                    if os.path.exists(picture_cached_path):
-                        os.remove(picture_cached_path)
+            self.commands.remove_picture_record(item)
 
-                removed_list.append(item)
+        self.commands.end_pictures_batch()
 
-                self.commands.remove_picture_record(item)
+        # Once the records are gone, a cache file nothing refers to any more is removed
+        for picture_cached_name in removed_cache_names_set:
+            if not self.commands.check_cache_referenced(picture_cached_name):
+                ThumbnailTiers.remove_tiers(self.cache_folder_path, picture_cached_name)
 
         removed_number = len(removed_list)
         moved_number = len(moved_list)
         added_number = self.existent_list_number - moved_number
+        moved_number = moved_number + self.moved_list_number
 
         pictures_changes_list = list()
         pictures_changes_list.append(removed_number)
@@ -309,6 +477,8 @@ class HandlePicturesChanges:
 
         pictures_changes_signal.put(pictures_changes_list)
 
+        CacheEvictor().start_evict()
+
 
 class CachePictures:
     def __init__(self):
@@ -321,14 +491,29 @@ class CachePictures:
         self.temp_folder_path = self.commands.read_temp_folder_path()
         self.stop_caching_signal = os.path.join(self.temp_folder_path, 'stop_caching_signal')
 
+        self.thumbnail_pool = ThumbnailPool.get_pool(self.commands.read_cache_threads_number())
+        self.thumbnail_pack = ThumbnailPack.get_pack()
+        self.thumbnail_store = self.commands.read_thumbnail_store()
+        self.imagemagick_chunk_size = 16
+        self.identify_chunk_size = 50
+
+        self.resize_option = str()
+        self.rebuild_cache_list = set()
+        self.img_stat_dict = dict()
+        self.cachepictures_progress_signal = None
+
+        self.cached_img_list = list()
+        self.preview_cached_list = list()
+        self.imagemagick_pending_list = list()
+
     def start_cache(
             self,
-            img_list, resize_option, rebuild_cache_list,
+            img_list, resize_option, pictures_md5_dict, rebuild_cache_list, modified_list, img_stat_dict,
             cachepictures_progress_signal, cachepictures_result_signal
     ):
         thread = Thread(
             target=self.cache, args=(
-                img_list, resize_option, rebuild_cache_list,
+                img_list, resize_option, pictures_md5_dict, rebuild_cache_list, modified_list, img_stat_dict,
                 cachepictures_progress_signal, cachepictures_result_signal
             )
         )
@@ -337,64 +522,233 @@ class CachePictures:
 
     def cache(
             self,
-            img_list, resize_option, rebuild_cache_list,
+            img_list, resize_option, pictures_md5_dict, rebuild_cache_list, modified_list, img_stat_dict,
             cachepictures_progress_signal, cachepictures_result_signal):
-        updated_pictures_path_list = list()
-        updated_pictures_md5_list = list()
-        added_pictures_list = list()
-        cached_img_list = list()
+        self.resize_option = resize_option
+        self.rebuild_cache_list = rebuild_cache_list
+        self.img_stat_dict = img_stat_dict
+        self.cachepictures_progress_signal = cachepictures_progress_signal
 
-        pictures_path_data, pictures_md5_data, _, _ = self.commands.read_pictures_data()
+        self.cached_img_list = list()
+        self.preview_cached_list = list()
+        self.imagemagick_pending_list = list()
+        self.hash_algorithm = self.commands.read_hash_algorithm()
+        added_pending_list = list()
+
+        self.commands.begin_pictures_batch()
 
         for img_path in img_list:
             if os.path.exists(self.stop_caching_signal):
                 break
 
-            img_md5 = self.commands.read_md5(img_path)
-            img_file_type = self.commands.get_filetype(img_path)
-            imagemagick_supported_formats = self.commands.imagemagick_supported_formats()
-
-            if img_path in pictures_path_data and img_md5 not in pictures_md5_data:
-                # Need to update md5 and create cache
-                self.commands.save_picture_md5(img_path, img_md5)
-                updated_pictures_md5_list.append(img_path)
-                img_status = 'Need to create cache'
-
-            elif img_path not in pictures_path_data and img_md5 in pictures_md5_data:
-                img_status = 'Need to add path'
-                creation_time = self.imagemagick_handler.read_exif_creation_time(img_path)
-                self.commands.add_picture_record(img_path, img_md5, creation_time)
-                added_pictures_list.append(img_path)
-                img_status = 'Need to create cache'
-
-            elif img_path not in pictures_path_data and img_md5 not in pictures_md5_data:
-                # Need to add record and create cache
-                creation_time = self.imagemagick_handler.read_exif_creation_time(img_path)
-                self.commands.add_picture_record(img_path, img_md5, creation_time)
-                added_pictures_list.append(img_path)
-                img_status = 'Need to create cache'
+            if img_path in pictures_md5_dict and img_path not in modified_list:
+                # The stored signature still matches the file, so its stored md5 is reused without reading it
+                img_md5 = pictures_md5_dict[img_path]
+                img_status = 'No change'
 
-            else:
+            elif img_path in pictures_md5_dict:
+                # The signature has changed, so the whole file is hashed again; an edit that keeps the size
+                # can leave every fingerprint sample as it was.
+                # Stored hashes keep their algorithm, so an existing catalog is never hashed again
+                img_md5 = self.commands.read_file_hash(img_path, FileHash.read_algorithm(pictures_md5_dict[img_path]))
                 img_status = 'No change'
+                if img_md5 != pictures_md5_dict[img_path]:
+                    # Need to update md5 and create cache
+                    self.commands.save_picture_md5(img_path, img_md5)
+                    self.invalidate_picture_size(img_path)
+                    img_status = 'Need to create cache'
+                self.commands.save_picture_fingerprint(img_path, self.commands.read_quick_fingerprint(img_path))
 
-            img_cache_name = f'{img_md5}.jpg'
+            else:
+                # Need to add record and create cache; new pictures are identified in chunks by one identify run
+                img_md5 = self.commands.read_file_hash(img_path, self.hash_algorithm)
+                added_pending_list.append((img_path, img_md5))
+                if len(added_pending_list) >= self.identify_chunk_size:
+                    self.add_pictures(added_pending_list)
+                    added_pending_list = list()
+                continue
 
-            img_cache_path = os.path.join(self.cache_folder_path, img_cache_name)
+            self.cache_picture(img_path, img_md5, img_status)
 
-            if img_status != 'Need to create cache' and img_path in rebuild_cache_list:
-                img_status = 'Need to create cache'
+        if added_pending_list:
+            self.add_pictures(added_pending_list)
 
-            if img_status == 'Need to create cache':
-                if not os.path.exists(img_cache_path):
-                    img_cache_result = self.imagemagick_handler.convert_picture(
-                        img_path, img_cache_path, resize_option, ''
-                    )
-                    if img_cache_result:
-                        cached_img_list.append(img_path)
+        if self.imagemagick_pending_list:
+            self.convert_imagemagick_pictures(self.imagemagick_pending_list)
 
-                self.commands.save_picture_cached_path(img_path, img_cache_name)
+        self.commands.end_pictures_batch()
 
-            cachepictures_progress_signal.put(img_path)
+        if self.preview_cached_list:
+            deferred_thumbnails = DeferredThumbnails.get_deferred()
+            for img_path, img_cache_name in self.preview_cached_list:
+                deferred_thumbnails.add(img_path, img_cache_name, resize_option)
 
         cachepictures_progress_signal.put('The list has been handled.')
-        cachepictures_result_signal.put(cached_img_list)
+        cachepictures_result_signal.put(self.cached_img_list)
+
+    def add_pictures(self, added_pending_list):
+        pictures_metadata_dict = self.imagemagick_handler.read_pictures_metadata(
+            [img_path for img_path, _ in added_pending_list]
+        )
+        for img_path, img_md5 in added_pending_list:
+            picture_metadata = pictures_metadata_dict[img_path]
+            self.commands.add_picture_record(img_path, img_md5, picture_metadata['creation_time'])
+            self.save_picture_size(img_path, picture_metadata)
+            self.commands.save_picture_fingerprint(img_path, self.commands.read_quick_fingerprint(img_path))
+            self.cache_picture(img_path, img_md5, 'Need to create cache')
+
+    def save_picture_size(self, img_path, picture_metadata):
+        img_width = picture_metadata['width']
+        img_height = picture_metadata['height']
+        if picture_metadata['orientation'] in (5, 6, 7, 8):
+            img_width, img_height = img_height, img_width
+        if not img_width or not img_height:
+            # ImageMagick has already been asked above, so only the in-process probe is left to try
+            img_width, img_height = QtBackend.probe(img_path) or (0, 0)
+
+        if img_width and img_height:
+            self.commands.save_picture_size(img_path, img_width, img_height)
+
+    def invalidate_picture_size(self, img_path):
+        # The stored size belongs to the old content, so it is measured again and left unknown if that fails
+        self.commands.remove_picture_size(img_path)
+        img_width, img_height = ImageBackends.probe(img_path)
+        if img_width and img_height:
+            self.commands.save_picture_size(img_path, img_width, img_height)
+
+    def cache_picture(self, img_path, img_md5, img_status):
+        if img_path in self.img_stat_dict:
+            self.commands.save_picture_signature(img_path, self.img_stat_dict[img_path])
+
+        img_cache_name = f'{img_md5}.jpg'
+
+        img_cache_path = self.commands.make_cache_path(self.cache_folder_path, img_cache_name)
+
+        if img_status != 'Need to create cache' and img_path in self.rebuild_cache_list:
+            img_status = 'Need to create cache'
+
+        if img_status == 'Need to create cache':
+            if not os.path.exists(img_cache_path) and not self.check_packed(img_cache_name):
+                # An embedded EXIF preview gives a tile at once; the full-quality thumbnail follows later
+                if ThumbnailPool.create_preview_thumbnail(img_path, img_cache_path, self.resize_option):
+                    self.commands.save_picture_cache_preview(img_path, 1)
+                    self.preview_cached_list.append((img_path, img_cache_name))
+                    img_cache_result = True
+                elif ImageBackends.read_backend_name(
+                        self.commands.get_filetype(img_path), 'thumbnail') == 'imagemagick':
+                    # Pictures routed to ImageMagick are converted in chunks, and reported once their chunk is done
+                    self.commands.save_picture_cached_path(img_path, img_cache_name)
+                    tiers_list = ThumbnailTiers.read_tiers_list(
+                        img_path, img_cache_path, img_cache_path, self.resize_option)
+                    self.imagemagick_pending_list.append((img_path, tiers_list))
+                    if len(self.imagemagick_pending_list) >= self.imagemagick_chunk_size:
+                        self.convert_imagemagick_pictures(self.imagemagick_pending_list)
+                        self.imagemagick_pending_list = list()
+                    return
+                else:
+                    tiers_list = ThumbnailTiers.read_tiers_list(
+                        img_path, img_cache_path, img_cache_path, self.resize_option)
+                    img_cache_result = self.thumbnail_pool.convert_picture(img_path, tiers_list)
+                if img_cache_result:
+                    self.cached_img_list.append(img_path)
+                    self.pack_cache_file(img_cache_name, img_cache_path)
+
+            self.commands.save_picture_cached_path(img_path, img_cache_name)
+
+        self.cachepictures_progress_signal.put(img_path)
+
+    def convert_imagemagick_pictures(self, pictures_list):
+        converted_pictures_dict = self.imagemagick_handler.convert_pictures(pictures_list)
+        for img_path, tiers_list in pictures_list:
+            if converted_pictures_dict[img_path]:
+                self.cached_img_list.append(img_path)
+                img_cache_path = tiers_list[-1][0]
+                self.pack_cache_file(os.path.basename(img_cache_path), img_cache_path)
+            self.cachepictures_progress_signal.put(img_path)
+
+    def check_packed(self, img_cache_name):
+        if self.thumbnail_store != 'pack':
+            return False
+        return bool(self.thumbnail_pack.read_entries([img_cache_name]))
+
+    def pack_cache_file(self, img_cache_name, img_cache_path):
+        if self.thumbnail_store == 'pack':
+            self.thumbnail_pack.add(img_cache_name, img_cache_path)
+
+
+class CacheEvictor:
+    # One pass runs at a time; a pass asked for while another runs is left to that one
+    lock = Lock()
+    running = False
+
+    def __init__(self):
+        super(CacheEvictor, self).__init__()
+        self.commands = Commands()
+        self.cache_folder_path = self.commands.read_cache_folder_path()
+
+    def start_evict(self):
+        with CacheEvictor.lock:
+            if CacheEvictor.running:
+                return
+            CacheEvictor.running = True
+
+        thread = Thread(target=self.evict)
+        thread.daemon = True
+        thread.start()
+
+    def evict(self):
+        try:
+            cache_size_limit = self.commands.read_cache_size_limit() * 1048576
+            if cache_size_limit:
+                self.evict_cache_files(cache_size_limit)
+        finally:
+            with CacheEvictor.lock:
+                CacheEvictor.running = False
+
+    def read_cache_size(self):
+        cache_size = 0
+        for folder_path, _, file_names_list in os.walk(self.cache_folder_path):
+            for file_name in file_names_list:
+                try:
+                    cache_size = cache_size + os.stat(os.path.join(folder_path, file_name)).st_size
+                except OSError:
+                    continue
+        return cache_size
+
+    def evict_cache_files(self, cache_size_limit):
+        cache_size = self.read_cache_size()
+        if cache_size <= cache_size_limit:
+            return 0
+
+        # Eviction goes a tenth below the limit, so the next few thumbnails do not start another pass
+        target_cache_size = cache_size_limit * 0.9
+        evicted_names_list = list()
+        thumbnail_pack = ThumbnailPack.get_pack()
+        pack_entries_dict = self.commands.read_all_pack_entries()
+        evicted_pack_names_list = list()
+        for picture_cached_name in self.commands.read_cache_eviction_list():
+            if cache_size <= target_cache_size:
+                break
+
+            if picture_cached_name in pack_entries_dict:
+                evicted_pack_names_list.append(picture_cached_name)
+                cache_size = cache_size - pack_entries_dict[picture_cached_name][2]
+
+            picture_cached_path = self.commands.read_cache_path(self.cache_folder_path, picture_cached_name)
+            for tier_path in ThumbnailTiers.read_tier_paths(picture_cached_path):
+                try:
+                    tier_size = os.stat(tier_path).st_size
+                    os.remove(tier_path)
+                except OSError:
+                    continue
+                cache_size = cache_size - tier_size
+
+            evicted_names_list.append(picture_cached_name)
+
+        if evicted_pack_names_list:
+            # Packed thumbnails only give their space back once the pack files are compacted
+            thumbnail_pack.remove(evicted_pack_names_list)
+            thumbnail_pack.compact()
+
+        self.commands.save_evicted_cache_names(evicted_names_list)
+        return len(evicted_names_list)
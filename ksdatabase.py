@@ -1,6 +1,7 @@
 import os
 import sys
 import sqlite3
+import threading
 
 
 class BasicConfig:
@@ -34,20 +35,142 @@ class BasicConfig:
         return default_pictures_path
 
 
+class DatabaseConnections:
+    # One long-lived connection per process and thread, shared by every Database instance
+    local_connections = threading.local()
+    initialized_db_paths = set()
+    lock = threading.Lock()
+
+    @classmethod
+    def get_connection(cls, db_path):
+        connections = getattr(cls.local_connections, 'connections', None)
+        if connections is None or cls.local_connections.pid != os.getpid():
+            # Connections inherited through fork must not be reused by the child process
+            connections = dict()
+            cls.local_connections.connections = connections
+            cls.local_connections.pid = os.getpid()
+
+        db = connections.get(db_path)
+        if db is None:
+            db = sqlite3.connect(db_path, timeout=30)
+            cls.tune_connection(db)
+            connections[db_path] = db
+
+        return db
+
+    @staticmethod
+    def tune_connection(db):
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('PRAGMA temp_store = MEMORY')
+        db.execute('PRAGMA cache_size = -32000')
+        db.execute('PRAGMA mmap_size = 268435456')
+
+    @classmethod
+    def close_connection(cls, db_path):
+        connections = getattr(cls.local_connections, 'connections', None)
+        if connections and db_path in connections:
+            db = connections.pop(db_path)
+            db.commit()
+            db.close()
+
+
+class PicturesBatch:
+    # Queued rows are not seen by reads, on this connection or any other, until they are written:
+    # once batch_size rows are queued, flush_interval after the first of them even if the batch goes idle,
+    # or when the batch ends
+    def __init__(self, database, batch_size, flush_interval):
+        super(PicturesBatch, self).__init__()
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending_commands = list()
+        self.pending_lock = threading.Lock()
+        self.flush_timer = None
+
+    def add(self, db_command, parameters):
+        with self.pending_lock:
+            self.pending_commands.append((db_command, parameters))
+            if len(self.pending_commands) == 1:
+                self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+            full = len(self.pending_commands) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.pending_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.pending_commands:
+                return
+
+            # Consecutive rows sharing one statement go through executemany, so the queued order is kept
+            grouped_commands = list()
+            for db_command, parameters in self.pending_commands:
+                if grouped_commands and grouped_commands[-1][0] == db_command:
+                    grouped_commands[-1][1].append(parameters)
+                else:
+                    grouped_commands.append((db_command, [parameters]))
+
+            self.pending_commands = []
+
+            # The timer flushes from its own thread, so the rows go through that thread's connection
+            # and never through the cursor the database object is using
+            db = DatabaseConnections.get_connection(self.database.read_db_path())
+            db_cursor = db.cursor()
+            for db_command, parameters_list in grouped_commands:
+                db_cursor.executemany(db_command, parameters_list)
+            db.commit()
+            db_cursor.close()
+
+
 class Database:
     def __init__(self):
         super(Database, self).__init__()
 
         self.basicconfig = BasicConfig()
-        self.db = None
-        self.db_cursor = None
+        # A Commands object is often shared by several threads, so each thread keeps its own
+        # connection and cursor here instead of taking over another thread's
+        self.local_db = threading.local()
+        self.pictures_batch = None
 
         self.profile_folder_path = self.basicconfig.read_profile_folder_path()
         self.system_pictures_folder_path = self.basicconfig.read_system_pictures_folder_path()
 
         self.initialize_db()
 
+    @property
+    def db(self):
+        return getattr(self.local_db, 'db', None)
+
+    @db.setter
+    def db(self, db):
+        self.local_db.db = db
+
+    @property
+    def db_cursor(self):
+        return getattr(self.local_db, 'db_cursor', None)
+
+    @db_cursor.setter
+    def db_cursor(self, db_cursor):
+        self.local_db.db_cursor = db_cursor
+
     def initialize_db(self):
+        # The path is only marked once the schema is committed, and other openers wait until then,
+        # so none of them queries a table that is still being made
+        db_path = self.read_db_path()
+        with DatabaseConnections.lock:
+            if db_path in DatabaseConnections.initialized_db_paths:
+                return
+            self.create_schema()
+            DatabaseConnections.initialized_db_paths.add(db_path)
+
+    def create_schema(self):
         self.open_db()
 
         self.db_cursor.execute(
@@ -57,25 +180,109 @@ class Database:
         self.initialize_setting('latest_geometry', '')
         self.initialize_setting('zoomed_size', '')
         self.initialize_setting('cache_threads_number', '')
+        self.initialize_setting('watch_pictures_folder', 'off')
+        self.initialize_setting('hash_algorithm', 'md5')
+        self.initialize_setting('cache_size_limit', '0')
+        self.initialize_setting('thumbnail_store', 'files')
+        self.initialize_setting('image_backends', '')
+
+        self.create_pictures_table()
+        self.create_directories_table()
+        self.create_thumbnails_pack_table()
 
+        # self.add_column_if_notfound('pictures', 'cached_path')
+
+        self.close_db()
+
+    def create_pictures_table(self):
         self.db_cursor.execute(
             'CREATE TABLE IF NOT EXISTS pictures'
             '(id INTEGER PRIMARY KEY AUTOINCREMENT,'
-            'picture_path UNIQUE, picture_md5, creation_time, cached_name)'
+            'picture_path UNIQUE, picture_md5, creation_time, cached_name, picture_folder,'
+            'file_size, file_mtime_ns, file_inode, file_device, cache_preview, file_fingerprint,'
+            'picture_width, picture_height, cache_access_time, cache_evicted)'
         )
 
-        # self.add_column_if_notfound('pictures', 'cached_path')
+        if self.add_column_if_notfound('pictures', 'picture_folder'):
+            self.fill_pictures_folder_column()
 
-        self.close_db()
+        # Rows indexed before these columns existed keep NULL until the next scan stores their signature
+        for column in ['file_size', 'file_mtime_ns', 'file_inode', 'file_device']:
+            self.add_column_if_notfound('pictures', column)
 
-    def open_db(self):
+        # cache_preview is 1 while the cache file is still made from the picture's embedded EXIF preview
+        self.add_column_if_notfound('pictures', 'cache_preview')
+
+        # file_fingerprint is a quick hash of the size and a few samples, so a touched file is not read whole
+        self.add_column_if_notfound('pictures', 'file_fingerprint')
+
+        # The upright size lets the album lay out pictures whose cache file does not exist yet
+        for column in ['picture_width', 'picture_height']:
+            self.add_column_if_notfound('pictures', column)
+
+        # The cache is kept under its size limit by removing the files shown least recently;
+        # cache_evicted is 1 once they are removed, so scans leave them to be made again when shown
+        for column in ['cache_access_time', 'cache_evicted']:
+            self.add_column_if_notfound('pictures', column)
+
+        self.db_cursor.execute('CREATE INDEX IF NOT EXISTS pictures_folder_index ON pictures (picture_folder)')
+        self.db_cursor.execute('CREATE INDEX IF NOT EXISTS pictures_md5_index ON pictures (picture_md5)')
+        self.db_cursor.execute('CREATE INDEX IF NOT EXISTS pictures_cached_name_index ON pictures (cached_name)')
+        self.db_cursor.execute('CREATE INDEX IF NOT EXISTS pictures_creation_time_index ON pictures (creation_time)')
+
+    def create_directories_table(self):
+        # One row per scanned folder, so folders whose mtime has not changed can be taken from the catalog
+        self.db_cursor.execute(
+            'CREATE TABLE IF NOT EXISTS directories'
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, folder_path UNIQUE, parent_folder, folder_mtime_ns, files_number)'
+        )
+
+    def create_thumbnails_pack_table(self):
+        # Where each packed thumbnail is kept: its pack file's number, offset and length
+        self.db_cursor.execute(
+            'CREATE TABLE IF NOT EXISTS thumbnails_pack'
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, cached_name UNIQUE, pack_number, pack_offset, pack_length)'
+        )
+
+    def fill_pictures_folder_column(self):
+        self.db_cursor.execute('SELECT picture_path FROM pictures WHERE picture_folder IS NULL')
+        pictures_path_data = self.db_cursor.fetchall()
+
+        pictures_folder_data = list()
+        for (picture_path,) in pictures_path_data:
+            pictures_folder_data.append((os.path.dirname(picture_path), picture_path))
+
+        self.db_cursor.executemany(
+            'UPDATE pictures SET picture_folder = ? WHERE picture_path = ?', pictures_folder_data
+        )
+
+    @staticmethod
+    def read_folder_range(folder_path):
+        # Every path below folder_path sorts between "folder_path/" and "folder_path0",
+        # which lets SQLite walk the picture_folder index instead of scanning the table
+        folder_path = os.path.normpath(folder_path)
+        if folder_path.endswith(os.sep):
+            folder_prefix = folder_path
+        else:
+            folder_prefix = f'{folder_path}{os.sep}'
+        folder_upper_bound = f'{folder_prefix[:-1]}{chr(ord(os.sep) + 1)}'
+        return folder_path, folder_prefix, folder_upper_bound
+
+    def read_db_path(self):
         db_path = os.path.join(self.profile_folder_path, 'ksdata.db')
-        self.db = sqlite3.connect(db_path)
+        return db_path
+
+    def open_db(self):
+        self.db = DatabaseConnections.get_connection(self.read_db_path())
         self.db_cursor = self.db.cursor()
 
     def close_db(self):
+        # The connection stays open for the next call; only the transaction ends here
         self.db.commit()
-        self.db.close()
+        self.db_cursor.close()
+
+    def disconnect_db(self):
+        DatabaseConnections.close_connection(self.read_db_path())
 
     def initialize_setting(self, item, value):
         self.db_cursor.execute('SELECT item FROM settings')
@@ -91,9 +298,11 @@ class Database:
 
     def add_column_if_notfound(self, table, column):
         try:
-            self.db_cursor.execute(f'SELECT {column} FROM {table}')
+            self.db_cursor.execute(f'SELECT {column} FROM {table} LIMIT 1')
         except sqlite3.OperationalError:
             self.db_cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+            return True
+        return False
 
     def read_setting(self, item):
         self.open_db()
@@ -112,11 +321,7 @@ class Database:
     def reset_pictures_table(self):
         self.open_db()
         self.db_cursor.execute(f'DROP TABLE pictures')
-        self.db_cursor.execute(
-            'CREATE TABLE IF NOT EXISTS pictures'
-            '(id INTEGER PRIMARY KEY AUTOINCREMENT,'
-            'picture_path UNIQUE, picture_md5, creation_time, cached_name)'
-        )
+        self.create_pictures_table()
         self.close_db()
 
     def read_pictures_data(self):
@@ -135,6 +340,112 @@ class Database:
         self.close_db()
         return pictures_data
 
+    def read_folder_pictures_data(self, folder_path):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        db_command = 'SELECT * FROM pictures ' \
+                     'WHERE picture_folder = ? OR (picture_folder >= ? AND picture_folder < ?) ' \
+                     'ORDER BY creation_time DESC'
+        self.db_cursor.execute(db_command, (folder_path, folder_prefix, folder_upper_bound))
+        pictures_data = self.db_cursor.fetchall()
+        self.close_db()
+        return pictures_data
+
+    def read_folder_pictures_size_data(self, folder_path):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        db_command = 'SELECT picture_path, picture_width, picture_height FROM pictures ' \
+                     'WHERE picture_folder = ? OR (picture_folder >= ? AND picture_folder < ?)'
+        self.db_cursor.execute(db_command, (folder_path, folder_prefix, folder_upper_bound))
+        pictures_size_data = self.db_cursor.fetchall()
+        self.close_db()
+        return pictures_size_data
+
+    def read_folder_pictures_signature_data(self, folder_path):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        db_command = 'SELECT picture_path, picture_md5, file_size, file_mtime_ns, file_inode, file_device ' \
+                     'FROM pictures ' \
+                     'WHERE picture_folder = ? OR (picture_folder >= ? AND picture_folder < ?)'
+        self.db_cursor.execute(db_command, (folder_path, folder_prefix, folder_upper_bound))
+        pictures_signature_data = self.db_cursor.fetchall()
+        self.close_db()
+        return pictures_signature_data
+
+    def read_folder_preview_pictures_data(self, folder_path):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        db_command = 'SELECT picture_path, cached_name FROM pictures ' \
+                     'WHERE (picture_folder = ? OR (picture_folder >= ? AND picture_folder < ?)) ' \
+                     'AND cache_preview = 1'
+        self.db_cursor.execute(db_command, (folder_path, folder_prefix, folder_upper_bound))
+        pictures_preview_data = self.db_cursor.fetchall()
+        self.close_db()
+        return pictures_preview_data
+
+    def read_folder_evicted_pictures_data(self, folder_path):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        db_command = 'SELECT picture_path FROM pictures ' \
+                     'WHERE (picture_folder = ? OR (picture_folder >= ? AND picture_folder < ?)) ' \
+                     'AND cache_evicted = 1'
+        self.db_cursor.execute(db_command, (folder_path, folder_prefix, folder_upper_bound))
+        pictures_evicted_data = self.db_cursor.fetchall()
+        self.close_db()
+        return pictures_evicted_data
+
+    def read_cache_eviction_data(self):
+        # Cache files never shown come first, the oldest records among them first
+        self.open_db()
+        db_command = 'SELECT cached_name FROM pictures ' \
+                     "WHERE cached_name IS NOT NULL AND cached_name != '' AND cache_evicted IS NOT 1 " \
+                     'GROUP BY cached_name ORDER BY MAX(IFNULL(cache_access_time, 0)), MIN(id)'
+        self.db_cursor.execute(db_command)
+        cache_eviction_data = self.db_cursor.fetchall()
+        self.close_db()
+        return cache_eviction_data
+
+    def pictures_update_access_time(self, cached_names_list, access_time):
+        self.open_db()
+        self.db_cursor.executemany(
+            'UPDATE pictures SET cache_access_time = ? WHERE cached_name = ?',
+            [(access_time, cached_name) for cached_name in cached_names_list]
+        )
+        self.close_db()
+
+    def pictures_update_evicted(self, cached_names_list):
+        # An evicted preview is not owed a full-quality thumbnail any more
+        self.open_db()
+        self.db_cursor.executemany(
+            'UPDATE pictures SET cache_evicted = 1, cache_preview = 0 WHERE cached_name = ?',
+            [(cached_name,) for cached_name in cached_names_list]
+        )
+        self.close_db()
+
+    def pictures_read_duplicate_records(self):
+        self.open_db()
+        db_command = 'SELECT * FROM pictures WHERE id NOT IN (SELECT MIN(id) FROM pictures GROUP BY picture_path)'
+        self.db_cursor.execute(db_command)
+        pictures_data = self.db_cursor.fetchall()
+        self.close_db()
+        return pictures_data
+
+    def pictures_delete_outside_folder(self, folder_path):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        db_command = 'DELETE FROM pictures ' \
+                     'WHERE NOT (picture_folder = ? OR (picture_folder >= ? AND picture_folder < ?))'
+        self.db_cursor.execute(db_command, (folder_path, folder_prefix, folder_upper_bound))
+        removed_records_number = self.db_cursor.rowcount
+        self.close_db()
+        return removed_records_number
+
     def pictures_read_record(self, query_column, query_column_value):
         self.open_db()
         db_command = f'SELECT * FROM pictures WHERE {query_column} = ?'
@@ -143,24 +454,148 @@ class Database:
         self.close_db()
         return picture_record
 
+    def begin_pictures_batch(self, batch_size=500, flush_interval=0.5):
+        if self.pictures_batch is None:
+            self.pictures_batch = PicturesBatch(self, batch_size, flush_interval)
+
+    def flush_pictures_batch(self):
+        if self.pictures_batch is not None:
+            self.pictures_batch.flush()
+
+    def end_pictures_batch(self):
+        if self.pictures_batch is not None:
+            self.pictures_batch.flush()
+            self.pictures_batch = None
+
+    def pictures_write_record(self, db_command, parameters):
+        if self.pictures_batch is not None:
+            self.pictures_batch.add(db_command, parameters)
+        else:
+            self.open_db()
+            self.db_cursor.execute(db_command, parameters)
+            self.close_db()
+
     def pictures_insert_record(self, picture_path, picture_md5, creation_time):
+        db_command = 'INSERT OR REPLACE INTO pictures (picture_path, picture_md5, creation_time, picture_folder) ' \
+                     'VALUES (?, ?, ?, ?)'
+        self.pictures_write_record(
+            db_command, (picture_path, picture_md5, creation_time, os.path.dirname(picture_path))
+        )
+
+    def pictures_update_signature(self, picture_path, file_size, file_mtime_ns, file_inode, file_device):
+        db_command = 'UPDATE pictures SET file_size = ?, file_mtime_ns = ?, file_inode = ?, file_device = ? ' \
+                     'WHERE picture_path = ?'
+        self.pictures_write_record(db_command, (file_size, file_mtime_ns, file_inode, file_device, picture_path))
+
+    def pictures_update_size(self, picture_path, picture_width, picture_height):
+        db_command = 'UPDATE pictures SET picture_width = ?, picture_height = ? WHERE picture_path = ?'
+        self.pictures_write_record(db_command, (picture_width, picture_height, picture_path))
+
+    def pictures_move_records(self, moved_records_list):
+        # moved_records_list holds (old_path, new_path, file_size, file_mtime_ns, file_inode, file_device);
+        # old paths are parked under a NUL prefix first so swaps and chains never collide on the unique index
         self.open_db()
-        db_command = 'INSERT OR REPLACE INTO pictures (picture_path, picture_md5, creation_time) VALUES (?, ?, ?)'
-        self.db_cursor.execute(
-            db_command, (picture_path, picture_md5, creation_time)
+        self.db_cursor.executemany(
+            'UPDATE pictures SET picture_path = ? WHERE picture_path = ?',
+            [(f'\0{record[0]}', record[0]) for record in moved_records_list]
+        )
+        self.db_cursor.executemany(
+            'UPDATE pictures SET picture_path = ?, picture_folder = ?, '
+            'file_size = ?, file_mtime_ns = ?, file_inode = ?, file_device = ? WHERE picture_path = ?',
+            [
+                (record[1], os.path.dirname(record[1]), record[2], record[3], record[4], record[5], f'\0{record[0]}')
+                for record in moved_records_list
+            ]
         )
         self.close_db()
 
-    def pictures_update_record(self, query_column, query_column_value, target_column, target_column_value):
+    def pictures_count_cached_name(self, cached_name):
         self.open_db()
-        db_command = f'UPDATE pictures SET {target_column} = ? WHERE {query_column} = ?'
-        self.db_cursor.execute(db_command, (target_column_value, query_column_value))
+        self.db_cursor.execute('SELECT COUNT(*) FROM pictures WHERE cached_name = ?', (cached_name,))
+        cached_name_count = self.db_cursor.fetchone()[0]
         self.close_db()
+        return cached_name_count
 
-    def pictures_delete_record(self, query_column, query_column_value):
+    def pictures_read_fingerprint(self, picture_path):
         self.open_db()
+        self.db_cursor.execute('SELECT file_fingerprint FROM pictures WHERE picture_path = ?', (picture_path,))
+        picture_fingerprint = self.db_cursor.fetchone()
+        self.close_db()
+
+        if picture_fingerprint is None:
+            return None
+        return picture_fingerprint[0]
+
+    def pictures_update_record(self, query_column, query_column_value, target_column, target_column_value):
+        db_command = f'UPDATE pictures SET {target_column} = ? WHERE {query_column} = ?'
+        self.pictures_write_record(db_command, (target_column_value, query_column_value))
+
+    def pictures_delete_record(self, query_column, query_column_value):
         db_command = f'DELETE FROM pictures WHERE {query_column} = ?'
-        self.db_cursor.execute(db_command, (query_column_value,))
+        self.pictures_write_record(db_command, (query_column_value,))
+
+    def read_folder_directories_data(self, folder_path):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        db_command = 'SELECT folder_path, parent_folder, folder_mtime_ns, files_number FROM directories ' \
+                     'WHERE folder_path = ? OR (folder_path >= ? AND folder_path < ?)'
+        self.db_cursor.execute(db_command, (folder_path, folder_prefix, folder_upper_bound))
+        directories_data = self.db_cursor.fetchall()
+        self.close_db()
+        return directories_data
+
+    def directories_replace_records(self, folder_path, directories_data):
+        folder_path, folder_prefix, folder_upper_bound = self.read_folder_range(folder_path)
+
+        self.open_db()
+        self.db_cursor.execute(
+            'DELETE FROM directories WHERE folder_path = ? OR (folder_path >= ? AND folder_path < ?)',
+            (folder_path, folder_prefix, folder_upper_bound)
+        )
+        self.db_cursor.executemany(
+            'INSERT INTO directories (folder_path, parent_folder, folder_mtime_ns, files_number) VALUES (?, ?, ?, ?)',
+            directories_data
+        )
+        self.close_db()
+
+    def read_pack_entries_data(self, cached_names_list):
+        pack_entries_data = list()
+
+        self.open_db()
+        # Names are asked for in slices, below SQLite's limit on parameters
+        for n in range(0, len(cached_names_list), 500):
+            cached_names_slice = cached_names_list[n:n + 500]
+            db_command = 'SELECT cached_name, pack_number, pack_offset, pack_length FROM thumbnails_pack ' \
+                         f'WHERE cached_name IN ({", ".join("?" * len(cached_names_slice))})'
+            self.db_cursor.execute(db_command, cached_names_slice)
+            pack_entries_data.extend(self.db_cursor.fetchall())
+        self.close_db()
+        return pack_entries_data
+
+    def read_all_pack_entries_data(self):
+        self.open_db()
+        db_command = 'SELECT cached_name, pack_number, pack_offset, pack_length FROM thumbnails_pack ' \
+                     'ORDER BY pack_number, pack_offset'
+        self.db_cursor.execute(db_command)
+        pack_entries_data = self.db_cursor.fetchall()
+        self.close_db()
+        return pack_entries_data
+
+    def pack_replace_entries(self, pack_entries_list):
+        self.open_db()
+        self.db_cursor.executemany(
+            'INSERT OR REPLACE INTO thumbnails_pack (cached_name, pack_number, pack_offset, pack_length) '
+            'VALUES (?, ?, ?, ?)',
+            pack_entries_list
+        )
+        self.close_db()
+
+    def pack_delete_entries(self, cached_names_list):
+        self.open_db()
+        self.db_cursor.executemany(
+            'DELETE FROM thumbnails_pack WHERE cached_name = ?', [(cached_name,) for cached_name in cached_names_list]
+        )
         self.close_db()
 
     def database_vacuum(self):
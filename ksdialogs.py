@@ -1,10 +1,11 @@
 import os
 from PySide6.QtCore import Signal, Qt
-from PySide6.QtGui import QIcon, QPixmap
+from PySide6.QtGui import QIcon
 from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QRadioButton, QTableWidget, QLabel, QLineEdit,
                                QPushButton, QComboBox, QSlider, QApplication, QListWidget, QListWidgetItem)
 
 from kshandler import Commands
+from ksbackend import ImageBackends
 
 
 class MessageDialog(QDialog):
@@ -455,10 +456,8 @@ class MakePDFDialog(QDialog):
         self.dialog_exit_button.clicked.connect(self.close_dialog)
 
     def add_picture(self, img_path):
-        image = QPixmap(img_path)
-
-        img_width = image.width()
-        img_height = image.height()
+        # The picture is turned upright when it is put on the page, so its size is taken after the orientation
+        img_width, img_height = ImageBackends.probe(img_path)
         img_resolution = f'{img_width}x{img_height}'
         img_with_resolution = (img_path, img_resolution)
 
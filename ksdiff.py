@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+
+
+class PicturesDiff:
+    def __init__(self, pictures_signature_dict):
+        super(PicturesDiff, self).__init__()
+        # pictures_signature_dict maps each catalog path to its (size, mtime_ns, inode, device) or None
+        self.pictures_signature_dict = pictures_signature_dict
+
+        self.scanned_paths_set = set()
+        self.scanned_signature_dict = dict()
+
+        self.added_list = list()
+        self.modified_list = list()
+        self.unsigned_list = list()
+        self.unchanged_list = list()
+        self.settled_list = list()
+
+        self.pictures_size_mtime_dict = dict()
+        for picture_path, picture_signature in pictures_signature_dict.items():
+            if picture_signature is not None:
+                self.pictures_size_mtime_dict.setdefault(picture_signature[:2], []).append(picture_path)
+
+    def feed(self, scanned_files_stat_dict):
+        for img_path, img_signature in scanned_files_stat_dict.items():
+            if img_path in self.scanned_paths_set:
+                continue
+
+            self.scanned_paths_set.add(img_path)
+            self.scanned_signature_dict[img_path] = img_signature
+
+            if img_path not in self.pictures_signature_dict:
+                self.added_list.append(img_path)
+                if not self.could_be_moved(img_signature):
+                    self.settled_list.append(img_path)
+                continue
+
+            picture_signature = self.pictures_signature_dict[img_path]
+            if picture_signature is None:
+                self.unsigned_list.append(img_path)
+            elif picture_signature != img_signature:
+                self.modified_list.append(img_path)
+                self.settled_list.append(img_path)
+            else:
+                self.unchanged_list.append(img_path)
+
+    def could_be_moved(self, img_signature):
+        # Only a record that has not been seen in the walk yet can still turn out to be removed,
+        # and a move needs at least the same size and mtime as that record
+        candidates = self.pictures_size_mtime_dict.get(img_signature[:2])
+        if not candidates:
+            return False
+
+        for picture_path in candidates:
+            if picture_path not in self.scanned_paths_set:
+                return True
+        return False
+
+    def read_settled(self):
+        # Added and modified files that are certain not to be moves can be handled before the walk ends
+        settled_list = self.settled_list
+        self.settled_list = list()
+        return settled_list
+
+    def finish(self):
+        removed_list = list()
+        for picture_path in self.pictures_signature_dict:
+            if picture_path not in self.scanned_paths_set:
+                removed_list.append(picture_path)
+
+        added_list, removed_list, moved_list = self.match_moved(self.added_list, removed_list)
+        added_list, removed_list, move_candidates_list = self.match_move_candidates(added_list, removed_list)
+
+        pictures_diff = dict()
+        pictures_diff['added'] = added_list
+        pictures_diff['removed'] = removed_list
+        pictures_diff['modified'] = self.modified_list
+        pictures_diff['moved'] = moved_list
+        pictures_diff['move_candidates'] = move_candidates_list
+        pictures_diff['unsigned'] = self.unsigned_list
+        pictures_diff['unchanged'] = self.unchanged_list
+        return pictures_diff
+
+    def compare(self, scanned_files_stat_dict):
+        self.feed(scanned_files_stat_dict)
+        return self.finish()
+
+    def match_moved(self, added_list, removed_list):
+        # A removed record and an added file with the same full signature are the same file under a new path
+        removed_signature_dict = dict()
+        for picture_path in removed_list:
+            picture_signature = self.pictures_signature_dict[picture_path]
+            if picture_signature is not None and picture_signature[2]:
+                removed_signature_dict.setdefault(picture_signature, []).append(picture_path)
+
+        if not removed_signature_dict:
+            return added_list, removed_list, []
+
+        moved_list = list()
+        moved_paths_set = set()
+        remaining_added_list = list()
+        for img_path in added_list:
+            candidates = removed_signature_dict.get(self.scanned_signature_dict[img_path])
+            if candidates:
+                picture_path = candidates.pop()
+                moved_list.append((picture_path, img_path))
+                moved_paths_set.add(picture_path)
+            else:
+                remaining_added_list.append(img_path)
+
+        remaining_removed_list = list()
+        for picture_path in removed_list:
+            if picture_path not in moved_paths_set:
+                remaining_removed_list.append(picture_path)
+
+        return remaining_added_list, remaining_removed_list, moved_list
+
+    def match_move_candidates(self, added_list, removed_list):
+        # Copies across devices get a new inode but usually keep size and mtime;
+        # such pairs are only candidates until their content hash is compared
+        removed_size_mtime_dict = dict()
+        for picture_path in removed_list:
+            picture_signature = self.pictures_signature_dict[picture_path]
+            if picture_signature is not None:
+                removed_size_mtime_dict.setdefault(picture_signature[:2], []).append(picture_path)
+
+        if not removed_size_mtime_dict:
+            return added_list, removed_list, []
+
+        move_candidates_list = list()
+        candidate_paths_set = set()
+        remaining_added_list = list()
+        for img_path in added_list:
+            candidates = removed_size_mtime_dict.get(self.scanned_signature_dict[img_path][:2])
+            if candidates:
+                picture_path = self.choose_move_candidate(candidates, img_path)
+                candidates.remove(picture_path)
+                move_candidates_list.append((picture_path, img_path))
+                candidate_paths_set.add(picture_path)
+            else:
+                remaining_added_list.append(img_path)
+
+        remaining_removed_list = list()
+        for picture_path in removed_list:
+            if picture_path not in candidate_paths_set:
+                remaining_removed_list.append(picture_path)
+
+        return remaining_added_list, remaining_removed_list, move_candidates_list
+
+    @staticmethod
+    def choose_move_candidate(candidates, img_path):
+        # A pair is only kept if the content hashes agree, so a copy that kept its file name is paired first
+        img_name = os.path.basename(img_path)
+        for picture_path in reversed(candidates):
+            if os.path.basename(picture_path) == img_name:
+                return picture_path
+        return candidates[-1]
+
+
+def benchmark(paths_number):
+    changed_number = max(paths_number // 100, 1)
+
+    pictures_signature_dict = dict()
+    for n in range(paths_number):
+        pictures_signature_dict[os.path.join('Pictures', str(n % 97), f'{n}.jpg')] = (n, n, n + 1, 1)
+
+    scanned_files_stat_dict = dict(pictures_signature_dict)
+    for n in range(changed_number):
+        # Removed, added, modified and moved files, one percent each
+        del scanned_files_stat_dict[os.path.join('Pictures', str(n % 97), f'{n}.jpg')]
+        scanned_files_stat_dict[os.path.join('Pictures', 'new', f'{n}.jpg')] = (
+            paths_number + n, n, paths_number + n + 1, 1
+        )
+        m = changed_number + n
+        scanned_files_stat_dict[os.path.join('Pictures', str(m % 97), f'{m}.jpg')] = (m + 1, m, m + 1, 1)
+        k = 2 * changed_number + n
+        del scanned_files_stat_dict[os.path.join('Pictures', str(k % 97), f'{k}.jpg')]
+        scanned_files_stat_dict[os.path.join('Pictures', 'moved', f'{k}.jpg')] = (k, k, k + 1, 1)
+
+    start_time = time.perf_counter()
+    pictures_diff = PicturesDiff(pictures_signature_dict).compare(scanned_files_stat_dict)
+    elapsed_time = time.perf_counter() - start_time
+
+    return elapsed_time, pictures_diff
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        benchmark_sizes = [int(size) for size in sys.argv[1:]]
+    else:
+        benchmark_sizes = [10000, 100000, 1000000]
+
+    for size in benchmark_sizes:
+        elapsed_time, pictures_diff = benchmark(size)
+        print(
+            f'{size} paths: {elapsed_time:.3f} s '
+            f'(added {len(pictures_diff["added"])}, removed {len(pictures_diff["removed"])}, '
+            f'modified {len(pictures_diff["modified"])}, moved {len(pictures_diff["moved"])}, '
+            f'move candidates {len(pictures_diff["move_candidates"])})'
+        )
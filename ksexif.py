@@ -0,0 +1,204 @@
+import struct
+
+
+class ExifHeader:
+    def __init__(self):
+        super(ExifHeader, self).__init__()
+
+    @staticmethod
+    def read_exif_data(img_path):
+        # Only the first bytes of a JPEG are read; the EXIF segment, including its preview, is limited to 64 KB
+        exif_data = dict()
+        try:
+            with open(img_path, 'rb') as img_file:
+                header_data = img_file.read(131072)
+        except OSError:
+            return exif_data
+
+        if header_data[:4] in (b'II*\x00', b'MM\x00*'):
+            # TIFF keeps its directories anywhere in the file, so they are read where they are
+            try:
+                with open(img_path, 'rb') as img_file:
+                    return ExifHeader.read_tiff_data(FileData(img_file))
+            except (OSError, struct.error, IndexError, ValueError):
+                return exif_data
+        else:
+            tiff_data, tiff_offset = ExifHeader.read_jpeg_exif_segment(header_data)
+            if not tiff_data:
+                return exif_data
+
+        try:
+            exif_data = ExifHeader.read_tiff_data(tiff_data)
+        except (struct.error, IndexError, ValueError):
+            return dict()
+
+        if 'preview_offset' in exif_data:
+            exif_data['preview_offset'] = exif_data['preview_offset'] + tiff_offset
+        return exif_data
+
+    @staticmethod
+    def read_jpeg_exif_segment(header_data):
+        if header_data[:2] != b'\xff\xd8':
+            return b'', 0
+
+        offset = 2
+        while offset + 4 <= len(header_data):
+            if header_data[offset] != 0xff:
+                break
+            marker = header_data[offset + 1]
+            if marker == 0xff:
+                offset = offset + 1
+                continue
+            if marker in (0xd9, 0xda):
+                break
+
+            segment_length = struct.unpack('>H', header_data[offset + 2:offset + 4])[0]
+            segment_data = header_data[offset + 4:offset + 2 + segment_length]
+            if marker == 0xe1 and segment_data[:6] == b'Exif\x00\x00':
+                return segment_data[6:], offset + 10
+
+            offset = offset + 2 + segment_length
+
+        return b'', 0
+
+    @staticmethod
+    def read_tiff_data(tiff_data):
+        if tiff_data[:2] == b'II':
+            byte_order = '<'
+        elif tiff_data[:2] == b'MM':
+            byte_order = '>'
+        else:
+            return dict()
+
+        exif_data = dict()
+        ifd0_offset = struct.unpack(f'{byte_order}I', tiff_data[4:8])[0]
+        ifd0_tags_dict, ifd1_offset = ExifHeader.read_ifd(tiff_data, ifd0_offset, byte_order)
+
+        if 0x0100 in ifd0_tags_dict and 0x0101 in ifd0_tags_dict:
+            exif_data['width'] = ifd0_tags_dict[0x0100]
+            exif_data['height'] = ifd0_tags_dict[0x0101]
+            # Raw files keep a reduced copy in IFD0, so its size is not the picture's
+            exif_data['reduced'] = bool(ifd0_tags_dict.get(0x00fe, 0) & 1)
+        if 0x0112 in ifd0_tags_dict:
+            exif_data['orientation'] = ifd0_tags_dict[0x0112]
+        if 0x0132 in ifd0_tags_dict:
+            exif_data['date_time'] = ifd0_tags_dict[0x0132]
+
+        if 0x8769 in ifd0_tags_dict:
+            exif_ifd_tags_dict, _ = ExifHeader.read_ifd(tiff_data, ifd0_tags_dict[0x8769], byte_order)
+            if 0x9003 in exif_ifd_tags_dict:
+                exif_data['date_time_original'] = exif_ifd_tags_dict[0x9003]
+
+        # IFD1 describes the embedded preview, usually a 160x120 JPEG
+        if ifd1_offset:
+            ifd1_tags_dict, _ = ExifHeader.read_ifd(tiff_data, ifd1_offset, byte_order)
+            if 0x0201 in ifd1_tags_dict and 0x0202 in ifd1_tags_dict:
+                exif_data['preview_offset'] = ifd1_tags_dict[0x0201]
+                exif_data['preview_length'] = ifd1_tags_dict[0x0202]
+
+        return exif_data
+
+    @staticmethod
+    def read_ifd(tiff_data, ifd_offset, byte_order):
+        tags_dict = dict()
+        if ifd_offset <= 0 or ifd_offset + 2 > len(tiff_data):
+            return tags_dict, 0
+
+        entries_number = struct.unpack(f'{byte_order}H', tiff_data[ifd_offset:ifd_offset + 2])[0]
+        for n in range(entries_number):
+            entry_offset = ifd_offset + 2 + n * 12
+            if entry_offset + 12 > len(tiff_data):
+                return tags_dict, 0
+
+            tag, value_type, value_count = struct.unpack(
+                f'{byte_order}HHI', tiff_data[entry_offset:entry_offset + 8]
+            )
+            value_data = tiff_data[entry_offset + 8:entry_offset + 12]
+
+            if value_type == 3:
+                tags_dict[tag] = struct.unpack(f'{byte_order}H', value_data[:2])[0]
+            elif value_type in (4, 13):
+                tags_dict[tag] = struct.unpack(f'{byte_order}I', value_data)[0]
+            elif value_type == 2:
+                if value_count <= 4:
+                    text_data = value_data[:value_count]
+                else:
+                    text_offset = struct.unpack(f'{byte_order}I', value_data)[0]
+                    text_data = tiff_data[text_offset:text_offset + value_count]
+                tags_dict[tag] = text_data.split(b'\x00')[0].decode('ascii', 'replace').strip()
+
+        next_ifd_offset_position = ifd_offset + 2 + entries_number * 12
+        if next_ifd_offset_position + 4 > len(tiff_data):
+            return tags_dict, 0
+        next_ifd_offset = struct.unpack(
+            f'{byte_order}I', tiff_data[next_ifd_offset_position:next_ifd_offset_position + 4]
+        )[0]
+        return tags_dict, next_ifd_offset
+
+    @staticmethod
+    def reset_orientation(tiff_data):
+        # The orientation tag of IFD0 is set to 1, upright, and everything else is kept as it is
+        if tiff_data[:2] == b'II':
+            byte_order = '<'
+        elif tiff_data[:2] == b'MM':
+            byte_order = '>'
+        else:
+            return tiff_data
+
+        tiff_data = bytearray(tiff_data)
+        ifd0_offset = struct.unpack(f'{byte_order}I', tiff_data[4:8])[0]
+        if ifd0_offset <= 0 or ifd0_offset + 2 > len(tiff_data):
+            return bytes(tiff_data)
+
+        entries_number = struct.unpack(f'{byte_order}H', tiff_data[ifd0_offset:ifd0_offset + 2])[0]
+        for n in range(entries_number):
+            entry_offset = ifd0_offset + 2 + n * 12
+            if entry_offset + 12 > len(tiff_data):
+                break
+            tag, value_type = struct.unpack(f'{byte_order}HH', tiff_data[entry_offset:entry_offset + 4])
+            if tag == 0x0112 and value_type == 3:
+                tiff_data[entry_offset + 8:entry_offset + 10] = struct.pack(f'{byte_order}H', 1)
+        return bytes(tiff_data)
+
+    @staticmethod
+    def read_preview(img_path):
+        exif_data = ExifHeader.read_exif_data(img_path)
+        orientation = exif_data.get('orientation', 1)
+        if 'preview_offset' not in exif_data or not exif_data['preview_length']:
+            return b'', orientation
+
+        try:
+            with open(img_path, 'rb') as img_file:
+                img_file.seek(exif_data['preview_offset'])
+                preview_data = img_file.read(exif_data['preview_length'])
+        except OSError:
+            return b'', orientation
+
+        if preview_data[:2] != b'\xff\xd8':
+            return b'', orientation
+        return preview_data, orientation
+
+
+class FileData:
+    # Slices of an open file read like slices of bytes, so TIFF directories are parsed without loading the file
+    def __init__(self, data_file):
+        super(FileData, self).__init__()
+        self.data_file = data_file
+        self.data_file.seek(0, 2)
+        self.data_size = self.data_file.tell()
+
+    def __len__(self):
+        return self.data_size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(self.data_size)
+            if stop <= start:
+                return b''
+            self.data_file.seek(start)
+            return self.data_file.read(stop - start)
+
+        if index < 0:
+            index = index + self.data_size
+        self.data_file.seek(index)
+        return self.data_file.read(1)[0]
@@ -1,7 +1,8 @@
 import os
+import time
 import shutil
 from queue import Queue as queue_Queue
-from threading import Thread
+from threading import Thread, Event, Lock
 from PySide6.QtCore import Signal, QObject, Qt, QRect
 from PySide6.QtWidgets import QLabel
 from PySide6.QtGui import QPen, QPainter
@@ -9,6 +10,10 @@ from PySide6.QtGui import QPen, QPainter
 from kshandler import Commands, ImageMagickHandler
 from ksscan import MultiprocessingFolderScan
 from kscache import HandlePicturesChanges
+from kswatcher import WatchFolder
+from ksthumbnail import ThumbnailTiers, CacheMigration
+from kspack import ThumbnailPack
+from ksbackend import ImageBackends
 
 
 class PictureLabel(QLabel):
@@ -110,20 +115,16 @@ class SaveAs(QObject):
 
     def __init__(self, img_path, target_path, resize_option, img_quality):
         super(SaveAs, self).__init__()
-        self.imagemagick_handler = ImageMagickHandler()
 
         thread = Thread(target=self.save_as, args=(img_path, target_path, resize_option, img_quality))
         thread.daemon = True
         thread.start()
 
     def save_as(self, src_path, target_path, resize_option, img_quality):
-        imagemagick_program_status, imagemagick_program_path = \
-            self.imagemagick_handler.check_imagemagick_available()
-        if imagemagick_program_status:
-            save_as_result = self.imagemagick_handler.convert_picture(src_path, target_path, resize_option, img_quality)
+        save_as_result = ImageBackends.run('convert', src_path, target_path, resize_option, img_quality)
 
-            if save_as_result:
-                self.save_as_result_signal.emit()
+        if save_as_result:
+            self.save_as_result_signal.emit()
 
 
 class ExportPDF(QObject):
@@ -156,27 +157,22 @@ class ExportPDF(QObject):
 
 
 
-class ImageMagickClip(QObject):
+class PictureClip(QObject):
     clip_result_signal = Signal(str)
 
     def __init__(self, src_path, target_path, resize_option, width, height, begin_x, begin_y):
-        super(ImageMagickClip, self).__init__()
-        self.imagemagick_handler = ImageMagickHandler()
+        super(PictureClip, self).__init__()
 
         thread = Thread(
-            target=self.imagemagick_clip, args=(src_path, target_path, resize_option, width, height, begin_x, begin_y)
+            target=self.clip, args=(src_path, target_path, resize_option, width, height, begin_x, begin_y)
         )
         thread.daemon = True
         thread.start()
 
-    def imagemagick_clip(self, src_path, target_path, resize_option, width, height, begin_x, begin_y):
-        convert_result = self.imagemagick_handler.convert_picture(src_path, target_path, resize_option, '')
-        if convert_result:
-            clip_result = self.imagemagick_handler.clip_picture(
-                target_path, target_path, width, height, begin_x, begin_y
-            )
-            if clip_result:
-                self.clip_result_signal.emit(target_path)
+    def clip(self, src_path, target_path, resize_option, width, height, begin_x, begin_y):
+        clip_result = ImageBackends.run('crop', src_path, target_path, resize_option, width, height, begin_x, begin_y)
+        if clip_result:
+            self.clip_result_signal.emit(target_path)
 
 
 class OpenFolder(QObject):
@@ -201,7 +197,7 @@ class OpenFolder(QObject):
         handle_pictures_changes.start(
             folder_path, scanned_files_number_signal,
             cache_status_signal, pictures_changes_signal,
-            cached_progress_signal, cached_files_number_signal)
+            cached_progress_signal, cached_files_number_signal, force_rescan=True)
 
         scanned_files_number = scanned_files_number_signal.get()
         self.scan_result_signal.emit(scanned_files_number)
@@ -235,7 +231,7 @@ class ReadSubdirectories(QObject):
 
         multiprocessing_folder_scan = MultiprocessingFolderScan()
         multiprocessing_folder_scan.prepare(
-            folder_path, filetypes, threads_number, '', images_included_subdirectories_signal
+            folder_path, filetypes, threads_number, '', images_included_subdirectories_signal, ''
         )
 
         images_included_subdirectories_path_list = images_included_subdirectories_signal.get()
@@ -280,9 +276,17 @@ class ImportImages(QObject):
         scanned_files_number = scan_result[1]
 
         imported_number = 0
+        pictures_metadata_dict = dict()
+        chunk_size = 100
+
+        for n, image in enumerate(scanned_files_list):
+            if n % chunk_size == 0:
+                # Creation times of the next chunk come from a single identify run
+                pictures_metadata_dict = self.imagemagick_handler.read_pictures_metadata(
+                    scanned_files_list[n:n + chunk_size]
+                )
 
-        for image in scanned_files_list:
-            image_creation_time = self.imagemagick_handler.read_exif_creation_time(image)
+            image_creation_time = pictures_metadata_dict[image]['creation_time']
             image_creation_time = image_creation_time.split(' ')
             image_creation_date = image_creation_time[0]
             image_creation_date_folder = os.path.join(self.pictures_folder_path, image_creation_date)
@@ -295,9 +299,7 @@ class ImportImages(QObject):
                 imported_number = imported_number + 1
                 self.imported_number_signal.emit(scanned_files_number, imported_number)
             else:
-                image_md5 = self.commands.read_md5(image)
-                exist_image_md5 = self.commands.read_md5(import_image_path)
-                if image_md5 != exist_image_md5:
+                if not self.commands.compare_files(image, import_image_path):
                     file_basename = self.commands.create_duplicate_name(
                         os.path.basename(image), image_creation_date_folder
                     )
@@ -316,13 +318,13 @@ class SettingsScanFolder(QObject):
     cachepictures_progress_signal = Signal(str, int)
     cachepictures_result_signal = Signal(int)
 
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, force_rescan):
         super(SettingsScanFolder, self).__init__()
-        thread = Thread(target=self.scan_folder_thread, args=(folder_path,))
+        thread = Thread(target=self.scan_folder_thread, args=(folder_path, force_rescan))
         thread.daemon = True
         thread.start()
 
-    def scan_folder_thread(self, folder_path):
+    def scan_folder_thread(self, folder_path, force_rescan):
         scanned_files_number_signal = queue_Queue()
         cache_status_signal = queue_Queue()
         pictures_changes_signal = queue_Queue()
@@ -333,7 +335,7 @@ class SettingsScanFolder(QObject):
         handle_pictures_changes.start(
             folder_path, scanned_files_number_signal,
             cache_status_signal, pictures_changes_signal,
-            cached_progress_signal, cached_files_number_signal
+            cached_progress_signal, cached_files_number_signal, force_rescan
         )
 
         scanned_files_number = scanned_files_number_signal.get()
@@ -373,6 +375,115 @@ class SettingsScanFolder(QObject):
             self.pictures_changes_result_signal.emit(removed_number, moved_number, added_number)
 
 
+class WatchPicturesFolder(QObject):
+    pictures_changes_result_signal = Signal(int, int, int)
+    watch_notice_signal = Signal(str)
+
+    def __init__(self, folder_path):
+        super(WatchPicturesFolder, self).__init__()
+        self.commands = Commands()
+        self.folder_path = os.path.normpath(folder_path)
+
+        self.changed_folders_signal = queue_Queue()
+        self.resume_signal = Event()
+        self.resume_signal.set()
+        self.job_lock = Lock()
+
+        self.watch_folder = WatchFolder()
+        self.watch_folder.start(
+            self.folder_path, self.commands.read_supported_formats(), self.changed_folders_signal,
+            self.watch_limit_reached
+        )
+
+        thread = Thread(target=self.handle_changes_thread)
+        thread.daemon = True
+        thread.start()
+
+    def watch_limit_reached(self):
+        self.watch_notice_signal.emit(
+            'There are more folders than the inotify watch limit allows,\n'
+            'so the pictures folder is checked for changes every few seconds instead.'
+        )
+
+    def pause(self):
+        # A job already running holds job_lock, so a full scan or clean-up never writes alongside it
+        self.resume_signal.clear()
+        with self.job_lock:
+            pass
+
+    def resume(self):
+        self.resume_signal.set()
+
+    def stop(self):
+        self.watch_folder.stop()
+        self.changed_folders_signal.put('stopped')
+
+    def handle_changes_thread(self):
+        while True:
+            changed_folders_set = self.changed_folders_signal.get()
+            if changed_folders_set == 'stopped':
+                break
+
+            # Changes reported while a full scan is running are handled together once it has finished
+            while True:
+                self.resume_signal.wait()
+                with self.job_lock:
+                    # Paused again between the wait and the lock
+                    if not self.resume_signal.is_set():
+                        continue
+
+                    while not self.changed_folders_signal.empty():
+                        more_changed_folders_set = self.changed_folders_signal.get()
+                        if more_changed_folders_set == 'stopped':
+                            return
+                        changed_folders_set = changed_folders_set | more_changed_folders_set
+
+                    self.handle_changes(changed_folders_set)
+                break
+
+    def handle_changes(self, changed_folders_set):
+        # One job covers all changed folders, so a picture moved between two of them is still found as moved
+        changed_folder_path = os.path.commonpath(list(changed_folders_set))
+        if changed_folder_path != self.folder_path and \
+                not changed_folder_path.startswith(f'{self.folder_path}{os.sep}'):
+            changed_folder_path = self.folder_path
+        while not os.path.isdir(changed_folder_path) and changed_folder_path != self.folder_path:
+            changed_folder_path = os.path.dirname(changed_folder_path)
+        if not os.path.isdir(changed_folder_path):
+            return
+
+        scanned_files_number_signal = queue_Queue()
+        cache_status_signal = queue_Queue()
+        pictures_changes_signal = queue_Queue()
+        cached_progress_signal = queue_Queue()
+        cached_files_number_signal = queue_Queue()
+
+        handle_pictures_changes = HandlePicturesChanges()
+        handle_pictures_changes.changed_folders_set = changed_folders_set
+        handle_pictures_changes.start(
+            changed_folder_path, scanned_files_number_signal,
+            cache_status_signal, pictures_changes_signal,
+            cached_progress_signal, cached_files_number_signal
+        )
+
+        scanned_files_number_signal.get()
+        cache_status = cache_status_signal.get()
+
+        if cache_status == 'Need':
+            while True:
+                cached_progress_list = cached_progress_signal.get()
+                if cached_progress_list == 'stopped':
+                    break
+            cached_files_number_signal.get()
+
+        pictures_changes = pictures_changes_signal.get()
+        if pictures_changes != 'No change':
+            removed_number = pictures_changes[0]
+            moved_number = pictures_changes[1]
+            added_number = pictures_changes[2]
+            self.pictures_changes_result_signal.emit(removed_number, moved_number, added_number)
+
+
 class CleanDatabaseAndCache(QObject):
     clean_database_and_cache_result_signal = Signal(int, int, int, int)
 
@@ -404,6 +515,10 @@ class CleanDatabaseAndCache(QObject):
 
 
 class Tools:
+    # The album and the deferred thumbnails keep working during a clean, so a file changed this recently may be
+    # a thumbnail still being written, or one whose record is not saved yet; only older strays are removed
+    stray_grace_period = 600
+
     def __init__(self):
         super(Tools, self).__init__()
         self.commands = Commands()
@@ -416,41 +531,56 @@ class Tools:
             database_records_number_signal, cache_folder_files_number_signal
     ):
         pictures_folder_path = self.commands.read_pictures_folder_path()
-        pictures_path_data, _, _, _ = self.commands.read_pictures_data()
 
         removed_records_list = list()
-        for picture_path in pictures_path_data:
-            picture_record = self.commands.read_picture_record(picture_path)
-            if len(picture_record) > 1:
-                del picture_record[0]
-                for record in picture_record:
-                    picture_id = record[0]
-                    self.commands.remove_picture_id_record(picture_id)
-                    removed_records_list.append(record)
-
-        for picture_path in pictures_path_data:
-            if pictures_folder_path not in picture_path:
-                self.commands.remove_picture_record(picture_path)
-                removed_records_list.append(picture_path)
+        duplicate_picture_records = self.commands.read_duplicate_picture_records()
+        for record in duplicate_picture_records:
+            picture_id = record[0]
+            self.commands.remove_picture_id_record(picture_id)
+            removed_records_list.append(record)
 
         removed_records_number = len(removed_records_list)
+        removed_records_number = removed_records_number + \
+            self.commands.remove_picture_records_outside_folder(pictures_folder_path)
 
         _, _, _, pictures_cached_name_data = self.commands.read_pictures_data()
 
         pictures_cached_path_list = list()
         for picture_cached_name in pictures_cached_name_data:
             if picture_cached_name:
-                picture_cached_path = os.path.join(self.cache_folder_path, picture_cached_name)
-                pictures_cached_path_list.append(picture_cached_path)
+                picture_cached_path = self.commands.read_cache_path(self.cache_folder_path, picture_cached_name)
+                pictures_cached_path_list.extend(ThumbnailTiers.read_tier_paths(picture_cached_path))
+        pictures_cached_path_list = set(pictures_cached_path_list)
+
+        # Files left from the flat layout are moved into place first, so they are not taken for strays
+        CacheMigration().migrate()
+
+        # Packed thumbnails of removed records are dropped and the pack files compacted
+        thumbnail_pack = ThumbnailPack.get_pack()
+        pictures_cached_name_set = set(pictures_cached_name_data)
+        thumbnail_pack.remove(
+            [img_cache_name for img_cache_name in thumbnail_pack.read_packed_names()
+             if img_cache_name not in pictures_cached_name_set]
+        )
+        thumbnail_pack.compact()
 
         removed_files_list = list()
-        with os.scandir(self.cache_folder_path) as cache:
-            for item in cache:
-                item_path = item.path
-                if os.path.isfile(item_path):
-                    if item_path not in pictures_cached_path_list:
-                        os.remove(item_path)
-                        removed_files_list.append(item_path)
+        stray_time = time.time() - self.stray_grace_period
+        for folder_path, folders_list, file_names_list in os.walk(self.cache_folder_path):
+            if folder_path == self.cache_folder_path and 'pack' in folders_list:
+                folders_list.remove('pack')
+            for file_name in file_names_list:
+                item_path = os.path.join(folder_path, file_name)
+                if item_path in pictures_cached_path_list:
+                    continue
+                try:
+                    if os.path.getmtime(item_path) > stray_time:
+                        continue
+                    os.remove(item_path)
+                except OSError:
+                    # Renamed into place or removed by its writer meanwhile
+                    continue
+                removed_files_list.append(item_path)
 
         removed_files_number = len(removed_files_list)
 
@@ -459,14 +589,9 @@ class Tools:
         pictures_path_data, _, _, _ = self.commands.read_pictures_data()
         database_records_number = len(pictures_path_data)
 
-        cache_folder_files_list = list()
-        with os.scandir(self.cache_folder_path) as cache:
-            for item in cache:
-                item_path = item.path
-                if os.path.isfile(item_path):
-                    cache_folder_files_list.append(item_path)
-
-        cache_folder_files_number = len(cache_folder_files_list)
+        cache_folder_files_number = 0
+        for _, _, file_names_list in os.walk(self.cache_folder_path):
+            cache_folder_files_number = cache_folder_files_number + len(file_names_list)
 
         removed_records_number_signal.put(removed_records_number)
         removed_files_number_signal.put(removed_files_number)
@@ -1,12 +1,15 @@
 import os
 import sys
-import hashlib
+import json
 import shutil
 import random
 import string
+import time
+import threading
 import subprocess
 
 from ksdatabase import BasicConfig, Database
+from kshash import FileHash
 
 
 class Commands:
@@ -39,11 +42,19 @@ class Commands:
 
     @staticmethod
     def read_md5(file):
-        with open(file, 'rb') as cache:
-            md5_check = hashlib.md5()
-            md5_check.update(cache.read())
-            file_md5 = md5_check.hexdigest()
-        return file_md5
+        return FileHash.read_hash(file, 'md5')
+
+    @staticmethod
+    def read_file_hash(file, algorithm):
+        return FileHash.read_hash(file, algorithm)
+
+    @staticmethod
+    def read_quick_fingerprint(file):
+        return FileHash.read_quick_fingerprint(file)
+
+    @staticmethod
+    def compare_files(file, other_file):
+        return FileHash.compare_files(file, other_file)
 
     @staticmethod
     def create_random_name(prefix_name):
@@ -82,6 +93,18 @@ class Commands:
             filetype = f'.{basename[-1]}'
         return filetype
 
+    @staticmethod
+    def read_cache_path(cache_folder_path, img_cache_name):
+        # Cache files are kept two folders deep by the first characters of their names, ab/cd/abcd....jpg,
+        # so no folder holds more than a few thousand files however large the cache grows
+        return os.path.join(cache_folder_path, img_cache_name[:2], img_cache_name[2:4], img_cache_name)
+
+    @staticmethod
+    def make_cache_path(cache_folder_path, img_cache_name):
+        img_cache_path = Commands.read_cache_path(cache_folder_path, img_cache_name)
+        os.makedirs(os.path.dirname(img_cache_path), exist_ok=True)
+        return img_cache_path
+
     @staticmethod
     def get_filename(file_path):
         file_name_with_type = os.path.basename(file_path)
@@ -204,6 +227,57 @@ class Commands:
     def save_cache_threads_number(self, cache_threads_number):
         self.database.save_setting('cache_threads_number', cache_threads_number)
 
+    def read_hash_algorithm(self):
+        hash_algorithm = self.database.read_setting('hash_algorithm')
+        if hash_algorithm not in ['md5', 'blake2b']:
+            hash_algorithm = 'md5'
+        return hash_algorithm
+
+    def save_hash_algorithm(self, hash_algorithm):
+        self.database.save_setting('hash_algorithm', hash_algorithm)
+
+    def read_cache_size_limit(self):
+        # The limit is saved in megabytes; 0 means the cache folder may grow without limit
+        cache_size_limit = self.database.read_setting('cache_size_limit')
+        try:
+            cache_size_limit = int(cache_size_limit)
+        except (TypeError, ValueError):
+            cache_size_limit = 0
+        return max(cache_size_limit, 0)
+
+    def save_cache_size_limit(self, cache_size_limit):
+        self.database.save_setting('cache_size_limit', str(cache_size_limit))
+
+    def read_thumbnail_store(self):
+        # 'files' keeps each thumbnail in a file of its own; 'pack' appends the album's thumbnails to pack files
+        thumbnail_store = self.database.read_setting('thumbnail_store')
+        if thumbnail_store not in ['files', 'pack']:
+            thumbnail_store = 'files'
+        return thumbnail_store
+
+    def save_thumbnail_store(self, thumbnail_store):
+        self.database.save_setting('thumbnail_store', thumbnail_store)
+
+    def read_image_backends(self):
+        # The routing measured by the backend calibration, with the signature of the Qt and ImageMagick it measured
+        try:
+            image_backends = json.loads(self.database.read_setting('image_backends'))
+        except ValueError:
+            image_backends = dict()
+        if not isinstance(image_backends, dict):
+            image_backends = dict()
+        return image_backends
+
+    def save_image_backends(self, image_backends):
+        self.database.save_setting('image_backends', json.dumps(image_backends))
+
+    def read_watch_pictures_folder(self):
+        watch_pictures_folder = self.database.read_setting('watch_pictures_folder')
+        return watch_pictures_folder
+
+    def save_watch_pictures_folder(self, watch_pictures_folder):
+        self.database.save_setting('watch_pictures_folder', watch_pictures_folder)
+
     def read_latest_geometry(self):
         latest_geometry = self.database.read_setting('latest_geometry')
         return latest_geometry
@@ -240,26 +314,29 @@ class Commands:
             os.mkdir(cache_folder_path)
         return cache_folder_path
 
+    def begin_pictures_batch(self):
+        self.database.begin_pictures_batch()
+
+    def end_pictures_batch(self):
+        self.database.end_pictures_batch()
+
     def add_picture_record(self, picture_path, picture_md5, creation_time):
         self.database.pictures_insert_record(picture_path, picture_md5, creation_time)
 
     def read_latest_pictures_data(self):
         pictures_data = self.database.read_latest_pictures_data()
-        if pictures_data:
-            pictures_data = list(zip(*pictures_data))
-            pictures_path_data = pictures_data[1]
-            pictures_md5_data = pictures_data[2]
-            pictures_creation_time_data = pictures_data[3]
-            pictures_cached_name_data = pictures_data[4]
-        else:
-            pictures_path_data = []
-            pictures_md5_data = []
-            pictures_creation_time_data = []
-            pictures_cached_name_data = []
-        return pictures_path_data, pictures_md5_data, pictures_creation_time_data, pictures_cached_name_data
+        return self.split_pictures_data(pictures_data)
 
     def read_pictures_data(self):
         pictures_data = self.database.read_pictures_data()
+        return self.split_pictures_data(pictures_data)
+
+    def read_folder_pictures_data(self, folder_path):
+        pictures_data = self.database.read_folder_pictures_data(folder_path)
+        return self.split_pictures_data(pictures_data)
+
+    @staticmethod
+    def split_pictures_data(pictures_data):
         if pictures_data:
             pictures_data = list(zip(*pictures_data))
             pictures_path_data = pictures_data[1]
@@ -273,6 +350,50 @@ class Commands:
             pictures_cached_name_data = []
         return pictures_path_data, pictures_md5_data, pictures_creation_time_data, pictures_cached_name_data
 
+    def read_folder_pictures_size_data(self, folder_path):
+        pictures_size_data = self.database.read_folder_pictures_size_data(folder_path)
+
+        pictures_size_dict = dict()
+        for picture_path, picture_width, picture_height in pictures_size_data:
+            if picture_width and picture_height:
+                pictures_size_dict[picture_path] = (picture_width, picture_height)
+        return pictures_size_dict
+
+    def read_folder_pictures_signature_data(self, folder_path):
+        pictures_signature_data = self.database.read_folder_pictures_signature_data(folder_path)
+
+        pictures_md5_dict = dict()
+        pictures_signature_dict = dict()
+        for picture_path, picture_md5, file_size, file_mtime_ns, file_inode, file_device in pictures_signature_data:
+            pictures_md5_dict[picture_path] = picture_md5
+            if file_size is None:
+                pictures_signature_dict[picture_path] = None
+            else:
+                pictures_signature_dict[picture_path] = (file_size, file_mtime_ns, file_inode, file_device)
+
+        return pictures_md5_dict, pictures_signature_dict
+
+    def read_folder_directories_data(self, folder_path):
+        directories_data = self.database.read_folder_directories_data(folder_path)
+
+        directories_mtime_dict = dict()
+        directories_files_number_dict = dict()
+        subdirectories_dict = dict()
+        for directory_path, parent_folder, folder_mtime_ns, files_number in directories_data:
+            directories_mtime_dict[directory_path] = folder_mtime_ns
+            directories_files_number_dict[directory_path] = files_number
+            if parent_folder:
+                subdirectories_dict.setdefault(parent_folder, []).append(directory_path)
+
+        return directories_mtime_dict, directories_files_number_dict, subdirectories_dict
+
+    def save_folder_directories(self, folder_path, scanned_folders_dict):
+        directories_data = list()
+        for directory_path, (parent_folder, folder_mtime_ns, files_number) in scanned_folders_dict.items():
+            directories_data.append((directory_path, parent_folder, folder_mtime_ns, files_number))
+
+        self.database.directories_replace_records(folder_path, directories_data)
+
     def read_picture_record(self, picture_path):
         picture_record = self.database.pictures_read_record('picture_path', picture_path)
         return picture_record
@@ -296,18 +417,86 @@ class Commands:
         else:
             picture_record = list(picture_record[0])
             picture_cached_name = picture_record[4]
+            if not picture_cached_name:
+                # The record was added but its thumbnail was never made
+                return ''
             cache_folder_path = self.read_cache_folder_path()
-            picture_cached_path = os.path.join(cache_folder_path, picture_cached_name)
+            picture_cached_path = self.read_cache_path(cache_folder_path, picture_cached_name)
         return picture_cached_path
 
-    def save_picture_path(self, img_md5, img_path):
-        self.database.pictures_update_record('picture_md5', img_md5, 'picture_path', img_path)
-
     def save_picture_md5(self, img_path, img_md5):
         self.database.pictures_update_record('picture_path', img_path, 'picture_md5', img_md5)
 
+    def read_picture_fingerprint(self, img_path):
+        img_fingerprint = self.database.pictures_read_fingerprint(img_path)
+        return img_fingerprint
+
+    def save_picture_fingerprint(self, img_path, img_fingerprint):
+        self.database.pictures_update_record('picture_path', img_path, 'file_fingerprint', img_fingerprint)
+
+    def save_picture_size(self, img_path, img_width, img_height):
+        self.database.pictures_update_size(img_path, img_width, img_height)
+
+    def remove_picture_size(self, img_path):
+        self.database.pictures_update_size(img_path, None, None)
+
+    def save_picture_signature(self, img_path, img_signature):
+        file_size, file_mtime_ns, file_inode, file_device = img_signature
+        self.database.pictures_update_signature(img_path, file_size, file_mtime_ns, file_inode, file_device)
+
+    def read_folder_preview_pictures_data(self, folder_path):
+        pictures_preview_data = self.database.read_folder_preview_pictures_data(folder_path)
+        return pictures_preview_data
+
+    def save_picture_cache_preview(self, img_path, cache_preview):
+        self.database.pictures_update_record('picture_path', img_path, 'cache_preview', cache_preview)
+
+    def clear_cache_preview(self, img_cache_name):
+        self.database.pictures_update_record('cached_name', img_cache_name, 'cache_preview', 0)
+
+    def move_picture_records(self, moved_list, img_stat_dict):
+        moved_records_list = list()
+        for picture_path, img_path in moved_list:
+            moved_records_list.append((picture_path, img_path) + tuple(img_stat_dict[img_path]))
+
+        if moved_records_list:
+            self.database.pictures_move_records(moved_records_list)
+
     def save_picture_cached_path(self, img_path, img_cache_name):
         self.database.pictures_update_record('picture_path', img_path, 'cached_name', img_cache_name)
+        self.database.pictures_update_record('cached_name', img_cache_name, 'cache_evicted', 0)
+
+    def read_pack_entries(self, cached_names_list):
+        pack_entries_data = self.database.read_pack_entries_data(list(cached_names_list))
+        return dict((entry[0], tuple(entry[1:])) for entry in pack_entries_data)
+
+    def read_all_pack_entries(self):
+        pack_entries_data = self.database.read_all_pack_entries_data()
+        return dict((entry[0], tuple(entry[1:])) for entry in pack_entries_data)
+
+    def save_pack_entries(self, pack_entries_list):
+        if pack_entries_list:
+            self.database.pack_replace_entries(pack_entries_list)
+
+    def remove_pack_entries(self, cached_names_list):
+        if cached_names_list:
+            self.database.pack_delete_entries(list(cached_names_list))
+
+    def read_folder_evicted_pictures(self, folder_path):
+        pictures_evicted_data = self.database.read_folder_evicted_pictures_data(folder_path)
+        return set(picture_path for (picture_path,) in pictures_evicted_data)
+
+    def read_cache_eviction_list(self):
+        cache_eviction_data = self.database.read_cache_eviction_data()
+        return [picture_cached_name for (picture_cached_name,) in cache_eviction_data]
+
+    def save_cache_access_time(self, cached_names_list):
+        if cached_names_list:
+            self.database.pictures_update_access_time(cached_names_list, int(time.time()))
+
+    def save_evicted_cache_names(self, cached_names_list):
+        if cached_names_list:
+            self.database.pictures_update_evicted(cached_names_list)
 
     def remove_picture_record(self, picture_path):
         self.database.pictures_delete_record('picture_path', picture_path)
@@ -315,26 +504,20 @@ class Commands:
     def remove_picture_id_record(self, picture_id):
         self.database.pictures_delete_record('id', picture_id)
 
-    def database_vacuum(self):
-        self.database.database_vacuum()
-
-    def check_reserved_cache_files(self):
-        cache_folder_path = self.read_cache_folder_path()
-        pictures_path_data, _, _, pictures_cached_name_data = self.read_latest_pictures_data()
-
-        reserved_cache_files_list = list()
-        n = 0
+    def read_duplicate_picture_records(self):
+        duplicate_picture_records = self.database.pictures_read_duplicate_records()
+        return duplicate_picture_records
 
-        for picture_cached_name in pictures_cached_name_data:
-            picture_path = pictures_path_data[n]
+    def remove_picture_records_outside_folder(self, folder_path):
+        removed_records_number = self.database.pictures_delete_outside_folder(folder_path)
+        return removed_records_number
 
-            if os.path.exists(picture_path):
-                picture_cached_path = os.path.join(cache_folder_path, picture_cached_name)
-                reserved_cache_files_list.append(picture_cached_path)
-
-            n = n + 1
+    def database_vacuum(self):
+        self.database.database_vacuum()
 
-        return reserved_cache_files_list
+    def check_cache_referenced(self, img_cache_name):
+        # The count is read from the cached_name index, so it does not grow with the catalog
+        return self.database.pictures_count_cached_name(img_cache_name) > 0
 
 
 class ImageMagickHandler:
@@ -422,9 +605,16 @@ class ImageMagickHandler:
         hide_console = self.hide_console_status()
         identify_process = subprocess.Popen(commands, stdout=subprocess.PIPE, startupinfo=hide_console)
         exif_info = identify_process.stdout.readlines()
+        creation_time = self.read_creation_time([line.decode('utf-8') for line in exif_info])
+
+        identify_process.communicate()
+
+        return creation_time
+
+    @staticmethod
+    def read_creation_time(exif_lines):
         creation_time = str()
-        for line in exif_info:
-            line = line.decode('utf-8')
+        for line in exif_lines:
             if 'DateTimeOriginal' in line:
                 line = line.strip('\r\n')
                 line = line.split('=')
@@ -446,10 +636,91 @@ class ImageMagickHandler:
                         if 'T' in creation_time:
                             creation_time = creation_time.split('T')
                             creation_time = f'{creation_time[0]} {creation_time[1]}'
+        return creation_time
 
-        identify_process.communicate()
+    def read_pictures_metadata(self, img_list):
+        # One identify run per chunk returns creation time, dimensions and orientation of every picture;
+        # pictures missing from its output are identified again one by one
+        pictures_metadata_dict = dict()
+        chunk_size = 100
+        for n in range(0, len(img_list), chunk_size):
+            chunk_list = img_list[n:n + chunk_size]
+            chunk_metadata_dict = self.identify_pictures(chunk_list)
+
+            for img_path in chunk_list:
+                if img_path not in chunk_metadata_dict and len(chunk_list) > 1:
+                    chunk_metadata_dict.update(self.identify_pictures([img_path]))
+
+                if img_path in chunk_metadata_dict:
+                    pictures_metadata_dict[img_path] = chunk_metadata_dict[img_path]
+                else:
+                    pictures_metadata_dict[img_path] = {
+                        'creation_time': '', 'width': 0, 'height': 0, 'orientation': 1
+                    }
 
-        return creation_time
+        return pictures_metadata_dict
+
+    def identify_pictures(self, img_list):
+        _, imagemagick_program_path = self.check_imagemagick_available()
+
+        identify_format = 'kscenes:picture=%i\\n%[date:*]%[exif:*]\\nkscenes:size=%w,%h\\nkscenes:end\\n'
+        if sys.platform == 'darwin' or sys.platform == 'linux':
+            imagemagick_folder_path = self.read_imagemagick_folder_path()
+            imagemagick_identify_path = os.path.join(imagemagick_folder_path, 'identify')
+            commands = [imagemagick_identify_path, '-format', identify_format]
+        else:
+            commands = [imagemagick_program_path, 'identify', '-format', identify_format]
+        commands.extend(img_list)
+
+        hide_console = self.hide_console_status()
+        identify_process = subprocess.Popen(
+            commands, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, startupinfo=hide_console
+        )
+        identify_info, _ = identify_process.communicate()
+
+        img_set = set(img_list)
+        pictures_metadata_dict = dict()
+        img_path = None
+        exif_lines = list()
+        picture_size = (0, 0)
+        for line in identify_info.decode('utf-8', 'replace').splitlines():
+            if line.startswith('kscenes:picture='):
+                img_path = line[16:]
+                exif_lines = list()
+                picture_size = (0, 0)
+            elif line.startswith('kscenes:size='):
+                picture_size = line[13:].split(',')
+            elif line == 'kscenes:end':
+                # Only a complete block counts, and a multi-frame picture keeps its first frame
+                if img_path in img_set and img_path not in pictures_metadata_dict:
+                    pictures_metadata_dict[img_path] = self.read_picture_metadata(exif_lines, picture_size)
+                img_path = None
+            elif img_path is not None:
+                exif_lines.append(line)
+
+        return pictures_metadata_dict
+
+    def read_picture_metadata(self, exif_lines, picture_size):
+        orientation = 1
+        for line in exif_lines:
+            if line.startswith('exif:Orientation='):
+                orientation_value = line[17:].strip()
+                if orientation_value.isdigit():
+                    orientation = int(orientation_value)
+
+        try:
+            width = max(int(picture_size[0]), 0)
+            height = max(int(picture_size[1]), 0)
+        except (ValueError, IndexError):
+            width = 0
+            height = 0
+
+        picture_metadata = dict()
+        picture_metadata['creation_time'] = self.read_creation_time(exif_lines)
+        picture_metadata['width'] = width
+        picture_metadata['height'] = height
+        picture_metadata['orientation'] = orientation
+        return picture_metadata
 
     def convert_picture(self, img_path, target_path, resize_option, img_quality):
         _, imagemagick_program_path = self.check_imagemagick_available()
@@ -481,6 +752,90 @@ class ImageMagickHandler:
         else:
             return False
 
+    def convert_picture_tiers(self, img_path, tiers_list):
+        # tiers_list holds (target_path, resize_option) pairs, largest first; each tier is resized from the
+        # one written before it, so the picture is decoded once
+        _, imagemagick_program_path = self.check_imagemagick_available()
+        temp_tiers_list = self.read_temp_tiers(tiers_list)
+
+        commands = [imagemagick_program_path, img_path, '-auto-orient']
+        for temp_target, resize_option in temp_tiers_list[:-1]:
+            commands.extend(['-resize', resize_option, '-write', temp_target])
+        temp_target, resize_option = temp_tiers_list[-1]
+        if resize_option:
+            commands.extend(['-resize', resize_option])
+        commands.append(temp_target)
+
+        hide_console = self.hide_console_status()
+        convert_process = subprocess.Popen(commands, startupinfo=hide_console)
+        convert_process.communicate()
+
+        if convert_process.returncode == 0:
+            return self.replace_temp_tiers(tiers_list)
+        else:
+            self.remove_temp_tiers(tiers_list)
+            return False
+
+    @staticmethod
+    def read_temp_path(target_path):
+        # Like QtBackend.save_thumbnail, the cache file only appears once it is complete, so an interrupted
+        # convert is never taken as cached
+        return f'{target_path}.{os.getpid()}.{threading.get_ident()}.part'
+
+    def read_temp_tiers(self, tiers_list):
+        # The format is given in front of the temp name, as ImageMagick would otherwise take it from '.part'
+        temp_tiers_list = list()
+        for target_path, resize_option in tiers_list:
+            target_format = Commands.get_filetype(target_path)[1:]
+            temp_tiers_list.append((f'{target_format}:{self.read_temp_path(target_path)}', resize_option))
+        return temp_tiers_list
+
+    def replace_temp_tiers(self, tiers_list):
+        for target_path, _ in tiers_list:
+            temp_target_path = self.read_temp_path(target_path)
+            if not os.path.exists(temp_target_path) or os.path.getsize(temp_target_path) == 0:
+                self.remove_temp_tiers(tiers_list)
+                return False
+
+        for target_path, _ in tiers_list:
+            os.replace(self.read_temp_path(target_path), target_path)
+        return True
+
+    def remove_temp_tiers(self, tiers_list):
+        for target_path, _ in tiers_list:
+            temp_target_path = self.read_temp_path(target_path)
+            if os.path.exists(temp_target_path):
+                os.remove(temp_target_path)
+
+    def convert_pictures(self, pictures_list):
+        # pictures_list holds (img_path, tiers_list) pairs that are all converted by one ImageMagick process,
+        # so its coders and delegates are loaded once per chunk instead of once per picture
+        _, imagemagick_program_path = self.check_imagemagick_available()
+
+        commands = [imagemagick_program_path]
+        for img_path, tiers_list in pictures_list:
+            commands.extend([img_path, '-auto-orient'])
+            for temp_target, resize_option in self.read_temp_tiers(tiers_list):
+                if resize_option:
+                    commands.extend(['-resize', resize_option])
+                commands.extend(['-write', temp_target])
+            commands.extend(['-delete', '0--1'])
+        commands.append('null:')
+
+        hide_console = self.hide_console_status()
+        convert_process = subprocess.Popen(commands, startupinfo=hide_console)
+        convert_process.communicate()
+
+        # A picture that broke the chunk or was not written is converted on its own
+        converted_pictures_dict = dict()
+        for img_path, tiers_list in pictures_list:
+            if self.replace_temp_tiers(tiers_list):
+                converted_pictures_dict[img_path] = True
+            else:
+                converted_pictures_dict[img_path] = self.convert_picture_tiers(img_path, tiers_list)
+
+        return converted_pictures_dict
+
     def clip_picture(self, img_path, target_path, width, height, begin_x, begin_y):
         _, imagemagick_program_path = self.check_imagemagick_available()
 
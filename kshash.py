@@ -0,0 +1,63 @@
+import os
+import hashlib
+
+
+class FileHash:
+    buffer_size = 1048576
+    sample_size = 65536
+
+    def __init__(self):
+        super(FileHash, self).__init__()
+
+    @staticmethod
+    def create_hash(algorithm):
+        # blake2b hashes are 64 characters long, so a stored hash always tells which algorithm made it
+        if algorithm == 'blake2b':
+            return hashlib.blake2b(digest_size=32)
+        return hashlib.md5()
+
+    @staticmethod
+    def read_algorithm(file_hash):
+        if file_hash and len(file_hash) == 64:
+            return 'blake2b'
+        return 'md5'
+
+    @staticmethod
+    def read_hash(file_path, algorithm):
+        # The file is streamed through one reused buffer, so memory stays the same whatever its size
+        file_hash = FileHash.create_hash(algorithm)
+        read_buffer = bytearray(FileHash.buffer_size)
+        read_view = memoryview(read_buffer)
+        with open(file_path, 'rb', buffering=0) as hashed_file:
+            while True:
+                read_size = hashed_file.readinto(read_buffer)
+                if not read_size:
+                    break
+                file_hash.update(read_view[:read_size])
+        return file_hash.hexdigest()
+
+    @staticmethod
+    def read_quick_fingerprint(file_path):
+        # The size and samples from the head, middle and tail tell a changed file from an unchanged one
+        # without reading it all; small files are read whole
+        sample_size = FileHash.sample_size
+        file_fingerprint = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as hashed_file:
+            file_size = os.fstat(hashed_file.fileno()).st_size
+            file_fingerprint.update(str(file_size).encode())
+            if file_size <= sample_size * 3:
+                file_fingerprint.update(hashed_file.read())
+            else:
+                for sample_offset in [0, (file_size - sample_size) // 2, file_size - sample_size]:
+                    hashed_file.seek(sample_offset)
+                    file_fingerprint.update(hashed_file.read(sample_size))
+        return file_fingerprint.hexdigest()
+
+    @staticmethod
+    def compare_files(file_path, other_file_path):
+        # Full hashes are only read once the sizes and fingerprints agree
+        if os.path.getsize(file_path) != os.path.getsize(other_file_path):
+            return False
+        if FileHash.read_quick_fingerprint(file_path) != FileHash.read_quick_fingerprint(other_file_path):
+            return False
+        return FileHash.read_hash(file_path, 'md5') == FileHash.read_hash(other_file_path, 'md5')
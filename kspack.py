@@ -0,0 +1,208 @@
+import os
+import mmap
+import threading
+from threading import Thread, Lock
+
+from kshandler import Commands
+
+
+class ThumbnailPack:
+    # With the pack store the album's thumbnails are appended to a few large pack files instead of being
+    # kept one file each, and the catalog maps each cache name to its pack file's number, offset and length.
+    # Pack numbers are never reused, so an entry read before a compaction finds its pack file gone
+    # instead of reading another thumbnail
+    pack = None
+    pack_lock = Lock()
+    pack_file_size = 1073741824
+
+    def __init__(self):
+        super(ThumbnailPack, self).__init__()
+        # The pack is shared by the whole process, so each thread using it gets its own Commands
+        self.local_commands = threading.local()
+        self.cache_folder_path = self.commands.read_cache_folder_path()
+        self.pack_folder_path = os.path.join(self.cache_folder_path, 'pack')
+
+        self.write_lock = Lock()
+        self.maps_lock = Lock()
+        self.maps_dict = dict()
+
+        pack_numbers_list = self.read_pack_numbers()
+        if pack_numbers_list:
+            self.pack_number = pack_numbers_list[-1]
+        else:
+            self.pack_number = 0
+
+    @property
+    def commands(self):
+        commands = getattr(self.local_commands, 'commands', None)
+        if commands is None:
+            commands = Commands()
+            self.local_commands.commands = commands
+        return commands
+
+    @classmethod
+    def get_pack(cls):
+        with cls.pack_lock:
+            if cls.pack is None:
+                cls.pack = ThumbnailPack()
+        return cls.pack
+
+    @staticmethod
+    def check_pack_store():
+        return Commands().read_thumbnail_store() == 'pack'
+
+    def read_pack_path(self, pack_number):
+        return os.path.join(self.pack_folder_path, f'thumbnails.{pack_number}.pack')
+
+    def read_pack_numbers(self):
+        pack_numbers_list = list()
+        if not os.path.isdir(self.pack_folder_path):
+            return pack_numbers_list
+
+        with os.scandir(self.pack_folder_path) as temp:
+            for item in temp:
+                pack_name = item.name.split('.')
+                if len(pack_name) == 3 and pack_name[0] == 'thumbnails' and pack_name[2] == 'pack' \
+                        and pack_name[1].isdigit():
+                    pack_numbers_list.append(int(pack_name[1]))
+        return sorted(pack_numbers_list)
+
+    def read_entries(self, cached_names_list):
+        return self.commands.read_pack_entries(cached_names_list)
+
+    def read_packed_names(self):
+        return set(self.commands.read_all_pack_entries())
+
+    def add(self, img_cache_name, img_cache_path):
+        try:
+            with open(img_cache_path, 'rb') as cache_file:
+                img_data = cache_file.read()
+        except OSError:
+            return False
+        if not img_data:
+            return False
+
+        # The data is appended before its entry is saved, so an entry never points past the end of its pack
+        with self.write_lock:
+            os.makedirs(self.pack_folder_path, exist_ok=True)
+            with open(self.read_pack_path(self.pack_number), 'ab') as pack_file:
+                pack_offset = pack_file.tell()
+                pack_file.write(img_data)
+            self.commands.save_pack_entries([(img_cache_name, self.pack_number, pack_offset, len(img_data))])
+
+            if pack_offset + len(img_data) >= self.pack_file_size:
+                self.pack_number = self.pack_number + 1
+
+        try:
+            os.remove(img_cache_path)
+        except OSError:
+            pass
+        return True
+
+    def remove(self, cached_names_list):
+        # The space is given back by the next compaction; the write lock keeps a running compaction
+        # from saving an entry again after it has been removed
+        with self.write_lock:
+            self.commands.remove_pack_entries(cached_names_list)
+
+    def read_data(self, pack_entry):
+        pack_number, pack_offset, pack_length = pack_entry
+        with self.maps_lock:
+            pack_map = self.maps_dict.get(pack_number)
+            if pack_map is None or len(pack_map) < pack_offset + pack_length:
+                # A pack still being appended to is mapped again once it has grown past the old map
+                if pack_map is not None:
+                    pack_map.close()
+                    del self.maps_dict[pack_number]
+                pack_map = self.open_map(pack_number)
+                if pack_map is None:
+                    return b''
+                self.maps_dict[pack_number] = pack_map
+
+            if len(pack_map) < pack_offset + pack_length:
+                return b''
+            return pack_map[pack_offset:pack_offset + pack_length]
+
+    def open_map(self, pack_number):
+        try:
+            with open(self.read_pack_path(pack_number), 'rb') as pack_file:
+                return mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    def close_maps(self):
+        with self.maps_lock:
+            for pack_map in self.maps_dict.values():
+                pack_map.close()
+            self.maps_dict = dict()
+
+    def compact(self):
+        # Entries still in the catalog are copied into new pack files and the old files are removed,
+        # which gives back the space of removed thumbnails
+        with self.write_lock:
+            old_pack_numbers_list = self.read_pack_numbers()
+            if not old_pack_numbers_list:
+                return 0
+
+            pack_entries_dict = self.commands.read_all_pack_entries()
+
+            pack_number = old_pack_numbers_list[-1] + 1
+            pack_offset = 0
+            pack_file = None
+            new_entries_list = list()
+            try:
+                for img_cache_name, pack_entry in pack_entries_dict.items():
+                    img_data = self.read_data(pack_entry)
+                    if not img_data:
+                        continue
+
+                    if pack_file is None:
+                        pack_file = open(self.read_pack_path(pack_number), 'wb')
+                        pack_offset = 0
+                    pack_file.write(img_data)
+                    new_entries_list.append((img_cache_name, pack_number, pack_offset, len(img_data)))
+                    pack_offset = pack_offset + len(img_data)
+
+                    if pack_offset >= self.pack_file_size:
+                        pack_file.close()
+                        pack_file = None
+                        pack_number = pack_number + 1
+            finally:
+                if pack_file is not None:
+                    pack_file.close()
+
+            self.commands.save_pack_entries(new_entries_list)
+            new_cache_names_set = set(entry[0] for entry in new_entries_list)
+            self.commands.remove_pack_entries(
+                [img_cache_name for img_cache_name in pack_entries_dict if img_cache_name not in new_cache_names_set]
+            )
+            self.pack_number = pack_number
+
+            self.close_maps()
+            reclaimed_size = 0
+            for old_pack_number in old_pack_numbers_list:
+                old_pack_path = self.read_pack_path(old_pack_number)
+                try:
+                    reclaimed_size = reclaimed_size + os.path.getsize(old_pack_path)
+                    os.remove(old_pack_path)
+                except OSError:
+                    continue
+
+            for entry in new_entries_list:
+                reclaimed_size = reclaimed_size - entry[3]
+            return reclaimed_size
+
+    def start_pack_cache_files(self):
+        thread = Thread(target=self.pack_cache_files)
+        thread.daemon = True
+        thread.start()
+
+    def pack_cache_files(self):
+        # Thumbnails cached before the pack store was chosen are moved into it
+        _, _, _, pictures_cached_name_data = self.commands.read_pictures_data()
+        for img_cache_name in set(pictures_cached_name_data):
+            if not img_cache_name:
+                continue
+            img_cache_path = self.commands.read_cache_path(self.cache_folder_path, img_cache_name)
+            if os.path.exists(img_cache_path):
+                self.add(img_cache_name, img_cache_path)
@@ -0,0 +1,395 @@
+import struct
+
+from ksexif import ExifHeader, FileData
+
+
+class PictureHeader:
+    jpeg_sof_markers = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+
+    # HEIF rotates counterclockwise before mirroring; the EXIF orientation for each clockwise rotation
+    heif_orientation_dict = {
+        (0, False): 1, (90, False): 6, (180, False): 3, (270, False): 8,
+        (0, True): 2, (90, True): 5, (180, True): 4, (270, True): 7
+    }
+
+    def __init__(self):
+        super(PictureHeader, self).__init__()
+
+    @staticmethod
+    def read_header(img_path):
+        # Only the headers are read, so the size, orientation and capture date of a picture cost a few KB
+        header = dict()
+        try:
+            with open(img_path, 'rb') as img_file:
+                signature = img_file.read(16)
+                if signature[:2] == b'\xff\xd8':
+                    header = PictureHeader.read_jpeg_header(img_file)
+                elif signature[:8] == b'\x89PNG\r\n\x1a\n':
+                    header = PictureHeader.read_png_header(img_file)
+                elif signature[:4] in (b'II*\x00', b'MM\x00*'):
+                    header = PictureHeader.read_tiff_header(img_file)
+                elif signature[:4] == b'RIFF' and signature[8:12] == b'WEBP':
+                    header = PictureHeader.read_webp_header(img_file)
+                elif signature[4:8] == b'ftyp':
+                    header = PictureHeader.read_heif_header(img_file)
+        except (OSError, struct.error, IndexError, ValueError):
+            header = dict()
+
+        if 'orientation' not in header:
+            header['orientation'] = 1
+        return header
+
+    @staticmethod
+    def read_display_size(img_path):
+        header = PictureHeader.read_header(img_path)
+        if 'width' not in header:
+            return 0, 0
+
+        # Orientations 5 to 8 turn the picture by 90 degrees
+        if header['orientation'] in (5, 6, 7, 8):
+            return header['height'], header['width']
+        return header['width'], header['height']
+
+    @staticmethod
+    def read_exif_header(tiff_data):
+        header = dict()
+        if tiff_data[:6] == b'Exif\x00\x00':
+            tiff_data = tiff_data[6:]
+
+        try:
+            exif_data = ExifHeader.read_tiff_data(tiff_data)
+        except (struct.error, IndexError, ValueError):
+            return header
+
+        if exif_data.get('orientation') in range(1, 9):
+            header['orientation'] = exif_data['orientation']
+        if exif_data.get('date_time_original'):
+            header['date_time_original'] = exif_data['date_time_original']
+        return header
+
+    @staticmethod
+    def read_jpeg_header(img_file):
+        header = dict()
+        img_file.seek(2)
+        while True:
+            marker_data = img_file.read(2)
+            if len(marker_data) < 2 or marker_data[0] != 0xff:
+                break
+
+            marker = marker_data[1]
+            if marker == 0xff:
+                img_file.seek(-1, 1)
+                continue
+            if marker in (0xd9, 0xda):
+                break
+
+            segment_length = struct.unpack('>H', img_file.read(2))[0]
+            if marker in PictureHeader.jpeg_sof_markers:
+                # The frame header follows the EXIF segment, so nothing is left to read after it
+                img_height, img_width = struct.unpack('>xHH', img_file.read(5))
+                header['width'] = img_width
+                header['height'] = img_height
+                break
+            elif marker == 0xe1 and segment_length > 8:
+                # XMP also lives in APP1 and is skipped once its identifier has been seen
+                segment_id = img_file.read(6)
+                if segment_id == b'Exif\x00\x00':
+                    header.update(PictureHeader.read_exif_header(img_file.read(segment_length - 8)))
+                else:
+                    img_file.seek(segment_length - 8, 1)
+            else:
+                img_file.seek(segment_length - 2, 1)
+
+        return header
+
+    @staticmethod
+    def read_png_header(img_file):
+        header = dict()
+        img_file.seek(8)
+        while True:
+            chunk_header = img_file.read(8)
+            if len(chunk_header) < 8:
+                break
+
+            chunk_length, chunk_type = struct.unpack('>I4s', chunk_header)
+            if chunk_type == b'IHDR':
+                img_width, img_height = struct.unpack('>II', img_file.read(8))
+                header['width'] = img_width
+                header['height'] = img_height
+                img_file.seek(chunk_length - 8 + 4, 1)
+            elif chunk_type == b'eXIf':
+                header.update(PictureHeader.read_exif_header(img_file.read(chunk_length)))
+                img_file.seek(4, 1)
+            elif chunk_type in (b'IDAT', b'IEND'):
+                break
+            else:
+                img_file.seek(chunk_length + 4, 1)
+
+        return header
+
+    @staticmethod
+    def read_tiff_header(img_file):
+        header = dict()
+        exif_data = ExifHeader.read_tiff_data(FileData(img_file))
+        if 'width' in exif_data and not exif_data['reduced']:
+            header['width'] = exif_data['width']
+            header['height'] = exif_data['height']
+        if exif_data.get('orientation') in range(1, 9):
+            header['orientation'] = exif_data['orientation']
+        if exif_data.get('date_time_original'):
+            header['date_time_original'] = exif_data['date_time_original']
+        return header
+
+    @staticmethod
+    def read_webp_header(img_file):
+        header = dict()
+        img_file.seek(12)
+        while True:
+            chunk_header = img_file.read(8)
+            if len(chunk_header) < 8:
+                break
+
+            chunk_type, chunk_length = struct.unpack('<4sI', chunk_header)
+            chunk_data = b''
+            if chunk_type in (b'VP8 ', b'VP8L', b'VP8X'):
+                chunk_data = img_file.read(min(chunk_length, 30))
+            elif chunk_type == b'EXIF':
+                chunk_data = img_file.read(chunk_length)
+
+            if chunk_type == b'VP8X':
+                img_width = int.from_bytes(chunk_data[4:7], 'little') + 1
+                img_height = int.from_bytes(chunk_data[7:10], 'little') + 1
+                header['width'] = img_width
+                header['height'] = img_height
+                if not chunk_data[0] & 0x08:
+                    break
+            elif chunk_type == b'VP8 ':
+                img_width, img_height = struct.unpack('<HH', chunk_data[6:10])
+                header['width'] = img_width & 0x3fff
+                header['height'] = img_height & 0x3fff
+                break
+            elif chunk_type == b'VP8L':
+                size_bits = struct.unpack('<I', chunk_data[1:5])[0]
+                header['width'] = (size_bits & 0x3fff) + 1
+                header['height'] = ((size_bits >> 14) & 0x3fff) + 1
+                break
+            elif chunk_type == b'EXIF':
+                header.update(PictureHeader.read_exif_header(chunk_data))
+                break
+
+            # Chunks are padded to an even length
+            img_file.seek(chunk_length + chunk_length % 2 - len(chunk_data), 1)
+
+        return header
+
+    @staticmethod
+    def read_boxes(data, start, end):
+        boxes_list = list()
+        offset = start
+        while offset + 8 <= end:
+            box_size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+            header_size = 8
+            if box_size == 1:
+                box_size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+                header_size = 16
+            elif box_size == 0:
+                box_size = end - offset
+            if box_size < header_size:
+                break
+
+            boxes_list.append((box_type, offset + header_size, min(offset + box_size, end)))
+            offset = offset + box_size
+        return boxes_list
+
+    @staticmethod
+    def read_heif_header(img_file):
+        header = dict()
+        img_file.seek(0, 2)
+        file_size = img_file.tell()
+
+        # Top-level boxes are only looked at until the meta box; mdat is skipped without being read
+        meta_data = b''
+        offset = 0
+        while offset + 8 <= file_size:
+            img_file.seek(offset)
+            box_size, box_type = struct.unpack('>I4s', img_file.read(8))
+            header_size = 8
+            if box_size == 1:
+                box_size = struct.unpack('>Q', img_file.read(8))[0]
+                header_size = 16
+            elif box_size == 0:
+                box_size = file_size - offset
+            if box_size < header_size:
+                break
+
+            if box_type == b'meta':
+                if box_size <= 4194304:
+                    meta_data = img_file.read(box_size - header_size)
+                break
+            offset = offset + box_size
+
+        if not meta_data:
+            return header
+
+        primary_item_id = int()
+        exif_item_id = None
+        item_locations_dict = dict()
+        properties_list = list()
+        associations_dict = dict()
+
+        # meta is a full box, so its children start after the version and flags
+        for box_type, box_start, box_end in PictureHeader.read_boxes(meta_data, 4, len(meta_data)):
+            version = meta_data[box_start]
+            if box_type == b'pitm':
+                if version == 0:
+                    primary_item_id = struct.unpack('>H', meta_data[box_start + 4:box_start + 6])[0]
+                else:
+                    primary_item_id = struct.unpack('>I', meta_data[box_start + 4:box_start + 8])[0]
+            elif box_type == b'iinf':
+                exif_item_id = PictureHeader.read_heif_exif_item_id(meta_data, box_start, box_end)
+            elif box_type == b'iloc':
+                item_locations_dict = PictureHeader.read_heif_item_locations(meta_data, box_start)
+            elif box_type == b'iprp':
+                for child_type, child_start, child_end in PictureHeader.read_boxes(meta_data, box_start, box_end):
+                    if child_type == b'ipco':
+                        properties_list = PictureHeader.read_boxes(meta_data, child_start, child_end)
+                    elif child_type == b'ipma':
+                        associations_dict = PictureHeader.read_heif_associations(meta_data, child_start)
+
+        rotation = 0
+        mirrored = False
+        for property_index in associations_dict.get(primary_item_id, list()):
+            if not 0 < property_index <= len(properties_list):
+                continue
+
+            property_type, property_start, _ = properties_list[property_index - 1]
+            if property_type == b'ispe':
+                img_width, img_height = struct.unpack('>II', meta_data[property_start + 4:property_start + 12])
+                header['width'] = img_width
+                header['height'] = img_height
+            elif property_type == b'irot':
+                rotation = (4 - (meta_data[property_start] & 0x03)) % 4 * 90
+            elif property_type == b'imir':
+                if meta_data[property_start] & 0x01:
+                    # A flip about the horizontal axis is a half turn and a flip about the vertical axis
+                    rotation = (rotation + 180) % 360
+                mirrored = True
+
+        # decoders apply irot and imir themselves; the orientation in the EXIF item does not count for HEIF
+        header['orientation'] = PictureHeader.heif_orientation_dict[(rotation, mirrored)]
+
+        if exif_item_id in item_locations_dict:
+            exif_offset, exif_length = item_locations_dict[exif_item_id]
+            if 4 < exif_length <= 1048576:
+                img_file.seek(exif_offset)
+                exif_data = img_file.read(exif_length)
+                tiff_header_offset = struct.unpack('>I', exif_data[:4])[0]
+                exif_header = PictureHeader.read_exif_header(exif_data[4 + tiff_header_offset:])
+                if 'date_time_original' in exif_header:
+                    header['date_time_original'] = exif_header['date_time_original']
+
+        return header
+
+    @staticmethod
+    def read_heif_exif_item_id(meta_data, box_start, box_end):
+        version = meta_data[box_start]
+        if version == 0:
+            entries_start = box_start + 6
+        else:
+            entries_start = box_start + 8
+
+        for box_type, entry_start, _ in PictureHeader.read_boxes(meta_data, entries_start, box_end):
+            if box_type != b'infe':
+                continue
+
+            entry_version = meta_data[entry_start]
+            if entry_version == 2:
+                item_id, item_type = struct.unpack('>H2x4s', meta_data[entry_start + 4:entry_start + 12])
+            elif entry_version == 3:
+                item_id, item_type = struct.unpack('>I2x4s', meta_data[entry_start + 4:entry_start + 14])
+            else:
+                continue
+
+            if item_type == b'Exif':
+                return item_id
+        return None
+
+    @staticmethod
+    def read_heif_item_locations(meta_data, box_start):
+        item_locations_dict = dict()
+        version = meta_data[box_start]
+        offset_size = meta_data[box_start + 4] >> 4
+        length_size = meta_data[box_start + 4] & 0x0f
+        base_offset_size = meta_data[box_start + 5] >> 4
+        index_size = 0
+        if version in (1, 2):
+            index_size = meta_data[box_start + 5] & 0x0f
+
+        offset = box_start + 6
+        id_size = 2 if version < 2 else 4
+        items_number = int.from_bytes(meta_data[offset:offset + id_size], 'big')
+        offset = offset + id_size
+
+        for n in range(items_number):
+            item_id = int.from_bytes(meta_data[offset:offset + id_size], 'big')
+            offset = offset + id_size
+            construction_method = 0
+            if version in (1, 2):
+                construction_method = int.from_bytes(meta_data[offset:offset + 2], 'big') & 0x0f
+                offset = offset + 2
+
+            offset = offset + 2
+            base_offset = int.from_bytes(meta_data[offset:offset + base_offset_size], 'big')
+            offset = offset + base_offset_size
+            extents_number = int.from_bytes(meta_data[offset:offset + 2], 'big')
+            offset = offset + 2
+
+            extents_list = list()
+            for m in range(extents_number):
+                offset = offset + index_size
+                extent_offset = int.from_bytes(meta_data[offset:offset + offset_size], 'big')
+                offset = offset + offset_size
+                extent_length = int.from_bytes(meta_data[offset:offset + length_size], 'big')
+                offset = offset + length_size
+                extents_list.append((base_offset + extent_offset, extent_length))
+
+            # Only items stored in one piece in the file itself are read
+            if construction_method == 0 and len(extents_list) == 1:
+                item_locations_dict[item_id] = extents_list[0]
+
+        return item_locations_dict
+
+    @staticmethod
+    def read_heif_associations(meta_data, box_start):
+        associations_dict = dict()
+        version = meta_data[box_start]
+        large_index = meta_data[box_start + 3] & 0x01
+
+        offset = box_start + 4
+        entries_number = struct.unpack('>I', meta_data[offset:offset + 4])[0]
+        offset = offset + 4
+
+        for n in range(entries_number):
+            if version < 1:
+                item_id = struct.unpack('>H', meta_data[offset:offset + 2])[0]
+                offset = offset + 2
+            else:
+                item_id = struct.unpack('>I', meta_data[offset:offset + 4])[0]
+                offset = offset + 4
+
+            associations_number = meta_data[offset]
+            offset = offset + 1
+
+            property_indexes_list = list()
+            for m in range(associations_number):
+                if large_index:
+                    property_index = struct.unpack('>H', meta_data[offset:offset + 2])[0] & 0x7fff
+                    offset = offset + 2
+                else:
+                    property_index = meta_data[offset] & 0x7f
+                    offset = offset + 1
+                property_indexes_list.append(property_index)
+
+            associations_dict[item_id] = property_indexes_list
+
+        return associations_dict
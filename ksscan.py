@@ -1,33 +1,28 @@
 import os
+import time
 from threading import Thread
-from queue import Queue as queue_Queue
 from multiprocessing import Process, Queue
 
 
 class MultiprocessingFolderScan:
     def __init__(self):
         super(MultiprocessingFolderScan, self).__init__()
+        self.batch_size = 500
+
+        # known_folders_dict maps a folder to (mtime_ns, subdirectories_list, files_stat_dict) from the last scan;
+        # scanned_folders_dict collects (parent_folder, mtime_ns, files_number) of every folder of this scan
+        self.known_folders_dict = dict()
+        self.scanned_folders_dict = dict()
 
     def prepare(
             self, folder_path, filetypes, threads_number,
-            total_result_signal, images_included_subdirectories_signal
+            total_result_signal, images_included_subdirectories_signal, batch_result_signal
     ):
-        subdirectories_path_list = list()
-        other_files_list = list()
-
-        with os.scandir(folder_path) as temp:
-            for item in temp:
-                item_path = item.path
-                if os.path.isdir(item_path):
-                    subdirectories_path_list.append(item_path)
-                elif os.path.isfile(item_path):
-                    other_files_list.append(item_path)
-
         thread = Thread(
             target=self.handle_folder,
             args=(
-                subdirectories_path_list, other_files_list, threads_number, filetypes,
-                total_result_signal, images_included_subdirectories_signal
+                folder_path, threads_number, filetypes,
+                total_result_signal, images_included_subdirectories_signal, batch_result_signal
             )
         )
         thread.daemon = True
@@ -35,169 +30,159 @@ class MultiprocessingFolderScan:
 
     def handle_folder(
             self,
-            subdirectories_list, other_files_list, threads_number, filetypes,
-            total_result_signal, images_included_subdirectories_signal
+            folder_path, threads_number, filetypes,
+            total_result_signal, images_included_subdirectories_signal, batch_result_signal
     ):
+        folder_path = os.path.normpath(folder_path)
+        if threads_number < 1:
+            threads_number = 1
+
+        # Every worker pulls directories from one shared queue and the subdirectories it finds are queued back,
+        # so a worker that runs out of work takes over pending directories at any depth of the tree
+        pending_folders_signal = Queue()
+        folder_result_signal = Queue()
+
+        process = dict()
+        for n in range(threads_number):
+            process[n] = Process(
+                target=self.scan_process,
+                args=(filetypes, pending_folders_signal, folder_result_signal)
+            )
+            process[n].daemon = True
+            process[n].start()
+
+        scan_start_time_ns = time.time_ns()
+
+        pending_folders_signal.put((folder_path, self.read_known_folder_mtime(folder_path)))
+        pending_folders_number = 1
+
         scanned_files_list = list()
-        subdirectories_list_number = len(subdirectories_list)
-
-        if subdirectories_list_number == 0:
-            if images_included_subdirectories_signal:
-                images_included_subdirectories_signal.put([])
-
-        if subdirectories_list_number > 0:
-            if subdirectories_list_number < threads_number:
-                threads_number = subdirectories_list_number
-
-            average_subdirectories_number = int(subdirectories_list_number / threads_number)
-
-            pending_folders_list = dict()
-
-            for n in range(threads_number):
-                start = n * average_subdirectories_number
-                stop = start + average_subdirectories_number
-
-                if n == threads_number - 1:
-                    pending_folders_list[n] = subdirectories_list[start:]
-                else:
-                    pending_folders_list[n] = subdirectories_list[start:stop]
-
-            process = dict()
-            scan_result_signal = dict()
-            images_included_folders_signal = dict()
-            folders_scanned_files_list = dict()
-            images_included_folders_list = dict()
-
-            images_included_subdirectories_result = list()
-
-            for n in range(threads_number):
-                scan_result_signal[n] = Queue()
-                images_included_folders_signal[n] = Queue()
-                process[n] = Process(
-                    target=self.scan_process,
-                    args=(pending_folders_list[n], filetypes, scan_result_signal[n], images_included_folders_signal[n])
-                )
-                process[n].daemon = True
-                process[n].start()
-
-            for n in range(threads_number):
-                folders_scanned_files_list[n] = scan_result_signal[n].get()
-                scanned_files_list = scanned_files_list + folders_scanned_files_list[n]
-                images_included_folders_list[n] = images_included_folders_signal[n].get()
-                images_included_subdirectories_result = \
-                    images_included_subdirectories_result + images_included_folders_list[n]
-
-            if images_included_subdirectories_signal:
-                images_included_subdirectories_signal.put(images_included_subdirectories_result)
-
-        other_scanned_files_list = self.scan_other_files(other_files_list, filetypes)
-        scanned_files_list = scanned_files_list + other_scanned_files_list
+        scanned_files_stat_dict = dict()
+        images_included_subdirectories_set = set()
+        batch_files_stat_dict = dict()
+
+        while pending_folders_number > 0:
+            folder, folder_mtime_ns, folder_files_list, folder_files_stat_dict, subdirectories_list = \
+                folder_result_signal.get()
+
+            if folder_files_list is None:
+                # The folder has not changed since the last scan, so its entries are taken from the catalog
+                _, subdirectories_list, folder_files_stat_dict = self.known_folders_dict[folder]
+                folder_files_list = list(folder_files_stat_dict)
+
+            pending_folders_number = pending_folders_number - 1 + len(subdirectories_list)
+            for subdirectory in subdirectories_list:
+                pending_folders_signal.put((subdirectory, self.read_known_folder_mtime(subdirectory)))
+
+            # A folder changed within the last two seconds may change again without a new mtime,
+            # so it is stored without one and read again next time
+            if folder_mtime_ns is None or folder_mtime_ns > scan_start_time_ns - 2000000000:
+                folder_mtime_ns = 0
+            self.scanned_folders_dict[folder] = (os.path.dirname(folder), folder_mtime_ns, len(folder_files_list))
+
+            if folder_files_list:
+                scanned_files_list.extend(folder_files_list)
+                scanned_files_stat_dict.update(folder_files_stat_dict)
+
+                if folder != folder_path:
+                    top_subdirectory_name = os.path.relpath(folder, folder_path).split(os.sep)[0]
+                    images_included_subdirectories_set.add(os.path.join(folder_path, top_subdirectory_name))
+
+                if batch_result_signal:
+                    batch_files_stat_dict.update(folder_files_stat_dict)
+
+            # A batch is handed over once it is full or whenever the workers have nothing ready,
+            # so the first files reach the caller long before the walk ends
+            if batch_files_stat_dict and (
+                    len(batch_files_stat_dict) >= self.batch_size or folder_result_signal.empty()
+                    or pending_folders_number == 0
+            ):
+                batch_result_signal.put(batch_files_stat_dict)
+                batch_files_stat_dict = dict()
+
+        for n in range(threads_number):
+            pending_folders_signal.put(None)
+
+        if batch_result_signal:
+            batch_result_signal.put('The folder has been scanned.')
+
+        if images_included_subdirectories_signal:
+            images_included_subdirectories_signal.put(sorted(images_included_subdirectories_set))
+
         scanned_files_number = len(scanned_files_list)
         scan_result = list()
         scan_result.append(scanned_files_list)
         scan_result.append(scanned_files_number)
+        scan_result.append(scanned_files_stat_dict)
         if total_result_signal:
             total_result_signal.put(scan_result)
 
     @staticmethod
-    def scan_process(pending_folders_list_part, filetypes, scan_result_signal, images_included_folders_signal):
-        folders_scanned_files_list = list()
-        images_included_folders_list = list()
-        for folder in pending_folders_list_part:
-            folder_result_signal = queue_Queue()
-            scan_folder = ScanFolder()
-            scan_folder.start(folder, filetypes, folder_result_signal)
-            folder_result = folder_result_signal.get()
-            scanned_files_list = folder_result[1]
-            folders_scanned_files_list = folders_scanned_files_list + scanned_files_list
-            scanned_files_number = len(scanned_files_list)
-            if scanned_files_number > 0:
-                images_included_folders_list.append(folder)
-
-        scan_result_signal.put(folders_scanned_files_list)
-        images_included_folders_signal.put(images_included_folders_list)
-
-    def scan_other_files(self, files_list, filetypes):
-        scanned_files_list = list()
-        for file_path in files_list:
-            if filetypes:
-                filetype = self.get_filetype(file_path)
-                if filetype in filetypes:
-                    scanned_files_list.append(file_path)
-            else:
-                scanned_files_list.append(file_path)
-
-        return scanned_files_list
+    def scan_process(filetypes, pending_folders_signal, folder_result_signal):
+        filetypes = set(filetypes)
+        while True:
+            pending_folder = pending_folders_signal.get()
+            if pending_folder is None:
+                break
+
+            folder, known_folder_mtime_ns = pending_folder
+            try:
+                folder_mtime_ns = os.stat(folder).st_mtime_ns
+            except OSError:
+                folder_mtime_ns = None
+
+            if known_folder_mtime_ns and folder_mtime_ns == known_folder_mtime_ns:
+                folder_result_signal.put((folder, folder_mtime_ns, None, None, None))
+                continue
+
+            folder_files_list, folder_files_stat_dict, subdirectories_list = \
+                MultiprocessingFolderScan.scan_single_folder(folder, filetypes)
+
+            folder_result_signal.put(
+                (folder, folder_mtime_ns, folder_files_list, folder_files_stat_dict, subdirectories_list)
+            )
 
-    @staticmethod
-    def get_filetype(file_path):
-        basename = os.path.basename(file_path)
-        if '.' not in basename:
-            filetype = 'unknown'
+    def read_known_folder_mtime(self, folder):
+        if folder in self.known_folders_dict:
+            known_folder_mtime_ns = self.known_folders_dict[folder][0]
         else:
-            basename = basename.split('.')
-            filetype = f'.{basename[-1]}'
-        return filetype
-
-
-class ScanFolder:
-    def __init__(self):
-        super(ScanFolder, self).__init__()
-        self.top_folder = str()
-        self.items_list = list()
-        self.scanned_folders_list = list()
-        self.scanned_files_list = list()
-        self.forbidden_folders_list = list()
+            known_folder_mtime_ns = None
+        return known_folder_mtime_ns
 
-    def start(self, folder, filetypes, folder_result_signal):
-        self.top_folder = folder
+    @staticmethod
+    def scan_single_folder(folder, filetypes):
+        folder_files_list = list()
+        folder_files_stat_dict = dict()
+        subdirectories_list = list()
 
-        thread = Thread(target=self.scan, args=(folder, filetypes))
-        thread.daemon = True
-        thread.start()
+        try:
+            with os.scandir(folder) as temp:
+                for item in temp:
+                    try:
+                        if item.is_file():
+                            if filetypes and MultiprocessingFolderScan.get_filetype(item.name) not in filetypes:
+                                continue
 
-        thread.join()
+                            item_path = os.path.normpath(item.path)
+                            folder_files_stat_dict[item_path] = MultiprocessingFolderScan.read_file_signature(item)
+                            folder_files_list.append(item_path)
 
-        scanfolder_result = list()
-        scanfolder_result.append(self.top_folder)
-        scanfolder_result.append(self.scanned_files_list)
+                        elif item.is_dir():
+                            subdirectories_list.append(os.path.normpath(item.path))
+                    except OSError:
+                        continue
 
-        folder_result_signal.put(scanfolder_result)
+        except OSError:
+            pass
 
-        self.top_folder = ''
-        self.items_list = []
-        self.scanned_folders_list = []
-        self.scanned_files_list = []
-        self.forbidden_folders_list = []
+        return folder_files_list, folder_files_stat_dict, subdirectories_list
 
-    def scan(self, folder, filetypes):
-        folder = os.path.normpath(folder)
-        pending_scan_list = list()
-        try:
-            with os.scandir(folder) as temp:
-                for item in temp:
-                    item_path = item.path
-                    item_path = os.path.normpath(item_path)
-                    self.items_list.append(item_path)
-
-                    if os.path.isfile(item_path):
-                        if filetypes:
-                            filetype = self.get_filetype(item_path)
-                            if filetype in filetypes:
-                                self.scanned_files_list.append(item_path)
-                        else:
-                            self.scanned_files_list.append(item_path)
-
-                    elif os.path.isdir(item_path):
-                        pending_scan_list.append(item_path)
-
-        except PermissionError:
-            self.forbidden_folders_list.append(folder)
-        else:
-            self.scanned_folders_list.append(folder)
-        finally:
-            for folder in pending_scan_list:
-                self.scan(folder, filetypes)
+    @staticmethod
+    def read_file_signature(entry):
+        # DirEntry caches its stat result, so the signature costs at most one stat per file
+        entry_stat = entry.stat()
+        file_signature = (entry_stat.st_size, entry_stat.st_mtime_ns, entry.inode(), entry_stat.st_dev)
+        return file_signature
 
     @staticmethod
     def get_filetype(file_path):
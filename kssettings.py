@@ -4,10 +4,12 @@ import webbrowser
 from PySide6.QtCore import Qt, Signal
 from PySide6.QtGui import QFont, QIcon
 from PySide6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QProgressBar, QPushButton, QComboBox, QLabel,
-                               QFileDialog, QStyle)
+                               QFileDialog, QStyle, QCheckBox)
 
 from kshandler import Commands, ImageMagickHandler
-from ksfeatures import SettingsScanFolder, CleanDatabaseAndCache
+from ksfeatures import SettingsScanFolder, CleanDatabaseAndCache, WatchPicturesFolder
+from kscache import CacheEvictor
+from kspack import ThumbnailPack
 from ksdialogs import MessageDialog
 
 
@@ -28,6 +30,7 @@ class Settings(QWidget):
 
         self.message_dialog = None
         self.folder_path_dialog_status = False
+        self.watch_pictures_folder = None
 
         # Layouts
         if os.name == 'nt':
@@ -81,6 +84,54 @@ class Settings(QWidget):
         self.folder_layout.addWidget(self.folder_path_dialog_button)
         self.folder_path_dialog_button.clicked.connect(self.folder_path_dialog)
 
+        # Watch default folder
+        self.watch_folder_option = QCheckBox('Watch default folder for changes')
+        self.watch_folder_option.setToolTip(
+            'Index and cache added, moved and removed pictures while kScenes is running.'
+        )
+        self.watch_folder_option.setChecked(self.commands.read_watch_pictures_folder() == 'on')
+        self.folder_layout.addWidget(self.watch_folder_option)
+        self.watch_folder_option.toggled.connect(self.save_watch_folder_value)
+
+        # Limit the size of cache folder
+        self.cache_size_limit_layout = QHBoxLayout()
+        self.cache_size_limit_layout.setAlignment(Qt.AlignLeft)
+        self.folder_layout.addLayout(self.cache_size_limit_layout)
+
+        self.cache_size_limit_label = QLabel('Cache size limit')
+        self.cache_size_limit_label.setToolTip(
+            'Cache files shown least recently are removed when the cache folder is larger than the limit.\n'
+            'They are made again when their pictures are shown.'
+        )
+        self.cache_size_limit_layout.addWidget(self.cache_size_limit_label)
+
+        self.cache_size_limit_option = QComboBox()
+        self.cache_size_limit_option.setFixedWidth(90)
+        self.cache_size_limit_layout.addWidget(self.cache_size_limit_option)
+
+        self.cache_size_limit_dict = {
+            'No limit': 0, '500 MB': 500, '1 GB': 1024, '2 GB': 2048, '5 GB': 5120, '10 GB': 10240, '20 GB': 20480
+        }
+        self.cache_size_limit_option.addItems(list(self.cache_size_limit_dict))
+        self.cache_size_limit_option.setEditable(False)
+
+        saved_cache_size_limit = self.commands.read_cache_size_limit()
+        for cache_size_limit_text, cache_size_limit in self.cache_size_limit_dict.items():
+            if cache_size_limit == saved_cache_size_limit:
+                self.cache_size_limit_option.setCurrentText(cache_size_limit_text)
+
+        self.cache_size_limit_option.activated.connect(self.save_cache_size_limit_value)
+
+        # Keep album's thumbnails in pack files
+        self.thumbnail_pack_option = QCheckBox('Pack album\'s thumbnails into large files')
+        self.thumbnail_pack_option.setToolTip(
+            'Thumbnails are kept in a few large files instead of one file each,\n'
+            'which is faster to read and easier to back up and copy.'
+        )
+        self.thumbnail_pack_option.setChecked(self.commands.read_thumbnail_store() == 'pack')
+        self.folder_layout.addWidget(self.thumbnail_pack_option)
+        self.thumbnail_pack_option.toggled.connect(self.save_thumbnail_store_value)
+
         # Cache default folder
         # Set multiprocessing number
         self.cache_threads_option_label = QLabel('Caching Option')
@@ -126,7 +177,7 @@ class Settings(QWidget):
         self.start_caching_button.setToolTip('Start scanning and caching')
         self.start_caching_button.setFixedSize(30, 30)
         self.cache_buttons_layout.addWidget(self.start_caching_button)
-        self.start_caching_button.clicked.connect(self.start_caching)
+        self.start_caching_button.clicked.connect(lambda: self.start_caching(True))
 
         # Clean index data and cache files
         self.clean_database_and_cache_button = QPushButton()
@@ -181,13 +232,53 @@ class Settings(QWidget):
             else:
                 self.notice_label.setText('')
 
-        # Scan default folder when the app starts
-        self.start_caching()
+        # Scan default folder when the app starts; folders whose mtime is unchanged are taken from the catalog
+        self.start_watching()
+        self.start_caching(False)
 
     def save_cache_threads_value(self):
         cache_threads_number = self.cache_threads_option.currentText()
         self.commands.save_cache_threads_number(cache_threads_number)
 
+    def save_cache_size_limit_value(self):
+        cache_size_limit = self.cache_size_limit_dict[self.cache_size_limit_option.currentText()]
+        self.commands.save_cache_size_limit(cache_size_limit)
+        CacheEvictor().start_evict()
+
+    def save_thumbnail_store_value(self, checked):
+        if checked:
+            self.commands.save_thumbnail_store('pack')
+            ThumbnailPack.get_pack().start_pack_cache_files()
+        else:
+            self.commands.save_thumbnail_store('files')
+
+    def save_watch_folder_value(self, checked):
+        if checked:
+            self.commands.save_watch_pictures_folder('on')
+        else:
+            self.commands.save_watch_pictures_folder('off')
+        self.start_watching()
+
+    def start_watching(self):
+        if self.watch_pictures_folder is not None:
+            self.watch_pictures_folder.stop()
+            self.watch_pictures_folder = None
+
+        if self.commands.read_watch_pictures_folder() != 'on' or not os.path.isdir(self.pictures_folder_path):
+            return
+
+        self.watch_pictures_folder = WatchPicturesFolder(self.pictures_folder_path)
+        self.watch_pictures_folder.pictures_changes_result_signal.connect(self.watcher_changes_result)
+        self.watch_pictures_folder.watch_notice_signal.connect(self.watcher_notice)
+
+    def pause_watching(self):
+        if self.watch_pictures_folder is not None:
+            self.watch_pictures_folder.pause()
+
+    def resume_watching(self):
+        if self.watch_pictures_folder is not None:
+            self.watch_pictures_folder.resume()
+
     def folder_path_dialog(self):
         self.folder_path_dialog_status = True
 
@@ -203,19 +294,20 @@ class Settings(QWidget):
             folder_path = os.path.normpath(folder_path)
             self.commands.save_pictures_folder_path(folder_path)
             self.pictures_folder_path = folder_path
+            self.start_watching()
             self.scan_folder(folder_path)
 
     def stop_caching(self):
         with open(self.stop_caching_signal, 'w') as temp:
             temp.write('')
 
-    def start_caching(self):
+    def start_caching(self, force_rescan):
         if os.path.exists(self.stop_caching_signal):
             os.remove(self.stop_caching_signal)
 
-        self.scan_folder(self.pictures_folder_path)
+        self.scan_folder(self.pictures_folder_path, force_rescan)
 
-    def scan_folder(self, folder_path):
+    def scan_folder(self, folder_path, force_rescan=True):
         if not os.path.exists(self.pictures_folder_path):
             self.info_label.setText(
                 f'Default pictures folder {self.pictures_folder_path} does not exist.\n'
@@ -226,12 +318,13 @@ class Settings(QWidget):
         self.folder_path_dialog_button.setDisabled(True)
         self.start_caching_button.setDisabled(True)
         self.clean_database_and_cache_button.setDisabled(True)
+        self.pause_watching()
         
         self.scan_progressbar.show()
         self.scan_progressbar.setMinimum(0)
         self.scan_progressbar.setMaximum(0)
 
-        settings_scan_folder_thread = SettingsScanFolder(folder_path)
+        settings_scan_folder_thread = SettingsScanFolder(folder_path, force_rescan)
         settings_scan_folder_thread.scan_result_signal.connect(self.scan_result)
         settings_scan_folder_thread.nochange_signal.connect(self.pictures_nochange)
         settings_scan_folder_thread.pictures_changes_result_signal.connect(self.pictures_changes_result)
@@ -246,18 +339,37 @@ class Settings(QWidget):
 
     def pictures_nochange(self):
         self.changes_info_label.setText(f'There is no change.')
+        self.resume_watching()
         self.folder_path_dialog_button.setDisabled(False)
         self.start_caching_button.setDisabled(False)
         self.clean_database_and_cache_button.setDisabled(False)
 
     def pictures_changes_result(self, removed_number, moved_number, added_number):
+        self.changes_info_label.setText(self.read_changes_info(removed_number, moved_number, added_number))
+
+        self.folder_path_dialog_button.setDisabled(False)
+        self.clean_database_and_cache_button.setDisabled(False)
+        self.resume_watching()
+
+    def watcher_changes_result(self, removed_number, moved_number, added_number):
+        # A watcher job only reports; the buttons and the watcher belong to the scan or clean-up in progress
+        self.changes_info_label.setText(self.read_changes_info(removed_number, moved_number, added_number))
+
+    def watcher_notice(self, notice):
+        # Kept below the ImageMagick notice, if there is one
+        notice_text = self.notice_label.text()
+        if notice_text:
+            notice = f'{notice_text}\n{notice}'
+        self.notice_label.setText(notice)
+
+    @staticmethod
+    def read_changes_info(removed_number, moved_number, added_number):
         added_number_info = f'There are {added_number} newly added images.\n'
         moved_number_info = f'Positional changes of {moved_number} images are found.\n'
         removed_number_info = f'{removed_number} images have been removed from the folder.'
 
         if added_number == 0:
             added_number_info = ''
-            self.folder_path_dialog_button.setDisabled(False)
         if moved_number == 0:
             moved_number_info = ''
         if removed_number == 0:
@@ -270,12 +382,7 @@ class Settings(QWidget):
         if removed_number == 1:
             removed_number_info = 'An image has been removed from the folder.'
 
-        self.changes_info_label.setText(f'{added_number_info}'
-                                        f'{moved_number_info}'
-                                        f'{removed_number_info}')
-
-        self.folder_path_dialog_button.setDisabled(False)
-        self.clean_database_and_cache_button.setDisabled(False)
+        return f'{added_number_info}{moved_number_info}{removed_number_info}'
 
     def cachepictures_progress(self, src_path, handled_percents):
         self.stop_caching_button.setDisabled(False)
@@ -302,6 +409,7 @@ class Settings(QWidget):
         self.folder_path_dialog_button.setDisabled(True)
         self.start_caching_button.setDisabled(True)
         self.clean_database_and_cache_button.setDisabled(True)
+        self.pause_watching()
 
         clean_database_and_cache_thread = CleanDatabaseAndCache()
         clean_database_and_cache_thread.clean_database_and_cache_result_signal.connect(
@@ -339,6 +447,7 @@ class Settings(QWidget):
         self.folder_path_dialog_button.setDisabled(False)
         self.start_caching_button.setDisabled(False)
         self.clean_database_and_cache_button.setDisabled(False)
+        self.resume_watching()
 
     def changeEvent(self, event):
         if not self.isActiveWindow() and not self.folder_path_dialog_status:
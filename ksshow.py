@@ -1,14 +1,19 @@
 import os
-from PySide6.QtCore import Qt
+import math
+from PySide6.QtCore import Qt, QTimer, QPoint, QSize
 from PySide6.QtWidgets import (QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QProgressBar, QComboBox, QLabel,
                                QScrollArea, QFileDialog, QMenu, QFrame)
-from PySide6.QtGui import QPixmap, QAction, QCursor, QIcon
+from PySide6.QtGui import QPixmap, QAction, QCursor, QIcon, QColor, QImageReader
 
 from kshandler import Commands, ImageMagickHandler
 from ksfeatures import PictureLabel, SaveAs, OpenFolder, ReadSubdirectories, ImportImages, ExportPDF
 from ksdialogs import MessageDialog, YesNoDialog, ExifDialog, SaveSizeDialog, MakePDFDialog
 from ksshowpicture import ShowPicture
 from ksviewer import ImgView
+from ksprobe import PictureHeader
+from kscache import PendingPictures
+from ksthumbnail import ThumbnailRequests, ThumbnailTiers
+from kspack import ThumbnailPack
 
 
 class Show(QWidget):
@@ -99,6 +104,7 @@ class Show(QWidget):
         self.scroll_area.setFrameShape(QFrame.NoFrame)
 
         self.layout.addWidget(self.scroll_area)
+        self.scroll_area.verticalScrollBar().valueChanged.connect(self.request_shown_thumbnails)
 
         self.window_width = window_width
         self.window_height = int()
@@ -138,6 +144,18 @@ class Show(QWidget):
         self.album_pictures_part = dict()
         self.continue_button = dict()
 
+        # Pictures without a cache file are laid out as placeholders and get their thumbnails once shown
+        self.thumbnail_height = 250
+        self.pictures_md5_dict = dict()
+        self.pictures_size_dict = dict()
+        self.placeholder_labels_dict = dict()
+        # Tiles shown from a tier smaller than the screen needs, waiting for the larger tier to be made
+        self.tier_labels_dict = dict()
+        self.tier_requested_set = set()
+        self.thumbnail_requests = ThumbnailRequests.get_requests()
+        self.thumbnail_requests.thumbnail_ready_signal.connect(self.thumbnail_ready)
+        self.thumbnail_pack = ThumbnailPack.get_pack()
+
         self.album_shown_widgets_list = list()
         self.album_refresh_pictures_list = list()
         self.album_refresh_continue_button_number = int()
@@ -211,13 +229,17 @@ class Show(QWidget):
         self.album_pictures_part = dict()
         self.continue_button = dict()
 
-        pictures_path_data, _, _, pictures_cached_name_data = self.commands.read_latest_pictures_data()
+        pictures_path_data, pictures_md5_data, _, pictures_cached_name_data = \
+            self.commands.read_folder_pictures_data(folder_path)
 
         self.pictures_data_dict = dict(zip(pictures_path_data, pictures_cached_name_data))
+        self.pictures_md5_dict = dict(zip(pictures_path_data, pictures_md5_data))
+        self.pictures_size_dict = self.commands.read_folder_pictures_size_data(folder_path)
+        self.placeholder_labels_dict = dict()
+        self.tier_labels_dict = dict()
+        self.tier_requested_set = set()
 
-        for picture_path in pictures_path_data:
-            if folder_path in picture_path:
-                self.album_pictures_list.append(picture_path)
+        self.album_pictures_list = list(pictures_path_data)
 
         self.album_parts_number = int(len(self.album_pictures_list) / 200) + 1
 
@@ -243,24 +265,52 @@ class Show(QWidget):
         line_width = 0
         n = 0
         line[0] = list()
+        uncached_pictures_list = list()
+
+        # Thumbnails in the pack store are read from the mapped pack files, all entries of the part at once
+        pack_entries_dict = self.thumbnail_pack.read_entries(
+            [self.pictures_data_dict[img] for img in album_pictures_list if self.pictures_data_dict.get(img)]
+        )
+        packed_pixmaps_dict = dict()
+
         for picture_path in album_pictures_list:
             if os.path.exists(picture_path):
                 picture_cached_name = self.pictures_data_dict[picture_path]
 
                 if picture_cached_name:
-                    picture_cached_path = os.path.join(self.cache_folder_path, picture_cached_name)
+                    picture_cached_path = self.commands.read_cache_path(self.cache_folder_path, picture_cached_name)
                 else:
                     picture_cached_path = ''
 
-                if os.path.exists(picture_cached_path):
-                    picture_width = QPixmap(picture_cached_path).width()
-                    line_width = line_width + picture_width + 5
-                    if line_width + 5 >= self.window_width:
-                        n = n + 1
-                        line[n] = list()
-                        line_width = 0 + picture_width + 5
+                if picture_cached_name in pack_entries_dict:
+                    packed_pixmap = self.read_tile_pixmap(
+                        picture_path, picture_cached_path, pack_entries_dict[picture_cached_name])
+                    if not packed_pixmap.isNull():
+                        packed_pixmaps_dict[picture_path] = packed_pixmap
+
+                if picture_path in packed_pixmaps_dict:
+                    picture_width = round(packed_pixmap.width() / packed_pixmap.devicePixelRatio())
+                elif os.path.exists(picture_cached_path):
+                    picture_width = PictureHeader.read_header(picture_cached_path).get('width', 0)
+                    if not picture_width:
+                        picture_width = QPixmap(picture_cached_path).width()
+                else:
+                    picture_width = self.read_placeholder_width(picture_path)
+                    uncached_pictures_list.append(picture_path)
+
+                line_width = line_width + picture_width + 5
+                if line_width + 5 >= self.window_width:
+                    n = n + 1
+                    line[n] = list()
+                    line_width = 0 + picture_width + 5
 
-                    line[n].append(picture_path)
+                line[n].append(picture_path)
+
+        uncached_pictures_set = set(uncached_pictures_list)
+        shown_cache_names_list = list()
+        if uncached_pictures_list:
+            # Pictures of this part that are still waiting for their thumbnail are cached before all others
+            PendingPictures.boost_pictures(uncached_pictures_list)
 
         lines_number = len(line)
         line_layout = dict()
@@ -269,11 +319,20 @@ class Show(QWidget):
             line_layout[n].setAlignment(Qt.AlignLeft)
             self.album_layout.addLayout(line_layout[n])
             for img in line[n]:
-                picture_cached_name = self.pictures_data_dict[img]
-                picture_cached_path = os.path.join(self.cache_folder_path, picture_cached_name)
-
                 m = self.album_pictures_list.index(img)
-                self.picture[m] = QPixmap(picture_cached_path)
+                if img in uncached_pictures_set:
+                    self.picture[m] = self.create_placeholder(self.read_placeholder_width(img))
+                    img_cache_name = f'{self.pictures_md5_dict[img]}.jpg'
+                    self.placeholder_labels_dict.setdefault(img_cache_name, list()).append((img, m))
+                else:
+                    picture_cached_name = self.pictures_data_dict[img]
+                    picture_cached_path = self.commands.read_cache_path(self.cache_folder_path, picture_cached_name)
+                    if img in packed_pixmaps_dict:
+                        self.picture[m] = packed_pixmaps_dict[img]
+                    else:
+                        self.picture[m] = self.read_tile_pixmap(img, picture_cached_path)
+                    shown_cache_names_list.append(picture_cached_name)
+
                 self.picture_label[m] = PictureLabel()
                 self.picture_label[m].setPixmap(self.picture[m])
 
@@ -294,6 +353,9 @@ class Show(QWidget):
                 if not self.album_refresh_mode:
                     self.album_refresh_pictures_list.append(img)
 
+        # Cache files shown last are the last to be evicted when the cache is over its size limit
+        self.commands.save_cache_access_time(shown_cache_names_list)
+
         self.previous_lines_number = self.previous_lines_number + lines_number
 
         self.continue_button_number = continue_button_number
@@ -308,6 +370,110 @@ class Show(QWidget):
 
         self.scroll_area.setWidget(self.album_widget)
 
+        # Placeholders only have a position once the layout has been applied
+        QTimer.singleShot(0, self.request_shown_thumbnails)
+
+    def read_placeholder_width(self, img_path):
+        # Records indexed before sizes were stored are measured from the picture's header once, in this process;
+        # a picture the header parser cannot measure is laid out as 4:3 and measured by its thumbnail request
+        if img_path not in self.pictures_size_dict:
+            self.pictures_size_dict[img_path] = PictureHeader.read_display_size(img_path)
+
+        img_width, img_height = self.pictures_size_dict[img_path]
+        if not img_width or not img_height:
+            return round(self.thumbnail_height * 4 / 3)
+        return max(round(self.thumbnail_height * img_width / img_height), 1)
+
+    def read_tile_pixmap(self, picture_path, picture_cached_path, pack_entry=None):
+        # On HiDPI screens a larger tier is drawn at the same size, so tiles are not upscaled
+        needed_height = math.ceil(self.thumbnail_height * self.devicePixelRatioF())
+        if pack_entry is not None and needed_height <= self.thumbnail_height:
+            return self.read_packed_pixmap(pack_entry)
+
+        tier_path = ThumbnailTiers.choose_tier_path(picture_cached_path, needed_height)
+        if not tier_path:
+            # The largest tier there is stands in, drawn larger, while the missing one is made in the background
+            self.request_tier(picture_path, picture_cached_path)
+            tier_path = ThumbnailTiers.read_largest_tier_path(picture_cached_path)
+        if not tier_path and pack_entry is not None:
+            return self.read_packed_pixmap(pack_entry)
+        if not tier_path or tier_path == picture_cached_path:
+            return QPixmap(picture_cached_path)
+
+        img_reader = QImageReader(tier_path)
+        img_size = img_reader.size()
+        if img_size.isValid() and img_size.height() > needed_height:
+            scaled_width = max(round(img_size.width() * needed_height / img_size.height()), 1)
+            img_reader.setScaledSize(QSize(scaled_width, needed_height))
+
+        tile_pixmap = QPixmap.fromImage(img_reader.read())
+        if tile_pixmap.isNull():
+            return QPixmap(picture_cached_path)
+        tile_pixmap.setDevicePixelRatio(tile_pixmap.height() / self.thumbnail_height)
+        return tile_pixmap
+
+    def request_tier(self, picture_path, picture_cached_path):
+        # Each thumbnail is asked for once an album; a picture smaller than the tier gets none and keeps its tile
+        img_cache_name = os.path.basename(picture_cached_path)
+        tier_pictures_list = self.tier_labels_dict.setdefault(img_cache_name, list())
+        if picture_path not in tier_pictures_list:
+            tier_pictures_list.append(picture_path)
+        if img_cache_name not in self.tier_requested_set:
+            self.tier_requested_set.add(img_cache_name)
+            self.thumbnail_requests.request(
+                picture_path, img_cache_name, f'x{self.thumbnail_height}', missing_tiers=True
+            )
+
+    def read_packed_pixmap(self, pack_entry):
+        tile_pixmap = QPixmap()
+        tile_pixmap.loadFromData(self.thumbnail_pack.read_data(pack_entry), 'JPG')
+        return tile_pixmap
+
+    def create_placeholder(self, placeholder_width):
+        placeholder = QPixmap(placeholder_width, self.thumbnail_height)
+        placeholder.fill(QColor(128, 128, 128, 60))
+        return placeholder
+
+    def request_shown_thumbnails(self):
+        viewport = self.scroll_area.viewport()
+        viewport_height = viewport.height()
+        for img_cache_name, placeholder_list in self.placeholder_labels_dict.items():
+            img, m = placeholder_list[0]
+            picture_label = self.picture_label.get(m)
+            if picture_label is None or not picture_label.isVisible():
+                continue
+
+            # Tiles within one screen below the view are asked for too, so scrolling finds them ready
+            label_top = picture_label.mapTo(viewport, QPoint(0, 0)).y()
+            if label_top + picture_label.height() > 0 and label_top < viewport_height * 2:
+                probe_size = not all(self.pictures_size_dict.get(img, (0, 0)))
+                self.thumbnail_requests.request(img, img_cache_name, f'x{self.thumbnail_height}', probe_size)
+
+    def thumbnail_ready(self, img_path, img_cache_name):
+        if img_cache_name in self.tier_labels_dict:
+            self.tier_ready(img_cache_name)
+        if img_cache_name not in self.placeholder_labels_dict:
+            return
+
+        picture_cached_path = self.commands.read_cache_path(self.cache_folder_path, img_cache_name)
+        pack_entry = self.thumbnail_pack.read_entries([img_cache_name]).get(img_cache_name)
+        for img, m in self.placeholder_labels_dict.pop(img_cache_name):
+            self.pictures_data_dict[img] = img_cache_name
+            self.picture[m] = self.read_tile_pixmap(img, picture_cached_path, pack_entry)
+            self.picture_label[m].setPixmap(self.picture[m])
+            if not self.picture[m].isNull():
+                self.pictures_size_dict[img] = (self.picture[m].width(), self.picture[m].height())
+        self.commands.save_cache_access_time([img_cache_name])
+
+    def tier_ready(self, img_cache_name):
+        picture_cached_path = self.commands.read_cache_path(self.cache_folder_path, img_cache_name)
+        pack_entry = self.thumbnail_pack.read_entries([img_cache_name]).get(img_cache_name)
+        for img in self.tier_labels_dict.pop(img_cache_name):
+            m = self.album_pictures_list.index(img)
+            if m in self.picture_label:
+                self.picture[m] = self.read_tile_pixmap(img, picture_cached_path, pack_entry)
+                self.picture_label[m].setPixmap(self.picture[m])
+
     def next_part(self):
         self.album_refresh_mode = False
         self.continue_button[self.continue_button_number].hide()
@@ -360,7 +526,16 @@ class Show(QWidget):
 
     def show_picture_result(self, img_temp_path, need_temp):
         self.rolling_progressbar.hide()
-        self.image_viewer = ImgView(img_temp_path, self.current_img_path, self.current_show_size, need_temp)
+        picture_cached_name = self.pictures_data_dict.get(self.current_img_path)
+        if picture_cached_name:
+            picture_cached_path = self.commands.read_cache_path(self.cache_folder_path, picture_cached_name)
+            self.commands.save_cache_access_time([picture_cached_name])
+        else:
+            picture_cached_path = ''
+
+        self.image_viewer = ImgView(
+            img_temp_path, self.current_img_path, self.current_show_size, need_temp, picture_cached_path
+        )
         self.image_viewer.show()
 
     def open_yesno_dialog(self):
@@ -380,16 +555,13 @@ class Show(QWidget):
 
         os.remove(img_path)
 
-        picture_cached_name = self.pictures_data_dict[img_path]
-        picture_cached_path = os.path.join(self.cache_folder_path, picture_cached_name)
-
-        reserved_cache_files_list = self.commands.check_reserved_cache_files()
-        if picture_cached_path not in reserved_cache_files_list:
-            if os.path.exists(picture_cached_path):
-                os.remove(picture_cached_path)
-
         self.commands.remove_picture_record(img_path)
 
+        # A picture still shown as a placeholder has no cache file to remove
+        picture_cached_name = self.pictures_data_dict[img_path]
+        if picture_cached_name and not self.commands.check_cache_referenced(picture_cached_name):
+            ThumbnailTiers.remove_tiers(self.cache_folder_path, picture_cached_name)
+
     def img_path_dialog(self):
         supported_formats = self.commands.read_supported_formats()
         filter_formats = str()
@@ -2,7 +2,8 @@ import os
 from threading import Thread
 from PySide6.QtCore import Signal, QObject
 
-from kshandler import Commands, ImageMagickHandler
+from kshandler import Commands
+from ksbackend import ImageBackends
 
 
 class ShowPicture(QObject):
@@ -12,7 +13,6 @@ class ShowPicture(QObject):
     def __init__(self, img_path):
         super(ShowPicture, self).__init__()
         self.commands = Commands()
-        self.imagemagick_handler = ImageMagickHandler()
 
         self.temp_folder_path = self.commands.read_temp_folder_path()
 
@@ -25,20 +25,13 @@ class ShowPicture(QObject):
         thread.start()
 
     def start(self, img_path):
+        # A picture routed to Qt is shown as it is and turned upright by the viewer;
+        # others are converted to a temporary picture first
         img_file_type = self.commands.get_filetype(img_path)
-        imagemagick_supported_formats = self.commands.imagemagick_supported_formats()
-
-        exif_details = self.imagemagick_handler.read_exif(img_path)
-        jpeg_formats = ['.jpeg', '.JPEG', '.jpg', '.JPG']
-        need_rotation = False
-        if 'Orientation' in exif_details.keys() and img_file_type in jpeg_formats:
-            if exif_details['Orientation'] != '1':
-                need_rotation = True
-
-        if img_file_type in imagemagick_supported_formats or need_rotation:
-            self.recognize_picture(img_path)
-        else:
+        if ImageBackends.read_backend_name(img_file_type, 'decode') == 'qt':
             self.show_picture('', False)
+        else:
+            self.recognize_picture(img_path)
 
     def recognize_picture(self, img_path):
         img_name = os.path.basename(img_path)
@@ -64,7 +57,7 @@ class ShowPicture(QObject):
 
         target_path = os.path.join(self.temp_folder_path, target_name)
 
-        convert_result = self.imagemagick_handler.convert_picture(img_path, target_path, resize_option, '')
+        convert_result = ImageBackends.run('convert', img_path, target_path, resize_option, '')
 
         if convert_result:
             self.show_picture(target_path, True)
@@ -0,0 +1,454 @@
+import os
+import itertools
+from queue import Queue as queue_Queue, LifoQueue, Empty
+from threading import Thread, Lock, Condition
+from multiprocessing import Process, Queue
+from PySide6.QtCore import Qt, Signal, QObject
+from PySide6.QtGui import QImage, QImageReader, QImageIOHandler, QTransform
+
+from kshandler import Commands
+from ksexif import ExifHeader
+from kspack import ThumbnailPack
+from ksbackend import ImageBackends, QtBackend
+
+
+class ThumbnailTiers:
+    # Thumbnails are kept at several heights, keyed by md5 and height; the smallest keeps the plain
+    # {md5}.jpg name, so caches made before the larger tiers existed still work
+    tier_heights_list = [250, 500, 1200]
+
+    def __init__(self):
+        super(ThumbnailTiers, self).__init__()
+
+    @staticmethod
+    def read_tier_path(img_cache_path, tier_height):
+        if tier_height == ThumbnailTiers.tier_heights_list[0]:
+            return img_cache_path
+        img_cache_root, img_cache_ext = os.path.splitext(img_cache_path)
+        return f'{img_cache_root}.{tier_height}{img_cache_ext}'
+
+    @staticmethod
+    def read_tier_paths(img_cache_path):
+        tier_paths_list = list()
+        for tier_height in ThumbnailTiers.tier_heights_list:
+            tier_paths_list.append(ThumbnailTiers.read_tier_path(img_cache_path, tier_height))
+        return tier_paths_list
+
+    @staticmethod
+    def read_tiers_list(img_path, img_cache_path, target_path, resize_option):
+        # Largest first, in the order they are made; the smallest tier is written to target_path.
+        # A tier at or above the picture's own height would only be a copy of it, so it is not made
+        # and the picture itself is read instead
+        img_height = (QtBackend.probe(img_path) or (0, 0))[1]
+        tiers_list = list()
+        if resize_option == f'x{ThumbnailTiers.tier_heights_list[0]}':
+            for tier_height in reversed(ThumbnailTiers.tier_heights_list[1:]):
+                if img_height and tier_height >= img_height:
+                    continue
+                tier_path = ThumbnailTiers.read_tier_path(img_cache_path, tier_height)
+                tiers_list.append((tier_path, f'x{tier_height}>'))
+        tiers_list.append((target_path, resize_option))
+        return tiers_list
+
+    @staticmethod
+    def choose_tier_path(img_cache_path, needed_height):
+        # The smallest tier that is at least as tall as needed; a missing tier is passed over
+        for tier_height in ThumbnailTiers.tier_heights_list:
+            if tier_height < needed_height:
+                continue
+            tier_path = ThumbnailTiers.read_tier_path(img_cache_path, tier_height)
+            if os.path.exists(tier_path):
+                return tier_path
+        return ''
+
+    @staticmethod
+    def remove_tiers(cache_folder_path, img_cache_name):
+        img_cache_path = Commands.read_cache_path(cache_folder_path, img_cache_name)
+        for tier_path in ThumbnailTiers.read_tier_paths(img_cache_path):
+            if os.path.exists(tier_path):
+                os.remove(tier_path)
+        ThumbnailPack.get_pack().remove([img_cache_name])
+
+    @staticmethod
+    def read_largest_tier_path(img_cache_path):
+        for tier_path in reversed(ThumbnailTiers.read_tier_paths(img_cache_path)):
+            if os.path.exists(tier_path):
+                return tier_path
+        return ''
+
+
+class CacheMigration:
+    # Caches made before the sharded layout keep their files in the cache folder itself; they are moved
+    # into place in the background, and a file asked for before its turn is moved at once
+    lock = Lock()
+    running = False
+
+    def __init__(self):
+        super(CacheMigration, self).__init__()
+        self.commands = Commands()
+        self.cache_folder_path = self.commands.read_cache_folder_path()
+
+    def start_migrate(self):
+        with CacheMigration.lock:
+            if CacheMigration.running:
+                return
+            CacheMigration.running = True
+
+        thread = Thread(target=self.migrate)
+        thread.daemon = True
+        thread.start()
+
+    def migrate(self):
+        try:
+            with os.scandir(self.cache_folder_path) as temp:
+                cache_file_names_list = [item.name for item in temp if item.is_file()]
+
+            for cache_file_name in cache_file_names_list:
+                cache_file_path = os.path.join(self.cache_folder_path, cache_file_name)
+                try:
+                    if cache_file_name.endswith('.part'):
+                        # Left by a thumbnail that was never finished
+                        os.remove(cache_file_path)
+                    else:
+                        os.replace(
+                            cache_file_path, Commands.make_cache_path(self.cache_folder_path, cache_file_name)
+                        )
+                except OSError:
+                    continue
+        finally:
+            with CacheMigration.lock:
+                CacheMigration.running = False
+
+    @staticmethod
+    def migrate_cache_file(cache_folder_path, img_cache_name):
+        img_cache_path = Commands.read_cache_path(cache_folder_path, img_cache_name)
+        old_tier_paths_list = ThumbnailTiers.read_tier_paths(os.path.join(cache_folder_path, img_cache_name))
+        for old_tier_path, tier_path in zip(old_tier_paths_list, ThumbnailTiers.read_tier_paths(img_cache_path)):
+            if not os.path.exists(old_tier_path):
+                continue
+            try:
+                os.makedirs(os.path.dirname(tier_path), exist_ok=True)
+                os.replace(old_tier_path, tier_path)
+            except OSError:
+                continue
+        return os.path.exists(img_cache_path)
+
+
+class ThumbnailPool:
+    # One pool per app process; its workers stay up across scans and each decodes many pictures
+    pool = None
+    pool_lock = Lock()
+
+    def __init__(self):
+        super(ThumbnailPool, self).__init__()
+        self.job_signal = Queue()
+        self.result_signal = Queue()
+
+        self.processes_dict = dict()
+        self.processes_number = int()
+
+        self.job_ids = itertools.count()
+        self.waiting_jobs_dict = dict()
+        self.running_jobs_dict = dict()
+        self.jobs_lock = Lock()
+        self.jobs_condition = Condition(self.jobs_lock)
+
+        thread = Thread(target=self.dispatch_results)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def get_pool(cls, processes_number):
+        with cls.pool_lock:
+            if cls.pool is None:
+                cls.pool = ThumbnailPool()
+            cls.pool.resize(max(int(processes_number), 1))
+        return cls.pool
+
+    def resize(self, processes_number):
+        with self.jobs_lock:
+            while self.processes_number < processes_number:
+                self.start_process()
+                self.processes_number = self.processes_number + 1
+
+            while self.processes_number > processes_number:
+                # Any idle worker takes the sentinel, so the pool shrinks without interrupting a picture
+                self.job_signal.put(None)
+                self.processes_number = self.processes_number - 1
+
+            self.jobs_condition.notify_all()
+
+    def wait_free_process(self):
+        # Jobs that must not hold up others wait here until fewer jobs are waiting than there are workers
+        with self.jobs_condition:
+            while len(self.waiting_jobs_dict) >= self.processes_number:
+                self.jobs_condition.wait()
+
+    def start_process(self):
+        process = Process(target=self.thumbnail_process, args=(self.job_signal, self.result_signal))
+        process.daemon = True
+        process.start()
+        self.processes_dict[process.pid] = process
+
+    def convert_picture(self, img_path, tiers_list):
+        job_result_signal = queue_Queue()
+        with self.jobs_lock:
+            job_id = next(self.job_ids)
+            self.waiting_jobs_dict[job_id] = job_result_signal
+
+        backend_names_list = ImageBackends.read_backend_names(Commands.get_filetype(img_path), 'thumbnail')
+        self.job_signal.put((job_id, img_path, tiers_list, backend_names_list))
+
+        while True:
+            try:
+                return job_result_signal.get(timeout=1)
+            except Empty:
+                self.check_processes()
+
+    def dispatch_results(self):
+        while True:
+            job_status, job_id, process_id, job_result = self.result_signal.get()
+            with self.jobs_lock:
+                if job_status == 'started':
+                    self.running_jobs_dict[process_id] = job_id
+                    continue
+
+                self.running_jobs_dict.pop(process_id, None)
+                job_result_signal = self.waiting_jobs_dict.pop(job_id, None)
+                self.jobs_condition.notify_all()
+
+            if job_result_signal is not None:
+                job_result_signal.put(job_result)
+
+    def check_processes(self):
+        # A worker that crashed on a broken picture fails its job and is replaced
+        with self.jobs_lock:
+            for process_id, process in list(self.processes_dict.items()):
+                if process.is_alive():
+                    continue
+
+                del self.processes_dict[process_id]
+                if process.exitcode == 0:
+                    continue
+
+                job_id = self.running_jobs_dict.pop(process_id, None)
+                job_result_signal = self.waiting_jobs_dict.pop(job_id, None)
+                if job_result_signal is not None:
+                    job_result_signal.put(False)
+                    self.jobs_condition.notify_all()
+                self.start_process()
+
+    @staticmethod
+    def thumbnail_process(job_signal, result_signal):
+        process_id = os.getpid()
+
+        while True:
+            job = job_signal.get()
+            if job is None:
+                break
+
+            job_id, img_path, tiers_list, backend_names_list = job
+            result_signal.put(('started', job_id, process_id, None))
+
+            img_cache_result = bool(ImageBackends.run_backends(backend_names_list, 'thumbnail', img_path, tiers_list))
+
+            result_signal.put(('finished', job_id, process_id, img_cache_result))
+
+    @staticmethod
+    def create_preview_thumbnail(img_path, target_path, resize_option):
+        # The preview embedded in the EXIF header is decoded instead of the picture itself
+        preview_data, orientation = ExifHeader.read_preview(img_path)
+        if not preview_data:
+            return False
+
+        img = QImage.fromData(preview_data)
+        if img.isNull():
+            return False
+        img = ThumbnailPool.transform_orientation(img, orientation)
+
+        img_reader = QImageReader(img_path)
+        img_reader.setAutoTransform(True)
+        img_size = img_reader.size()
+        if img_size.isValid():
+            img_width = img_size.width()
+            img_height = img_size.height()
+            if img_reader.transformation() & QImageIOHandler.TransformationRotate90:
+                img_width, img_height = img_height, img_width
+
+            # Cameras pad previews to 4:3, so the bars are cut off to match the picture's aspect ratio
+            if img.width() * img_height > img.height() * img_width:
+                cropped_width = max(round(img.height() * img_width / img_height), 1)
+                img = img.copy((img.width() - cropped_width) // 2, 0, cropped_width, img.height())
+            elif img.width() * img_height < img.height() * img_width:
+                cropped_height = max(round(img.width() * img_height / img_width), 1)
+                img = img.copy(0, (img.height() - cropped_height) // 2, img.width(), cropped_height)
+
+        width, height = QtBackend.read_resize_option(resize_option)
+        scaled_width, scaled_height = QtBackend.read_scaled_size(img.width(), img.height(), width, height)
+        img = img.scaled(scaled_width, scaled_height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+        return QtBackend.save_thumbnail(img, target_path)
+
+    @staticmethod
+    def transform_orientation(img, orientation):
+        if orientation in (2, 4):
+            img = img.mirrored(orientation == 2, orientation == 4)
+        elif orientation in (3, 6, 8):
+            rotation = {3: 180, 6: 90, 8: 270}[orientation]
+            img = img.transformed(QTransform().rotate(rotation))
+        elif orientation in (5, 7):
+            rotation = {5: 90, 7: 270}[orientation]
+            img = img.transformed(QTransform().rotate(rotation)).mirrored(True, False)
+        return img
+
+
+class DeferredThumbnails:
+    # Pictures cached from their EXIF preview get their full-quality thumbnail here, in the background
+    deferred = None
+    deferred_lock = Lock()
+
+    def __init__(self):
+        super(DeferredThumbnails, self).__init__()
+        self.commands = Commands()
+        self.cache_folder_path = self.commands.read_cache_folder_path()
+
+        self.deferred_signal = queue_Queue()
+        self.deferred_cache_names_set = set()
+        self.deferred_cache_names_lock = Lock()
+
+        thread = Thread(target=self.create_thumbnails)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def get_deferred(cls):
+        with cls.deferred_lock:
+            if cls.deferred is None:
+                cls.deferred = DeferredThumbnails()
+        return cls.deferred
+
+    def add(self, img_path, img_cache_name, resize_option):
+        with self.deferred_cache_names_lock:
+            if img_cache_name in self.deferred_cache_names_set:
+                return
+            self.deferred_cache_names_set.add(img_cache_name)
+        self.deferred_signal.put((img_path, img_cache_name, resize_option))
+
+    def create_thumbnails(self):
+        while True:
+            img_path, img_cache_name, resize_option = self.deferred_signal.get()
+
+            thumbnail_pool = ThumbnailPool.get_pool(self.commands.read_cache_threads_number())
+            # Pictures still waiting for their first thumbnail go first
+            thumbnail_pool.wait_free_process()
+
+            img_cache_path = self.commands.make_cache_path(self.cache_folder_path, img_cache_name)
+            temp_cache_path = self.commands.read_cache_path(
+                self.cache_folder_path, f'{self.commands.get_filename(img_cache_name)}.full.jpg'
+            )
+            tiers_list = ThumbnailTiers.read_tiers_list(img_path, img_cache_path, temp_cache_path, resize_option)
+            if os.path.exists(img_path) and thumbnail_pool.convert_picture(img_path, tiers_list):
+                os.replace(temp_cache_path, img_cache_path)
+                self.commands.clear_cache_preview(img_cache_name)
+
+                # A packed preview is replaced in the pack too, or the album would keep showing it
+                thumbnail_pack = ThumbnailPack.get_pack()
+                if self.commands.read_thumbnail_store() == 'pack' or thumbnail_pack.read_entries([img_cache_name]):
+                    thumbnail_pack.add(img_cache_name, img_cache_path)
+
+            with self.deferred_cache_names_lock:
+                self.deferred_cache_names_set.discard(img_cache_name)
+
+
+class ThumbnailRequests(QObject):
+    # The album asks for the thumbnails of the tiles it shows; the latest request is served first,
+    # so tiles scrolled past do not hold up the ones in view. One instance and its threads serve every album
+    thumbnail_ready_signal = Signal(str, str)
+    requests = None
+    requests_lock = Lock()
+
+    def __init__(self):
+        super(ThumbnailRequests, self).__init__()
+        self.commands = Commands()
+        self.cache_folder_path = self.commands.read_cache_folder_path()
+
+        self.request_signal = LifoQueue()
+        self.requested_cache_names_set = set()
+        self.requested_lock = Lock()
+
+        self.threads_number = int(self.commands.read_cache_threads_number())
+        for n in range(self.threads_number):
+            thread = Thread(target=self.create_thumbnails)
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def get_requests(cls):
+        with cls.requests_lock:
+            if cls.requests is None:
+                cls.requests = ThumbnailRequests()
+        return cls.requests
+
+    def request(self, img_path, img_cache_name, resize_option, probe_size=False, missing_tiers=False):
+        # With missing_tiers the thumbnail is already there and only the larger tiers it lacks are made
+        with self.requested_lock:
+            if img_cache_name in self.requested_cache_names_set:
+                return
+            self.requested_cache_names_set.add(img_cache_name)
+        self.request_signal.put((img_path, img_cache_name, resize_option, probe_size, missing_tiers))
+
+    def create_thumbnails(self):
+        # Each thread has its own Commands; the name is always given back, so a failed request can be made again
+        commands = Commands()
+        while True:
+            img_path, img_cache_name, resize_option, probe_size, missing_tiers = self.request_signal.get()
+            try:
+                if missing_tiers:
+                    self.create_missing_tiers(img_path, img_cache_name, resize_option)
+                else:
+                    self.create_thumbnail(commands, img_path, img_cache_name, resize_option, probe_size)
+            finally:
+                with self.requested_lock:
+                    self.requested_cache_names_set.discard(img_cache_name)
+
+    def create_missing_tiers(self, img_path, img_cache_name, resize_option):
+        # Tiers at or above the picture's own height are left out by read_tiers_list, so a small picture gets none
+        img_cache_path = Commands.read_cache_path(self.cache_folder_path, img_cache_name)
+        tiers_list = [
+            (tier_path, tier_resize_option)
+            for tier_path, tier_resize_option in ThumbnailTiers.read_tiers_list(
+                img_path, img_cache_path, img_cache_path, resize_option)[:-1]
+            if not os.path.exists(tier_path)
+        ]
+        if not tiers_list or not os.path.exists(img_path):
+            return
+
+        thumbnail_pool = ThumbnailPool.get_pool(self.threads_number)
+        if thumbnail_pool.convert_picture(img_path, tiers_list):
+            self.thumbnail_ready_signal.emit(img_path, img_cache_name)
+
+    def create_thumbnail(self, commands, img_path, img_cache_name, resize_option, probe_size):
+        if probe_size:
+            # The album had no size for this picture; the one measured here lays it out next time
+            img_width, img_height = ImageBackends.probe(img_path)
+            if img_width and img_height:
+                commands.save_picture_size(img_path, img_width, img_height)
+
+        img_cache_path = commands.make_cache_path(self.cache_folder_path, img_cache_name)
+        if not os.path.exists(img_cache_path) and os.path.exists(img_path) and \
+                not CacheMigration.migrate_cache_file(self.cache_folder_path, img_cache_name):
+            if ThumbnailPool.create_preview_thumbnail(img_path, img_cache_path, resize_option):
+                commands.save_picture_cache_preview(img_path, 1)
+                DeferredThumbnails.get_deferred().add(img_path, img_cache_name, resize_option)
+            else:
+                thumbnail_pool = ThumbnailPool.get_pool(self.threads_number)
+                tiers_list = ThumbnailTiers.read_tiers_list(img_path, img_cache_path, img_cache_path, resize_option)
+                thumbnail_pool.convert_picture(img_path, tiers_list)
+
+        img_cache_ready = os.path.exists(img_cache_path)
+        if img_cache_ready and commands.read_thumbnail_store() == 'pack':
+            ThumbnailPack.get_pack().add(img_cache_name, img_cache_path)
+
+        if img_cache_ready:
+            commands.save_picture_cached_path(img_path, img_cache_name)
+            self.thumbnail_ready_signal.emit(img_path, img_cache_name)
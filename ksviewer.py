@@ -1,16 +1,22 @@
 import os
-from PySide6.QtCore import Qt, QSize
-from PySide6.QtGui import QCursor, QAction, QPixmap, QIcon
+import math
+from threading import Thread
+from PySide6.QtCore import Qt, QSize, Signal
+from PySide6.QtGui import QCursor, QAction, QPixmap, QIcon, QImage
 from PySide6.QtWidgets import (QApplication, QWidget, QFileDialog, QMenu, QVBoxLayout, QScrollArea,
                                QFrame)
 
 from kshandler import Commands, ImageMagickHandler
 from ksdialogs import MessageDialog, SaveSizeDialog, ExifDialog
-from ksfeatures import SaveAs, ImageMagickClip, ViewerPictureLabel
+from ksfeatures import SaveAs, PictureClip, ViewerPictureLabel
+from ksthumbnail import ThumbnailTiers
+from ksbackend import QtBackend
 
 
 class ImgView(QWidget):
-    def __init__(self, img_temp_path, img_path, show_size, need_temp):
+    image_ready_signal = Signal(QSize, QImage)
+
+    def __init__(self, img_temp_path, img_path, show_size, need_temp, img_cache_path):
         super(ImgView, self).__init__()
         self.commands = Commands()
         self.imagemagick_handler = ImageMagickHandler()
@@ -25,43 +31,47 @@ class ImgView(QWidget):
         self.img_path = img_path
 
         if need_temp:
-            self.image_original = QPixmap(img_temp_path)
+            self.img_source_path = img_temp_path
         else:
-            self.image_original = QPixmap(self.img_path)
+            self.img_source_path = self.img_path
+        self.img_cache_path = img_cache_path
 
-        self.img_original_width = self.image_original.width()
-        self.img_original_height = self.image_original.height()
+        # Only the header is read here; each size is decoded when it is shown, at the size it is shown
+        self.img_original_width, self.img_original_height = QtBackend.probe(self.img_source_path) or (0, 0)
+        self.img_original_size = QSize(self.img_original_width, self.img_original_height)
 
         self.img_one_third_width = int(self.img_original_width / 3)
         self.img_one_third_height = int(self.img_original_height / 3)
         self.img_one_third_size = QSize(self.img_one_third_width, self.img_one_third_height)
-        
-        self.image_one_third_size = self.image_original.scaled(self.img_one_third_size, Qt.KeepAspectRatio)
 
         self.img_half_width = int(self.img_original_width / 2)
         self.img_half_height = int(self.img_original_height / 2)
         self.img_half_size = QSize(self.img_half_width, self.img_half_height)
 
-        self.image_half_size = self.image_original.scaled(self.img_half_size, Qt.KeepAspectRatio)
-
         screen = QApplication.primaryScreen()
         self.screen_width = screen.availableSize().width()
         self.screen_height = screen.availableSize().height()
+        self.device_pixel_ratio = screen.devicePixelRatio()
+
+        self.images_dict = dict()
+        self.image_ready_signal.connect(self.image_ready)
 
         if show_size == 'One-third size':
-            self.img = self.image_one_third_size
+            self.img_size = self.img_one_third_size
         elif show_size == 'Half size':
-            self.img = self.image_half_size
+            self.img_size = self.img_half_size
         elif show_size == 'Full size':
-            self.img = self.image_original
+            self.img_size = self.img_original_size
         else:
             if self.img_original_width + 21 > self.screen_width:
-                self.img = self.image_half_size
+                self.img_size = self.img_half_size
             else:
-                self.img = self.image_original
+                self.img_size = self.img_original_size
+
+        self.img = self.read_image(self.img_size)
 
-        img_width = self.img.width()
-        img_height = self.img.height()
+        img_width = self.img_size.width()
+        img_height = self.img_size.height()
 
         self.rename_title(img_width, img_height)
 
@@ -118,8 +128,68 @@ class ImgView(QWidget):
 
         self.action_clip.triggered.connect(self.clip_dialog)
 
+    def read_image(self, img_size):
+        img_size_key = (img_size.width(), img_size.height())
+        if img_size_key in self.images_dict:
+            return self.images_dict[img_size_key]
+
+        needed_height = math.ceil(img_size.height() * self.device_pixel_ratio)
+        if self.img_cache_path:
+            # A cached tier at least as tall as needed is shown instead of decoding the picture
+            tier_path = ThumbnailTiers.choose_tier_path(self.img_cache_path, needed_height)
+            if tier_path:
+                image = self.read_scaled_image(tier_path, img_size, self.device_pixel_ratio)
+                if not image.isNull():
+                    self.images_dict[img_size_key] = self.create_pixmap(image, img_size)
+                    return self.images_dict[img_size_key]
+
+            # Otherwise the largest tier is shown at once and the picture replaces it once decoded; this is
+            # also how a picture smaller than the larger tiers, which are not made for it, is shown
+            preview_path = ThumbnailTiers.read_largest_tier_path(self.img_cache_path)
+            if preview_path:
+                preview_image = QImage(preview_path)
+                if not preview_image.isNull():
+                    thread = Thread(target=self.decode_image, args=(img_size,))
+                    thread.daemon = True
+                    thread.start()
+                    return self.create_pixmap(preview_image, img_size)
+
+        image = self.read_scaled_image(self.img_source_path, img_size, self.device_pixel_ratio)
+        self.images_dict[img_size_key] = self.create_pixmap(image, img_size)
+        return self.images_dict[img_size_key]
+
+    @staticmethod
+    def read_scaled_image(img_path, img_size, device_pixel_ratio):
+        # JPEG is scaled while decoding, so a smaller size never decodes the whole picture
+        scaled_size = img_size * device_pixel_ratio
+        image = QtBackend.decode(img_path, scaled_size.width(), scaled_size.height())
+        if image is None:
+            return QImage()
+        return image
+
+    @staticmethod
+    def create_pixmap(image, img_size):
+        # The pixmap keeps every pixel it has and is drawn at img_size, so HiDPI screens show it sharp
+        pixmap = QPixmap.fromImage(image)
+        if not pixmap.isNull() and img_size.height() > 0:
+            pixmap.setDevicePixelRatio(max(pixmap.height() / img_size.height(), 1))
+            if pixmap.height() < img_size.height():
+                pixmap.setDevicePixelRatio(pixmap.height() / img_size.height())
+        return pixmap
+
+    def decode_image(self, img_size):
+        image = self.read_scaled_image(self.img_source_path, img_size, self.device_pixel_ratio)
+        self.image_ready_signal.emit(img_size, image)
+
+    def image_ready(self, img_size, image):
+        img_size_key = (img_size.width(), img_size.height())
+        self.images_dict[img_size_key] = self.create_pixmap(image, img_size)
+        if img_size == self.img_size:
+            self.img = self.images_dict[img_size_key]
+            self.label.setPixmap(self.img)
+
     def clip_ready(self, width, height, begin_x, begin_y):
-        if begin_x > self.img.width() or begin_y > self.img.height():
+        if begin_x > self.img_size.width() or begin_y > self.img_size.height():
             return
 
         self.clip_width = width
@@ -144,20 +214,17 @@ class ImgView(QWidget):
             filter="PNG (*.png);;JPEG (*.jpg);;GIF (*.gif)"
         )
 
-        imagemagick_program_status, imagemagick_program_path = \
-            self.imagemagick_handler.check_imagemagick_available()
-
-        if imagemagick_program_status and target_path[0]:
-            if self.img == self.image_original:
+        if target_path[0]:
+            if self.img_size == self.img_original_size:
                 resize_option = ''
             else:
-                img_width = self.img.width()
+                img_width = self.img_size.width()
                 resize_option = str(img_width)
-            imagemagick_clip_thread = ImageMagickClip(
+            clip_thread = PictureClip(
                 self.img_path, target_path[0], resize_option,
                 self.clip_width, self.clip_height, self.clip_begin_x, self.clip_begin_y
             )
-            imagemagick_clip_thread.clip_result_signal.connect(self.clip_result)
+            clip_thread.clip_result_signal.connect(self.clip_result)
 
     def clip_result(self, target_path):
         target_name = os.path.basename(target_path)
@@ -239,19 +306,19 @@ class ImgView(QWidget):
     def right_click_menu(self, event):
         self.menu.clear()
 
-        if self.img == self.image_one_third_size:
+        if self.img_size == self.img_one_third_size:
             self.menu.addAction(self.action_half_size)
             self.menu.addAction(self.action_full_size)
             self.menu.addAction(self.action_show_exif)
             self.menu.addAction(self.action_save_as)
 
-        if self.img == self.image_half_size:
+        elif self.img_size == self.img_half_size:
             self.menu.addAction(self.action_one_third_size)
             self.menu.addAction(self.action_full_size)
             self.menu.addAction(self.action_show_exif)
             self.menu.addAction(self.action_save_as)
 
-        if self.img == self.image_original:
+        elif self.img_size == self.img_original_size:
             self.menu.addAction(self.action_one_third_size)
             self.menu.addAction(self.action_half_size)
             self.menu.addAction(self.action_show_exif)
@@ -270,33 +337,36 @@ class ImgView(QWidget):
         self.setWindowTitle(title_text)
 
     def show_one_third_size(self):
-        self.img = self.image_one_third_size
+        self.img_size = self.img_one_third_size
+        self.img = self.read_image(self.img_size)
         self.label.setPixmap(self.img)
 
-        img_width = self.img.width()
-        img_height = self.img.height()
+        img_width = self.img_size.width()
+        img_height = self.img_size.height()
 
         self.rename_title(img_width, img_height)
 
         self.decide_window_size(img_width, img_height)
 
     def show_half_size(self):
-        self.img = self.image_half_size
+        self.img_size = self.img_half_size
+        self.img = self.read_image(self.img_size)
         self.label.setPixmap(self.img)
 
-        img_width = self.img.width()
-        img_height = self.img.height()
+        img_width = self.img_size.width()
+        img_height = self.img_size.height()
 
         self.rename_title(img_width, img_height)
 
         self.decide_window_size(img_width, img_height)
 
     def show_full_size(self):
-        self.img = self.image_original
+        self.img_size = self.img_original_size
+        self.img = self.read_image(self.img_size)
         self.label.setPixmap(self.img)
 
-        img_width = self.image_original.width()
-        img_height = self.image_original.height()
+        img_width = self.img_size.width()
+        img_height = self.img_size.height()
 
         self.rename_title(img_width, img_height)
 
@@ -304,8 +374,8 @@ class ImgView(QWidget):
 
     def save_dialog(self):
         self.save_size_dialog = SaveSizeDialog(
-            f'{self.img.width()}x{self.img.height()}',
-            f'{self.image_original.width()}x{self.image_original.height()}'
+            f'{self.img_size.width()}x{self.img_size.height()}',
+            f'{self.img_original_width}x{self.img_original_height}'
         )
         self.save_size_dialog.show()
 
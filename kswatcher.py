@@ -0,0 +1,321 @@
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+from threading import Thread, Event, Lock
+
+from kshandler import Commands
+
+
+class WatchFolder:
+    def __init__(self):
+        super(WatchFolder, self).__init__()
+        self.watcher = None
+        self.watcher_lock = Lock()
+        self.stopped = False
+
+        self.folder_path = str()
+        self.filetypes = list()
+        self.changed_folders_signal = None
+        self.watch_limit_callback = None
+
+    def start(self, folder_path, filetypes, changed_folders_signal, watch_limit_callback=None):
+        # inotify reports every change as it happens; other systems, or too many folders for the
+        # inotify watch limit, fall back to polling folder mtimes. Both walk the folder in their own thread
+        self.folder_path = folder_path
+        self.filetypes = filetypes
+        self.changed_folders_signal = changed_folders_signal
+        self.watch_limit_callback = watch_limit_callback
+
+        with self.watcher_lock:
+            self.watcher = InotifyWatcher(folder_path, filetypes, changed_folders_signal, self.watch_limit_reached)
+            if self.watcher.start():
+                return
+        self.start_polling()
+
+    def watch_limit_reached(self):
+        if self.watch_limit_callback is not None and not self.stopped:
+            self.watch_limit_callback()
+        self.start_polling()
+
+    def start_polling(self):
+        with self.watcher_lock:
+            if self.stopped:
+                return
+            self.watcher = PollingWatcher(self.folder_path, self.filetypes, self.changed_folders_signal)
+            self.watcher.start()
+
+    def stop(self):
+        with self.watcher_lock:
+            self.stopped = True
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+
+
+class ChangedFolders:
+    def __init__(self, changed_folders_signal):
+        super(ChangedFolders, self).__init__()
+        self.changed_folders_signal = changed_folders_signal
+
+        # Events are collected until the folder has been quiet for a moment, so copying
+        # a batch of pictures becomes one job instead of one job per file
+        self.quiet_time = 1.0
+        self.max_delay = 5.0
+
+        self.changed_folders_set = set()
+        self.first_change_time = float()
+        self.last_change_time = float()
+
+    def add(self, folder):
+        now = time.monotonic()
+        if not self.changed_folders_set:
+            self.first_change_time = now
+        self.last_change_time = now
+        self.changed_folders_set.add(folder)
+
+    def read_timeout(self):
+        if not self.changed_folders_set:
+            return None
+        now = time.monotonic()
+        timeout = min(self.last_change_time + self.quiet_time, self.first_change_time + self.max_delay) - now
+        return max(timeout, 0)
+
+    def flush_if_due(self):
+        timeout = self.read_timeout()
+        if timeout is not None and timeout <= 0:
+            self.flush()
+
+    def flush(self):
+        if self.changed_folders_set:
+            self.changed_folders_signal.put(self.changed_folders_set)
+            self.changed_folders_set = set()
+
+
+class InotifyWatcher:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, folder_path, filetypes, changed_folders_signal, watch_limit_reached_callback):
+        super(InotifyWatcher, self).__init__()
+        self.folder_path = os.path.normpath(folder_path)
+        self.filetypes = set(filetypes)
+        self.changed_folders = ChangedFolders(changed_folders_signal)
+        self.watch_limit_reached_callback = watch_limit_reached_callback
+        self.watch_limit_reached = False
+
+        self.libc = None
+        self.inotify_fd = -1
+        self.watched_folders_dict = dict()
+        self.stop_event = Event()
+
+        self.watch_mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | \
+            self.IN_DELETE | self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_ONLYDIR
+
+    def start(self):
+        if not sys.platform.startswith('linux'):
+            return False
+
+        libc_name = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            self.libc.inotify_init1.argtypes = [ctypes.c_int]
+            self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except (OSError, AttributeError):
+            return False
+
+        self.inotify_fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            return False
+
+        thread = Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+
+    def add_watches(self, folder_path):
+        pending_folders_list = [folder_path]
+        while pending_folders_list:
+            if self.stop_event.is_set():
+                break
+
+            folder = pending_folders_list.pop()
+            watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(folder), self.watch_mask)
+            if watch_descriptor < 0:
+                if ctypes.get_errno() == 28:
+                    # ENOSPC: the inotify watch limit has been reached
+                    return False
+                continue
+
+            self.watched_folders_dict[watch_descriptor] = folder
+            try:
+                with os.scandir(folder) as temp:
+                    for item in temp:
+                        if item.is_dir(follow_symlinks=False):
+                            pending_folders_list.append(os.path.normpath(item.path))
+            except OSError:
+                continue
+
+        return True
+
+    def remove_watches(self, folder_path):
+        folder_prefix = f'{folder_path}{os.sep}'
+        for watch_descriptor, folder in list(self.watched_folders_dict.items()):
+            if folder == folder_path or folder.startswith(folder_prefix):
+                self.libc.inotify_rm_watch(self.inotify_fd, watch_descriptor)
+                del self.watched_folders_dict[watch_descriptor]
+
+    def watch(self):
+        # The watches are added here, so a large library never holds up the thread that started the watcher
+        if not self.add_watches(self.folder_path):
+            self.watch_limit_reached = True
+        event_header_size = struct.calcsize('iIII')
+
+        while not self.stop_event.is_set() and not self.watch_limit_reached:
+            timeout = self.changed_folders.read_timeout()
+            if timeout is None:
+                timeout = 1.0
+            else:
+                timeout = min(timeout, 1.0)
+
+            readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+            if readable:
+                try:
+                    events_data = os.read(self.inotify_fd, 65536)
+                except BlockingIOError:
+                    events_data = b''
+
+                offset = 0
+                while offset + event_header_size <= len(events_data):
+                    watch_descriptor, mask, _, name_length = struct.unpack_from('iIII', events_data, offset)
+                    offset = offset + event_header_size
+                    name = events_data[offset:offset + name_length].rstrip(b'\0')
+                    offset = offset + name_length
+                    self.handle_event(watch_descriptor, mask, os.fsdecode(name))
+
+            self.changed_folders.flush_if_due()
+
+        os.close(self.inotify_fd)
+        self.inotify_fd = -1
+
+        if self.watch_limit_reached and not self.stop_event.is_set():
+            # A folder that could not be watched would never be reported, so the whole tree is polled instead
+            self.changed_folders.flush()
+            self.watch_limit_reached_callback()
+
+    def handle_event(self, watch_descriptor, mask, name):
+        if mask & self.IN_Q_OVERFLOW:
+            # Events have been lost, so the whole folder needs to be compared again
+            self.changed_folders.add(self.folder_path)
+            return
+
+        folder = self.watched_folders_dict.get(watch_descriptor)
+        if folder is None:
+            return
+
+        if mask & self.IN_IGNORED:
+            del self.watched_folders_dict[watch_descriptor]
+            return
+
+        if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+            if folder == self.folder_path:
+                self.changed_folders.add(self.folder_path)
+            return
+
+        item_path = os.path.join(folder, name)
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                if not self.add_watches(item_path):
+                    self.watch_limit_reached = True
+                self.changed_folders.add(item_path)
+            elif mask & self.IN_MOVED_FROM:
+                self.remove_watches(item_path)
+            self.changed_folders.add(folder)
+
+        elif Commands.get_filetype(name) in self.filetypes:
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_MOVED_FROM | self.IN_DELETE):
+                self.changed_folders.add(folder)
+
+
+class PollingWatcher:
+    def __init__(self, folder_path, filetypes, changed_folders_signal):
+        super(PollingWatcher, self).__init__()
+        self.folder_path = os.path.normpath(folder_path)
+        self.filetypes = set(filetypes)
+        self.changed_folders = ChangedFolders(changed_folders_signal)
+
+        self.poll_interval = 5.0
+        self.folders_mtime_dict = dict()
+        self.stop_event = Event()
+
+    def start(self):
+        thread = Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    @staticmethod
+    def read_folders_mtime(folder_path):
+        folders_mtime_dict = dict()
+        pending_folders_list = [folder_path]
+        while pending_folders_list:
+            folder = pending_folders_list.pop()
+            try:
+                folders_mtime_dict[folder] = os.stat(folder).st_mtime_ns
+                with os.scandir(folder) as temp:
+                    for item in temp:
+                        if item.is_dir(follow_symlinks=False):
+                            pending_folders_list.append(os.path.normpath(item.path))
+            except OSError:
+                continue
+
+        return folders_mtime_dict
+
+    def watch(self):
+        self.folders_mtime_dict = self.read_folders_mtime(self.folder_path)
+
+        # Only folder mtimes are compared, so a picture edited in place is found by the next full scan
+        while not self.stop_event.wait(self.poll_interval):
+            for folder, folder_mtime_ns in list(self.folders_mtime_dict.items()):
+                try:
+                    current_folder_mtime_ns = os.stat(folder).st_mtime_ns
+                except OSError:
+                    current_folder_mtime_ns = None
+
+                if current_folder_mtime_ns == folder_mtime_ns:
+                    continue
+
+                self.changed_folders.add(folder)
+                if current_folder_mtime_ns is None:
+                    del self.folders_mtime_dict[folder]
+                    self.changed_folders.add(os.path.dirname(folder))
+                else:
+                    self.folders_mtime_dict[folder] = current_folder_mtime_ns
+                    for subfolder, subfolder_mtime_ns in self.read_folders_mtime(folder).items():
+                        if subfolder not in self.folders_mtime_dict:
+                            self.folders_mtime_dict[subfolder] = subfolder_mtime_ns
+                            self.changed_folders.add(subfolder)
+
+            self.changed_folders.flush()
+
@@ -0,0 +1,48 @@
+import struct
+
+
+def make_tiff_data(ifd0_entries, ifd1_entries=None, extra_data=b''):
+    # Entries are (tag, type, value) with SHORT (3) or LONG (4) values; extra_data follows the directories,
+    # and its offset from the start of the TIFF data is returned so entries can point at it
+    ifds_list = [ifd0_entries]
+    if ifd1_entries:
+        ifds_list.append(ifd1_entries)
+
+    ifd_offsets_list = list()
+    ifd_offset = 8
+    for ifd_entries in ifds_list:
+        ifd_offsets_list.append(ifd_offset)
+        ifd_offset = ifd_offset + 2 + len(ifd_entries) * 12 + 4
+    extra_offset = ifd_offset
+
+    tiff_data = b'II*\x00' + struct.pack('<I', 8)
+    for n, ifd_entries in enumerate(ifds_list):
+        tiff_data = tiff_data + struct.pack('<H', len(ifd_entries))
+        for tag, value_type, value in ifd_entries:
+            if callable(value):
+                value = value(extra_offset)
+            if value_type == 3:
+                tiff_data = tiff_data + struct.pack('<HHIHxx', tag, value_type, 1, value)
+            else:
+                tiff_data = tiff_data + struct.pack('<HHII', tag, value_type, 1, value)
+        if n + 1 < len(ifds_list):
+            tiff_data = tiff_data + struct.pack('<I', ifd_offsets_list[n + 1])
+        else:
+            tiff_data = tiff_data + struct.pack('<I', 0)
+
+    return tiff_data + extra_data
+
+
+def make_jpeg(width, height, tiff_data=b''):
+    jpeg_data = b'\xff\xd8'
+    if tiff_data:
+        exif_data = b'Exif\x00\x00' + tiff_data
+        jpeg_data = jpeg_data + b'\xff\xe1' + struct.pack('>H', len(exif_data) + 2) + exif_data
+    jpeg_data = jpeg_data + b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3) + bytes(9)
+    return jpeg_data + b'\xff\xda' + struct.pack('>H', 2) + b'\xff\xd9'
+
+
+def make_png(width, height):
+    ihdr_data = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    png_data = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr_data)) + b'IHDR' + ihdr_data + bytes(4)
+    return png_data + struct.pack('>I', 0) + b'IEND' + bytes(4)
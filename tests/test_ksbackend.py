@@ -0,0 +1,65 @@
+import pytest
+from PySide6.QtGui import QImage, QColor
+
+from ksbackend import ImageBackends, QtBackend
+from ksexif import ExifHeader
+from sample_pictures import make_tiff_data
+
+
+class FakeImageMagickBackend:
+    name = 'imagemagick'
+
+    def __init__(self, available):
+        super(FakeImageMagickBackend, self).__init__()
+        self.available = available
+
+    def check_operation(self, filetype, operation):
+        return self.available
+
+    def convert(self, img_path, target_path, resize_option, img_quality):
+        return False
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    def set_backends(imagemagick_available, routing_dict):
+        monkeypatch.setattr(ImageBackends, 'backends_dict', {
+            'qt': QtBackend(), 'imagemagick': FakeImageMagickBackend(imagemagick_available)
+        })
+        monkeypatch.setattr(ImageBackends, 'routing_dict', routing_dict)
+    return set_backends
+
+
+def make_camera_jpeg(img_path, tiff_data):
+    img = QImage(400, 300, QImage.Format_RGB32)
+    img.fill(QColor(40, 90, 160))
+    assert img.save(str(img_path), 'JPG')
+
+    img_data = img_path.read_bytes()
+    exif_segment = b'Exif\x00\x00' + tiff_data
+    exif_segment = b'\xff\xe1' + (len(exif_segment) + 2).to_bytes(2, 'big') + exif_segment
+    img_path.write_bytes(img_data[:2] + exif_segment + img_data[2:])
+
+
+def test_export_goes_to_imagemagick_whatever_the_routing(backends):
+    backends(True, {'.jpg': {'thumbnail': 'qt', 'convert': 'qt', 'crop': 'qt'}})
+
+    assert ImageBackends.read_backend_names('.jpg', 'convert') == ['imagemagick', 'qt']
+    assert ImageBackends.read_backend_names('.jpg', 'crop') == ['imagemagick', 'qt']
+    assert ImageBackends.read_backend_names('.jpg', 'thumbnail') == ['qt', 'imagemagick']
+
+
+def test_save_as_keeps_exif(backends, tmp_path):
+    # Without ImageMagick the picture is saved by Qt, which has to put the EXIF back itself
+    backends(False, dict())
+    tiff_data = make_tiff_data([(0x0112, 3, 6), (0x0100, 4, 400), (0x0101, 4, 300)])
+    img_path = tmp_path / 'camera.jpg'
+    make_camera_jpeg(img_path, tiff_data)
+    target_path = tmp_path / 'saved.jpg'
+
+    assert ImageBackends.run('convert', str(img_path), str(target_path), '200', '90')
+
+    saved_tiff_data, _ = ExifHeader.read_jpeg_exif_segment(target_path.read_bytes())
+    assert saved_tiff_data == ExifHeader.reset_orientation(tiff_data)
+    assert ExifHeader.read_exif_data(str(target_path))['orientation'] == 1
+    assert QImage(str(target_path)).size().toTuple() == (200, 267)
@@ -0,0 +1,81 @@
+import time
+import sqlite3
+import threading
+
+import pytest
+
+from ksdatabase import Database
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    (tmp_path / '.config').mkdir()
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return Database()
+
+
+def read_md5(database, picture_path):
+    # A separate connection, as the album reads while the cache threads write
+    db = sqlite3.connect(database.read_db_path())
+    try:
+        picture_record = db.execute(
+            'SELECT picture_md5 FROM pictures WHERE picture_path = ?', (picture_path,)
+        ).fetchone()
+    finally:
+        db.close()
+    if picture_record is None:
+        return None
+    return picture_record[0]
+
+
+def test_batch_full_is_written(database):
+    database.begin_pictures_batch(batch_size=2, flush_interval=60)
+    database.pictures_insert_record('/p/a.jpg', 'a', 0)
+    assert read_md5(database, '/p/a.jpg') is None
+
+    database.pictures_insert_record('/p/b.jpg', 'b', 0)
+    assert read_md5(database, '/p/a.jpg') == 'a'
+    assert read_md5(database, '/p/b.jpg') == 'b'
+    database.end_pictures_batch()
+
+
+def test_idle_batch_is_written_after_flush_interval(database):
+    database.begin_pictures_batch(batch_size=500, flush_interval=0.05)
+    database.pictures_insert_record('/p/a.jpg', 'a', 0)
+    assert read_md5(database, '/p/a.jpg') is None
+
+    # No more rows are queued, so only the timer can write this one
+    time.sleep(0.5)
+    assert read_md5(database, '/p/a.jpg') == 'a'
+    database.end_pictures_batch()
+
+
+def test_end_writes_rows_in_order(database):
+    database.begin_pictures_batch(batch_size=500, flush_interval=60)
+    database.pictures_insert_record('/p/a.jpg', 'a', 0)
+    database.pictures_update_record('picture_path', '/p/a.jpg', 'picture_md5', 'b')
+    database.end_pictures_batch()
+
+    assert read_md5(database, '/p/a.jpg') == 'b'
+
+
+def test_one_database_shared_by_threads(database):
+    errors_list = list()
+
+    def write_and_read(n):
+        try:
+            for m in range(50):
+                picture_path = f'/p/{n}/{m}.jpg'
+                database.pictures_insert_record(picture_path, f'{n}{m}', 0)
+                assert database.pictures_read_record('picture_path', picture_path)
+        except Exception as e:
+            errors_list.append(e)
+
+    threads_list = [threading.Thread(target=write_and_read, args=(n,)) for n in range(4)]
+    for thread in threads_list:
+        thread.start()
+    for thread in threads_list:
+        thread.join()
+
+    assert errors_list == []
+    assert read_md5(database, '/p/3/49.jpg') == '349'
@@ -0,0 +1,90 @@
+from ksdiff import PicturesDiff
+
+
+def test_added_removed_modified_unchanged():
+    pictures_signature_dict = {
+        'a/kept.jpg': (100, 1, 11, 1),
+        'a/edited.jpg': (200, 2, 12, 1),
+        'a/deleted.jpg': (300, 3, 13, 1),
+        'a/unsigned.jpg': None,
+    }
+    scanned_files_stat_dict = {
+        'a/kept.jpg': (100, 1, 11, 1),
+        'a/edited.jpg': (201, 4, 12, 1),
+        'a/unsigned.jpg': (400, 5, 14, 1),
+        'a/new.jpg': (500, 6, 15, 1),
+    }
+
+    pictures_diff = PicturesDiff(pictures_signature_dict).compare(scanned_files_stat_dict)
+
+    assert pictures_diff['added'] == ['a/new.jpg']
+    assert pictures_diff['removed'] == ['a/deleted.jpg']
+    assert pictures_diff['modified'] == ['a/edited.jpg']
+    assert pictures_diff['unchanged'] == ['a/kept.jpg']
+    assert pictures_diff['unsigned'] == ['a/unsigned.jpg']
+    assert pictures_diff['moved'] == []
+    assert pictures_diff['move_candidates'] == []
+
+
+def test_moved_keeps_full_signature():
+    pictures_signature_dict = {'a/1.jpg': (100, 1, 11, 1), 'a/2.jpg': (100, 1, 12, 1)}
+    scanned_files_stat_dict = {'a/2.jpg': (100, 1, 12, 1), 'b/1.jpg': (100, 1, 11, 1)}
+
+    pictures_diff = PicturesDiff(pictures_signature_dict).compare(scanned_files_stat_dict)
+
+    assert pictures_diff['moved'] == [('a/1.jpg', 'b/1.jpg')]
+    assert pictures_diff['added'] == []
+    assert pictures_diff['removed'] == []
+    assert pictures_diff['move_candidates'] == []
+
+
+def test_new_inode_is_only_a_move_candidate():
+    pictures_signature_dict = {'a/1.jpg': (100, 1, 11, 1)}
+    scanned_files_stat_dict = {'usb/1.jpg': (100, 1, 99, 2)}
+
+    pictures_diff = PicturesDiff(pictures_signature_dict).compare(scanned_files_stat_dict)
+
+    assert pictures_diff['moved'] == []
+    assert pictures_diff['move_candidates'] == [('a/1.jpg', 'usb/1.jpg')]
+    assert pictures_diff['added'] == []
+    assert pictures_diff['removed'] == []
+
+
+def test_move_candidate_prefers_same_file_name():
+    # Both removed records have the size and mtime of both copies, so only the names tell them apart
+    pictures_signature_dict = {'a/x.jpg': (100, 1, 11, 1), 'a/y.jpg': (100, 1, 12, 1)}
+    scanned_files_stat_dict = {'usb/x.jpg': (100, 1, 21, 2), 'usb/y.jpg': (100, 1, 22, 2)}
+
+    pictures_diff = PicturesDiff(pictures_signature_dict).compare(scanned_files_stat_dict)
+
+    assert sorted(pictures_diff['move_candidates']) == [('a/x.jpg', 'usb/x.jpg'), ('a/y.jpg', 'usb/y.jpg')]
+    assert pictures_diff['added'] == []
+    assert pictures_diff['removed'] == []
+
+
+def test_move_candidate_without_same_name_takes_last_record():
+    pictures_signature_dict = {'a/x.jpg': (100, 1, 11, 1), 'a/y.jpg': (100, 1, 12, 1)}
+    scanned_files_stat_dict = {'usb/z.jpg': (100, 1, 21, 2)}
+
+    pictures_diff = PicturesDiff(pictures_signature_dict).compare(scanned_files_stat_dict)
+
+    assert pictures_diff['move_candidates'] == [('a/y.jpg', 'usb/z.jpg')]
+    assert pictures_diff['removed'] == ['a/x.jpg']
+
+
+def test_feed_in_chunks_and_settled():
+    pictures_signature_dict = {'a/1.jpg': (100, 1, 11, 1), 'a/2.jpg': (200, 2, 12, 1)}
+    pictures_diff = PicturesDiff(pictures_signature_dict)
+
+    pictures_diff.feed({'a/2.jpg': (201, 3, 12, 1), 'b/new.jpg': (300, 3, 13, 1), 'b/1.jpg': (100, 1, 11, 1)})
+    # b/1.jpg may still be a/1.jpg, which has not been seen yet, so it is not settled
+    assert sorted(pictures_diff.read_settled()) == ['a/2.jpg', 'b/new.jpg']
+    assert pictures_diff.read_settled() == []
+
+    pictures_diff.feed({'b/new.jpg': (300, 3, 13, 1)})
+    result = pictures_diff.finish()
+
+    assert result['added'] == ['b/new.jpg']
+    assert result['modified'] == ['a/2.jpg']
+    assert result['moved'] == [('a/1.jpg', 'b/1.jpg')]
+    assert result['removed'] == []
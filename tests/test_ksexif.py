@@ -0,0 +1,38 @@
+from ksexif import ExifHeader
+from sample_pictures import make_tiff_data, make_jpeg
+
+preview_data = b'\xff\xd8' + b'preview' + b'\xff\xd9'
+
+
+def make_jpeg_with_preview(orientation):
+    tiff_data = make_tiff_data(
+        [(0x0112, 3, orientation)],
+        [(0x0201, 4, lambda extra_offset: extra_offset), (0x0202, 4, len(preview_data))],
+        preview_data
+    )
+    return make_jpeg(4000, 3000, tiff_data)
+
+
+def test_read_exif_data(tmp_path):
+    img_path = tmp_path / 'camera.jpg'
+    img_path.write_bytes(make_jpeg_with_preview(8))
+
+    exif_data = ExifHeader.read_exif_data(str(img_path))
+
+    assert exif_data['orientation'] == 8
+    assert exif_data['preview_length'] == len(preview_data)
+
+
+def test_read_preview(tmp_path):
+    img_path = tmp_path / 'camera.jpg'
+    img_path.write_bytes(make_jpeg_with_preview(6))
+
+    assert ExifHeader.read_preview(str(img_path)) == (preview_data, 6)
+
+
+def test_read_preview_without_exif(tmp_path):
+    img_path = tmp_path / 'plain.jpg'
+    img_path.write_bytes(make_jpeg(640, 480))
+
+    assert ExifHeader.read_exif_data(str(img_path)) == {}
+    assert ExifHeader.read_preview(str(img_path)) == (b'', 1)
@@ -0,0 +1,47 @@
+import hashlib
+
+from kshash import FileHash
+
+
+def test_read_hash_and_algorithm(tmp_path):
+    file_path = tmp_path / 'picture.jpg'
+    file_data = bytes(range(256)) * 9000
+    file_path.write_bytes(file_data)
+
+    md5_hash = FileHash.read_hash(str(file_path), 'md5')
+    blake2b_hash = FileHash.read_hash(str(file_path), 'blake2b')
+
+    assert md5_hash == hashlib.md5(file_data).hexdigest()
+    assert blake2b_hash == hashlib.blake2b(file_data, digest_size=32).hexdigest()
+    assert FileHash.read_algorithm(md5_hash) == 'md5'
+    assert FileHash.read_algorithm(blake2b_hash) == 'blake2b'
+
+
+def test_quick_fingerprint_only_reads_samples(tmp_path):
+    file_path = tmp_path / 'picture.jpg'
+    file_data = bytearray(400000)
+    file_path.write_bytes(file_data)
+    fingerprint = FileHash.read_quick_fingerprint(str(file_path))
+
+    # The byte at 100000 lies between the head and middle samples, so only the full hash sees it change
+    file_data[100000] = 1
+    file_path.write_bytes(file_data)
+    assert FileHash.read_quick_fingerprint(str(file_path)) == fingerprint
+
+    file_data[0] = 1
+    file_path.write_bytes(file_data)
+    assert FileHash.read_quick_fingerprint(str(file_path)) != fingerprint
+
+
+def test_compare_files(tmp_path):
+    file_path = tmp_path / 'a.jpg'
+    same_path = tmp_path / 'b.jpg'
+    other_path = tmp_path / 'c.jpg'
+    file_path.write_bytes(bytes(400000))
+    same_path.write_bytes(bytes(400000))
+    other_data = bytearray(400000)
+    other_data[100000] = 1
+    other_path.write_bytes(other_data)
+
+    assert FileHash.compare_files(str(file_path), str(same_path))
+    assert not FileHash.compare_files(str(file_path), str(other_path))
@@ -0,0 +1,72 @@
+import os
+import threading
+
+import pytest
+
+from kspack import ThumbnailPack
+
+
+@pytest.fixture
+def thumbnail_pack(tmp_path, monkeypatch):
+    (tmp_path / '.config').mkdir()
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return ThumbnailPack()
+
+
+def add_thumbnail(thumbnail_pack, img_cache_name, img_data):
+    img_cache_path = os.path.join(thumbnail_pack.cache_folder_path, img_cache_name)
+    with open(img_cache_path, 'wb') as cache_file:
+        cache_file.write(img_data)
+    assert thumbnail_pack.add(img_cache_name, img_cache_path)
+    assert not os.path.exists(img_cache_path)
+
+
+def test_add_and_read(thumbnail_pack):
+    add_thumbnail(thumbnail_pack, 'a.jpg', b'first thumbnail')
+    add_thumbnail(thumbnail_pack, 'b.jpg', b'second')
+
+    pack_entries_dict = thumbnail_pack.read_entries(['a.jpg', 'b.jpg'])
+
+    assert thumbnail_pack.read_data(pack_entries_dict['a.jpg']) == b'first thumbnail'
+    assert thumbnail_pack.read_data(pack_entries_dict['b.jpg']) == b'second'
+    assert thumbnail_pack.read_packed_names() == {'a.jpg', 'b.jpg'}
+
+
+def test_remove_and_compact(thumbnail_pack):
+    add_thumbnail(thumbnail_pack, 'a.jpg', b'first thumbnail')
+    add_thumbnail(thumbnail_pack, 'b.jpg', b'second')
+    old_pack_numbers_list = thumbnail_pack.read_pack_numbers()
+
+    thumbnail_pack.remove(['a.jpg'])
+    reclaimed_size = thumbnail_pack.compact()
+
+    assert reclaimed_size == len(b'first thumbnail')
+    assert thumbnail_pack.read_packed_names() == {'b.jpg'}
+    pack_entry = thumbnail_pack.read_entries(['b.jpg'])['b.jpg']
+    assert pack_entry[0] not in old_pack_numbers_list
+    assert thumbnail_pack.read_data(pack_entry) == b'second'
+    for old_pack_number in old_pack_numbers_list:
+        assert not os.path.exists(thumbnail_pack.read_pack_path(old_pack_number))
+
+
+def test_pack_shared_by_threads(thumbnail_pack):
+    errors_list = list()
+
+    def add_and_read(n):
+        try:
+            for m in range(20):
+                img_cache_name = f'{n}-{m}.jpg'
+                add_thumbnail(thumbnail_pack, img_cache_name, img_cache_name.encode())
+                pack_entry = thumbnail_pack.read_entries([img_cache_name])[img_cache_name]
+                assert thumbnail_pack.read_data(pack_entry) == img_cache_name.encode()
+        except Exception as e:
+            errors_list.append(e)
+
+    threads_list = [threading.Thread(target=add_and_read, args=(n,)) for n in range(4)]
+    for thread in threads_list:
+        thread.start()
+    for thread in threads_list:
+        thread.join()
+
+    assert errors_list == []
+    assert len(thumbnail_pack.read_packed_names()) == 80
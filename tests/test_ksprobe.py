@@ -0,0 +1,38 @@
+from ksprobe import PictureHeader
+from sample_pictures import make_tiff_data, make_jpeg, make_png
+
+
+def test_jpeg_size_and_orientation(tmp_path):
+    img_path = tmp_path / 'rotated.jpg'
+    img_path.write_bytes(make_jpeg(4000, 3000, make_tiff_data([(0x0112, 3, 6)])))
+
+    header = PictureHeader.read_header(str(img_path))
+
+    assert (header['width'], header['height'], header['orientation']) == (4000, 3000, 6)
+    assert PictureHeader.read_display_size(str(img_path)) == (3000, 4000)
+
+
+def test_jpeg_without_exif(tmp_path):
+    img_path = tmp_path / 'plain.jpg'
+    img_path.write_bytes(make_jpeg(640, 480))
+
+    assert PictureHeader.read_display_size(str(img_path)) == (640, 480)
+    assert PictureHeader.read_header(str(img_path))['orientation'] == 1
+
+
+def test_png_size(tmp_path):
+    img_path = tmp_path / 'plain.png'
+    img_path.write_bytes(make_png(320, 200))
+
+    assert PictureHeader.read_display_size(str(img_path)) == (320, 200)
+
+
+def test_unknown_and_truncated_files(tmp_path):
+    unknown_path = tmp_path / 'notes.txt'
+    unknown_path.write_bytes(b'not a picture at all')
+    truncated_path = tmp_path / 'truncated.jpg'
+    truncated_path.write_bytes(make_jpeg(640, 480, make_tiff_data([(0x0112, 3, 6)]))[:20])
+
+    assert PictureHeader.read_header(str(unknown_path)) == {'orientation': 1}
+    assert PictureHeader.read_display_size(str(truncated_path)) == (0, 0)
+    assert PictureHeader.read_display_size(str(tmp_path / 'missing.jpg')) == (0, 0)